@@ -59,6 +59,13 @@ DEFAULT_COMMANDS = {
             },
         }
     },
+    'BENCHMARKS': {
+        'name': 'benchmark',
+        'module': 'tests.benchmarks',
+        'require_args': [],
+        'has_args': True,
+        'args': {}
+    },
     'CREATE': {
         'name': 'CREATE',
         'module': 'services.main',
@@ -85,6 +92,11 @@ DEFAULT_COMMANDS = {
                 'validate': lambda value:  value in DB_TABLES,
                 'message': 'Model needs to be a string and already declared in table map'
             },
+            'payload': {
+                'name': 'payload',
+                'validate': lambda payload_keys, model:  payload_keys <= {'cursor', 'page_size'},
+                'message': 'Payload data must be <= {"cursor", "page_size"}'
+            }
         }
     },
     'FETCH_ONE': {
@@ -120,8 +132,8 @@ DEFAULT_COMMANDS = {
             },
             'payload': {
                 'name': 'payload',
-                'validate': lambda payload_keys, model:  payload_keys <= set(TABLES_MAP.get(model).get('fields').keys()),
-                'message': f'Payload data must be <= field_map fields'
+                'validate': lambda payload_keys, model:  {key.split('__')[0] for key in payload_keys} <= set(TABLES_MAP.get(model).get('fields').keys()) | {'cursor', 'page_size'},
+                'message': 'Payload data must be <= field_map fields (with an optional __lookup), "cursor" and "page_size"'
             }
         }
     },
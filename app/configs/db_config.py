@@ -8,3 +8,20 @@ DB_NAME = os.getenv('DB_NAME')
 
 TEST_DB_NAME = f'test_{DB_NAME}'
 
+
+# max pooled connections per database file
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+
+# seconds to wait for a locked database or a free pooled connection
+DB_TIMEOUT = float(os.getenv('DB_TIMEOUT', 5))
+
+
+def get_db_name():
+    '''
+    Returns the database in use. The test database is used when
+    CURRENT_WORKING_DB_ENVIRON is set to test
+    '''
+    is_test_environ = os.getenv('CURRENT_WORKING_DB_ENVIRON', '').lower() == 'test'
+    if is_test_environ:
+        return TEST_DB_NAME
+    return DB_NAME
@@ -0,0 +1,65 @@
+class Aggregate:
+    '''
+    An SQL aggregate over one field of a QuerySet, computed by sqlite
+        Payment.query().filter(subscription_id=sub_id).aggregate(Sum('amount'), Count('*'))
+        -> {'amount__sum': 5000, 'count': 2}
+
+        Visit.query().group_by('client_id').annotate(visits=Count('*'))
+        -> [{'client_id': '...', 'visits': 3}, ...]
+
+    - the result key is field__function unless a name is given as keyword
+    - distinct=True aggregates the distinct values only
+    '''
+    function = None
+    allow_all = False # accepts '*' for every row
+
+    def __init__(self, field, distinct=False):
+        name = self.__class__.__name__
+        if not isinstance(field, str) or not field:
+            raise Exception(f'Invalid field {field} for {name}, expected a field name')
+        if field == '*' and not self.allow_all:
+            raise Exception(f'{name} needs a field name')
+        if field == '*' and distinct:
+            raise Exception(f'distinct can not be used with {name}(\'*\')')
+
+        self.field = field
+        self.distinct = distinct
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.field!r})'
+
+    @property
+    def default_alias(self) -> str:
+        if self.field == '*':
+            return self.function.lower()
+        return f'{self.field}__{self.function.lower()}'
+
+    def check(self, fields) -> None:
+        if self.field != '*' and self.field not in fields:
+            raise Exception(f'Invalid field {self.field} provided for {self}')
+
+    def compile(self) -> str:
+        if self.field == '*':
+            return f'{self.function}(*)'
+        return f'{self.function}({'DISTINCT ' if self.distinct else ''}{self.field})'
+
+
+class Count(Aggregate):
+    function = 'COUNT'
+    allow_all = True
+
+
+class Sum(Aggregate):
+    function = 'SUM'
+
+
+class Avg(Aggregate):
+    function = 'AVG'
+
+
+class Min(Aggregate):
+    function = 'MIN'
+
+
+class Max(Aggregate):
+    function = 'MAX'
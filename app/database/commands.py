@@ -2,6 +2,7 @@ import os
 from utils.general import get_json
 from database.fields import get_contraint_keys_by_field_name, get_field_from_datatype
 from database.db import get_table_map, format_model_name
+from database.schema import SchemaRegistry
 
 
 class DBService:
@@ -34,7 +35,8 @@ class DBCommands:
         self.meta = meta
         # self.required_contraint = get_contraint_keys()
 
-        self.table_map = get_table_map()
+        # copy so new models are not added to the shared schema registry
+        self.table_map = dict(get_table_map())
 
     def success(self, message='Success', data=None):
         return {
@@ -96,6 +98,7 @@ class DBCommands:
         #     file.write(formatted_data)
 
         self.__create_model_class(field_map['fields']) # create a model_name.py file in models dir
+        SchemaRegistry.invalidate() # recompile schema to pick up the new model
         self.__start_db_service()
 
     def create_bulk_models(self, **kwargs):
@@ -0,0 +1,281 @@
+import os
+import queue
+import atexit
+import sqlite3
+import threading
+import weakref
+from functools import wraps
+from contextlib import contextmanager
+from pathlib import Path
+from configs import db_config
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Checkout:
+    '''
+    The connection checked out by one thread and the number of units of
+    work holding it. It is handed back to the pool when the last hold is
+    released or when the thread ends and its locals are dropped
+    '''
+    __slots__ = ('conn', 'holds', 'finalizer', '__weakref__')
+
+    def __init__(self, pool, conn):
+        self.conn = conn
+        self.holds = 0
+        self.finalizer = weakref.finalize(self, pool._put_back, conn)
+
+
+class ConnectionPool:
+    '''
+    A bounded pool of persistent connections to one database file.
+    - each thread keeps the connection it checked out and reuses it for
+        every query
+    - a unit of work holds the connection (see hold()), it goes back to
+        the pool when the last hold is released or when the thread ends
+    - connections are opened once in WAL mode with the pragmas applied
+    - at most pool_size connections are opened, extra threads wait for a
+        released connection
+    '''
+    PRAGMAS = (
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA foreign_keys = ON',
+        'PRAGMA synchronous = NORMAL',
+    )
+
+    def __init__(self, db, pool_size=None, timeout=None):
+        self.db = db
+        self.pool_size = pool_size if pool_size else db_config.DB_POOL_SIZE
+        self.timeout = timeout if timeout else db_config.DB_TIMEOUT
+
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._local = threading.local()
+        # reentrant, a checkout dropped while the lock is held puts its connection back
+        self._lock = threading.RLock()
+
+    def _open(self) -> sqlite3.Connection:
+        logger.info(f'Opening pooled connection to {self.db}')
+
+        # the pool hands connections between threads, access is still one thread at a time
+        conn = sqlite3.connect(Path(self.db), timeout=self.timeout, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self, hold=False) -> sqlite3.Connection:
+        checkout = getattr(self._local, 'checkout', None)
+        if checkout is None:
+            checkout = self._checkout()
+
+        if hold:
+            checkout.holds += 1
+        return checkout.conn
+
+    def _checkout(self) -> _Checkout:
+        conn = None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if len(self._connections) < self.pool_size:
+                    conn = self._open()
+                    self._connections.append(conn)
+
+            if conn is None:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise Exception(f'No connection available for {self.db} after {self.timeout}s (pool size {self.pool_size})')
+
+        checkout = _Checkout(self, conn)
+        self._local.checkout = checkout
+        return checkout
+
+    def release(self) -> None:
+        ''' Drop one hold, the connection goes back to the pool with the last one '''
+        checkout = getattr(self._local, 'checkout', None)
+        if checkout is None:
+            return
+
+        checkout.holds -= 1
+        if checkout.holds > 0:
+            return
+
+        self._local.checkout = None
+        checkout.finalizer()
+
+    def _put_back(self, conn) -> None:
+        with self._lock:
+            # connections of a closed pool are not reused
+            if not any(conn is pooled for pooled in self._connections):
+                return
+
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @property
+    def held(self) -> sqlite3.Connection | None:
+        ''' The connection checked out by the current thread '''
+        checkout = getattr(self._local, 'checkout', None)
+        return checkout.conn if checkout is not None else None
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error as err:
+                    logger.error(f'Error closing connection to {self.db}: {err}')
+            self._connections = []
+            self._idle = queue.LifoQueue()
+            self._local = threading.local()
+
+
+class ConnectionManager:
+    '''
+    Process-wide access point for pooled database connections.
+    - one ConnectionPool per database file
+    - all pools are closed when the process exits
+    '''
+    _pools = {}
+    _lock = threading.Lock()
+    _atomic_depth = {} # id(connection) -> open atomic blocks
+
+    @classmethod
+    def _get_pool(cls, db) -> ConnectionPool:
+        db_path = os.path.abspath(db)
+        pool = cls._pools.get(db_path, None)
+        if pool is None:
+            with cls._lock:
+                pool = cls._pools.get(db_path, None)
+                if pool is None:
+                    pool = ConnectionPool(db_path)
+                    cls._pools[db_path] = pool
+        return pool
+
+    @classmethod
+    def get_connection(cls, db) -> sqlite3.Connection:
+        ''' Returns the connection bound to the current thread '''
+        return cls._get_pool(db).acquire()
+
+    @classmethod
+    def hold(cls, db) -> sqlite3.Connection:
+        '''
+        Returns the connection bound to the current thread and keeps it
+        checked out until the matching release()
+        '''
+        return cls._get_pool(db).acquire(hold=True)
+
+    @classmethod
+    def release(cls, db) -> None:
+        ''' Drop a hold of hold(), the last one hands the connection back to the pool '''
+        pool = cls._pools.get(os.path.abspath(db), None)
+        if pool:
+            pool.release()
+
+    @classmethod
+    @contextmanager
+    def connection(cls, db=None):
+        '''
+        Hold the connection of the current thread for the block
+            with ConnectionManager.connection() as conn:
+                conn.execute('PRAGMA foreign_keys = OFF')
+                ...
+        '''
+        db = db if db else db_config.get_db_name()
+        conn = cls.hold(db)
+        try:
+            yield conn
+        finally:
+            cls.release(db)
+
+    @classmethod
+    def in_atomic(cls, conn) -> bool:
+        ''' Check if an atomic block owns the transaction of conn '''
+        return cls._atomic_depth.get(id(conn), 0) > 0
+
+    @classmethod
+    def close(cls, db=None) -> None:
+        '''
+        Close the pooled connections of one database, or of every
+        database when db is not set
+        '''
+        with cls._lock:
+            if db is None:
+                pools = list(cls._pools.values())
+                cls._pools = {}
+            else:
+                pool = cls._pools.pop(os.path.abspath(db), None)
+                pools = [pool] if pool else []
+
+        for pool in pools:
+            pool.close()
+
+
+class Atomic:
+    '''
+    Context manager and decorator running a block in one transaction.
+    - the outermost block begins the transaction, commits on exit and
+        rolls back on error
+    - every block holds the connection of the thread (see
+        ConnectionManager.hold()) until it exits
+    - nested blocks are savepoints, an error in a nested block only rolls
+        back that block
+    - the database is resolved when the block is entered so it can be
+        used as a decorator at class definition time
+    '''
+    def __init__(self, db=None):
+        self.db = db
+        self._stack = []
+
+    def __enter__(self):
+        db = self.db if self.db else db_config.get_db_name()
+        conn = ConnectionManager.hold(db)
+        depth = ConnectionManager._atomic_depth.get(id(conn), 0)
+
+        if depth == 0:
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN')
+        else:
+            conn.execute(f'SAVEPOINT atomic_{depth}')
+
+        ConnectionManager._atomic_depth[id(conn)] = depth + 1
+        self._stack.append((db, conn, depth))
+        return conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        db, conn, depth = self._stack.pop()
+
+        try:
+            if depth == 0:
+                if exc_type is None:
+                    conn.commit()
+                else:
+                    conn.rollback()
+            else:
+                if exc_type is not None:
+                    conn.execute(f'ROLLBACK TO SAVEPOINT atomic_{depth}')
+                conn.execute(f'RELEASE SAVEPOINT atomic_{depth}')
+        finally:
+            if depth == 0:
+                ConnectionManager._atomic_depth.pop(id(conn), None)
+            else:
+                ConnectionManager._atomic_depth[id(conn)] = depth
+            ConnectionManager.release(db)
+
+        # never swallow the error
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Atomic(self.db):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+atexit.register(ConnectionManager.close)
@@ -5,8 +5,14 @@ from logs.utils import log_to_file, log_error_to_file
 from exceptions.exception import ValidationError
 from helpers.export_helper import export_helper
 from helpers.db_helpers import generate_id
+from utils.general import uuid7
 from utils.import_file import ImportManager
-from database.fields import get_contraint_keys_by_field_name, get_field_from_datatype, get_required_datatypes
+from database.fields import Field, get_contraint_keys_by_field_name, get_field_from_datatype, get_required_datatypes
+from database.schema import SchemaRegistry
+from database.connection import ConnectionManager, Atomic
+from database.query import QuerySet, QuerySetDescriptor, split_lookup, DATETIME_FORMAT
+from database.related import lazy_reference
+from database.session import get_session
 from configs import db_config
 from pathlib import Path
 from datetime import datetime, timedelta
@@ -50,44 +56,16 @@ def get_contraint_from_field_instance(instance, field_type=True):
     
 def get_table_map(model=None):
     ''' Helper function to get table map for all model or specific model if model is set'''
-    from database.fields import Field
-
-    os.makedirs('database', exist_ok=True)
-
-    # file_path = os.path.join('database', 'tables.json')
-    file_path = os.path.join('models')
-    model_files = os.listdir(file_path)
-
-    table_map = {}
-    for model_file in model_files:
-        field_map = {'fields': {}}
-        if '.py' in model_file and '__init__' not in model_file:
-            model_file = model_file.replace('.py', '')
-            module = import_module(f'models.{model_file}')
-            model_class_name = format_model_name(model_file)
-            model_class = getattr(module, model_class_name)
-            for key, value in model_class.__dict__.items():
-                if isinstance(value, Field):  
-                    contraint = get_contraint_from_field_instance(value)
-                    contraint['datatype'] = value.field_type
-                    field_map['fields'][key] = contraint
-            if model and model == model_file:
-                return field_map
-            table_map[model_file] = field_map
-    
-    return table_map
+    from database.schema import SchemaRegistry
 
+    table_map = SchemaRegistry.get_tables()
 
-    # data = {}
-    # with open(file_path, mode='r') as file:
-    #     data = json.load(file)
-    # if not model:
-    #     return data
-    
-    # if data == {}:
-    #     return data
-    
-    # return data.get(model, {})
+    if model:
+        field_map = table_map.get(model, None)
+        if field_map is not None:
+            return field_map
+
+    return table_map
 
 def format_model_name(model):
     '''
@@ -101,6 +79,21 @@ def format_model_name(model):
     # Capitalize each word and join
     return ''.join(word.title() for word in model.split())
 
+# table name -> model class, filled when a model class is defined
+MODEL_REGISTRY = {}
+
+def get_model_class(model):
+    '''
+    Helper function to get the model class of a table name from the
+    registry. The models module is only imported on the first lookup of
+    a model that is not defined yet
+    '''
+    model_class = MODEL_REGISTRY.get(model, None)
+    if model_class is None:
+        import_module(f'models.{model}')
+        model_class = MODEL_REGISTRY.get(model, None)
+    return model_class
+
 
 class DB:
     '''
@@ -191,6 +184,7 @@ class DB:
     _state = 'init' # monitor init state: init || ready
 
     _db = None
+    _bootstrapped = {} # database path -> schema version applied in this process
 
     lazy_fk = []
 
@@ -205,62 +199,119 @@ class DB:
         except TypeError:
             self.field_map = self._get_field_map(self)
         
-        conn = None
-        logger.info(f'Initializing database connection for {self.model_name}...')
-        self.write(f'Initializing database connection for {self.model_name}...')
-        
         if not using:
             logger.warn(f"No Database provided. Ensure DB config is set @ {__name__} 'line {inspect.currentframe().f_lineno}'")
             self.write_error('No Database provided. Ensure DB config is set')
             exit(1)
-        try:
-            self._db = using
 
-            conn = sqlite3.connect(Path(self._db))
-            conn.execute("PRAGMA foreign_keys = ON")
+        self._db = using
+
+        # tables are only created once per process and database file
+        if self._is_bootstrapped():
+            return
+
+        logger.info(f'Initializing database connection for {self.model_name}...')
+        self.write(f'Initializing database connection for {self.model_name}...')
+
+        try:
+            conn = ConnectionManager.get_connection(self._db)
             
             logger.info(f'Database connection established to {self._db}')
             self.write(f'Database connection established to {self._db}\n')
 
-            conn.close()
-            self._init_database_tables()
+            self._bootstrap_schema(conn)
         except Exception as err:
-            if conn:
-                conn.close()
             logger.exception(f"Error connecting to {self._db} @ {__name__} 'line {inspect.currentframe().f_lineno}'\n")
             self.write_error(f"Error connecting to {self._db} @ {__name__} 'line {inspect.currentframe().f_lineno}'\n")
             self.write_error(str(err))
             self.stderr.flush()
 
             raise err
-                
+
+    def _is_bootstrapped(self) -> bool:
+        '''
+        Check if the current schema version was already applied to the 
+        database file in this process
+        '''
+        db_path = os.path.abspath(self._db)
+        version = DB._bootstrapped.get(db_path, None)
+
+        if version is None:
+            return False
+
+        # the file may have been dropped since the bootstrap
+        if not os.path.exists(db_path):
+            DB.reset_bootstrap(db_path)
+            return False
+
+        return version == SchemaRegistry.get_version()
+
+    @classmethod
+    def reset_bootstrap(cls, db) -> None:
+        '''
+        Close the pooled connections to a database file and forget its 
+        bootstrap. Call before the file is removed
+        '''
+        db_path = os.path.abspath(db)
+        DB._bootstrapped.pop(db_path, None)
+        ConnectionManager.close(db_path)
+
+    def _bootstrap_schema(self, conn):
+        '''
+        Create the tables when the schema version stamped on the database 
+        (PRAGMA user_version) does not match the compiled schema
+        '''
+        version = SchemaRegistry.get_version()
+        current_version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+        if current_version != version:
+            logger.info(f'Applying schema version {version} to {self._db}')
+            self._init_database_tables()
+            self._record_migration(conn)
+
+            # pragma values cannot be bound as parameters
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            self._commit(conn)
+
+        DB._bootstrapped[os.path.abspath(self._db)] = version
+
+    def _record_migration(self, conn):
+        '''
+        Log the applied schema (tables, fields and indexes) to the
+        migration table. Going back to an earlier schema only refreshes
+        the timestamp of its row
+        '''
+        if 'migration' not in get_table_map():
+            return
+
+        schema = json.dumps(SchemaRegistry.get_tables(), indent=4, sort_keys=True, default=str)
+        conn.execute(
+            '''
+                INSERT INTO migration (migration_id, table_map, timestamp) VALUES (?, ?, ?)
+                ON CONFLICT (table_map) DO UPDATE SET timestamp = excluded.timestamp;
+            ''',
+            (uuid7(), schema, datetime.now().strftime(DATETIME_FORMAT))
+        )
+
     def _connect_to_db(self):
         '''
-        handles reconnection to database
+        returns the pooled connection of the current thread. The 
+        connection stays open and is reused by every query
         '''
 
         if self._db is None:
             DB.set_db_name()
         try:
-            if self.allow_print:
-                self.write('\nInitializing database connection...\n')
-            self.conn = sqlite3.connect(Path(self._db))
+            self.conn = ConnectionManager.get_connection(self._db)
 
             # access column by name (like a dictionary)
             # self.conn.row_factory = sqlite3.Row
 
-            self.conn.execute("PRAGMA foreign_keys = ON")
-            # logger.info('Database connection established')
-
-            if self.allow_print:
-                self.write('Database connection established\n')
-
             return self.conn
         except Exception as err:
             logger.exception(f"Error connecting to {self._db} @ {__name__} 'line {inspect.currentframe().f_lineno}'\n")
             self.write_error(f"Error connecting to {self._db} @ {__name__} 'line {inspect.currentframe().f_lineno}'\n")
             self.write_error(str(err))
-            self.conn.close()
             raise err
 
     @property
@@ -282,15 +333,39 @@ class DB:
         self.stdout.write(f'{text}\n')
         self.stdout.flush()
 
+    @classmethod
+    def atomic(cls) -> Atomic:
+        '''
+        Run a block or a function in one transaction. Saves, updates and
+        deletes inside the block are committed together on exit and
+        nested blocks become savepoints
+            with Client.atomic():
+                client.save()
+                subscription.save()
+
+            @InitDB.atomic()
+            def log_visit(self): ...
+        '''
+        return Atomic()
+
+    @classmethod
+    def _commit(cls, conn) -> None:
+        ''' Commit the transaction unless an atomic block owns it '''
+        if not ConnectionManager.in_atomic(conn):
+            conn.commit()
+
+    @classmethod
+    def _rollback(cls, conn) -> None:
+        ''' Rollback the transaction unless an atomic block owns it '''
+        if not ConnectionManager.in_atomic(conn):
+            conn.rollback()
+
     @classmethod
     def set_db_name(cls):
         '''
         Change database name depending on if environment is test environment
         '''
-        is_test_environ = os.getenv('CURRENT_WORKING_DB_ENVIRON', '').lower() == 'test' 
-        using = db_config.TEST_DB_NAME
-        if not is_test_environ:
-            using = db_config.DB_NAME
+        using = db_config.get_db_name()
         
         if not using:
             logger.warn(f"Database name not found\n")
@@ -346,7 +421,7 @@ class DB:
         database if tables do not exist
         '''
 
-        tables = self.table_map.keys()
+        tables = get_table_map().keys()
 
         for table_name in tables:
             if table_name in ['backup', 'log']:
@@ -369,7 +444,7 @@ class DB:
         
         table_detail = self._get_table_detail(table_name=table_name)
 
-        table_field_map = self.table_map.get(table_name).get('fields')
+        table_field_map = get_table_map(model=table_name).get('fields')
 
         # get fk map from detail
         fk_field_map = table_detail.get('fk_field_map', {})
@@ -442,15 +517,43 @@ class DB:
             cursor = self.conn.cursor()
             try:
                 cursor.execute(query)
-                self.conn.commit()
+                self._create_indexes(cursor, table_name)
+
+                self._commit(self.conn)
             except Exception as err:
-                self.conn.close()
+                self._rollback(self.conn)
                 logger.exception(f"Error creating {table_name} table @ {__name__} 'line {inspect.currentframe().f_lineno}'")
                 self.write_error(f"Error creating {table_name} table")
                 self.write(str(err))
                 raise err
 
-            self.conn.close()
+    def _create_indexes(self, cursor, table_name):
+        '''
+        Bring the indexes of a table in line with the schema
+        - declared indexes are created if missing
+        - an index that changed columns is rebuilt
+        - indexes named like ours (*_idx) that are no longer declared
+            are dropped, sqlite's own autoindexes are never touched
+        '''
+        indexes = get_table_map(model=table_name).get('indexes', {})
+
+        existing = cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name LIKE '%\\_idx' ESCAPE '\\';",
+            (table_name,)
+        ).fetchall()
+
+        for (index_name,) in existing:
+            columns = [row[2] for row in cursor.execute(f'PRAGMA index_info({index_name});').fetchall()]
+            if indexes.get(index_name, None) != columns:
+                if self.allow_print:
+                    self.write(f'Dropping index {index_name}...')
+                cursor.execute(f'DROP INDEX IF EXISTS {index_name};')
+
+        for index_name, columns in indexes.items():
+            query = f'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name}({', '.join(columns)});'
+            if self.show_sql:
+                self.write(query)
+            cursor.execute(query)
 
     def _get_datatype(self, obj):
         '''
@@ -509,7 +612,8 @@ class DB:
         NOT_NULL_FIELDS = []
         DATATYPE_MAP = {}
 
-        table_field = self.table_map.get(table_name, None)
+        table_map = get_table_map()
+        table_field = table_map.get(table_name, None)
 
         if table_field is None:
             raise ValidationError(f"Invalid table name '{table_name}'. ensure table is in TABLE_MAP")
@@ -563,10 +667,10 @@ class DB:
             
             if datatype == 'fk':
                 reference_model = field.get('to', None)
-                if reference_model not in self.table_map.keys():
+                if reference_model not in table_map.keys():
                     raise ValidationError(f'Invalid model {reference_model} for {key}')
                 
-                fk_field_datatype = self.table_map[reference_model]['fields'].get(f'{reference_model}_id', {}).get('datatype', None)
+                fk_field_datatype = table_map[reference_model]['fields'].get(f'{reference_model}_id', {}).get('datatype', None)
                 if not fk_field_datatype:
                     raise ValidationError(f'Datatype not found in fk field {field} @ {reference_model}')
                 contraint = {}
@@ -597,6 +701,102 @@ class DB:
 
         return table_detail
         
+    @classmethod
+    def _get_statements(cls, table_name=None) -> dict:
+        '''
+        Returns the canonical parameterized statements for a table. 
+        The statements are built once from _get_table_detail and reused 
+        for every save, update, delete and lookup so the sqlite3 
+        statement cache gets a hit on the same query text
+        {
+            'columns': ('payment_id', 'client_id', ...),
+            'pk_field': 'payment_id',
+            'pk_index': 0,
+            'insert': 'INSERT INTO payment(payment_id, client_id, ...) VALUES (?, ?, ...);',
+            'update': 'UPDATE payment SET client_id = ?, ... WHERE payment_id = ?;',
+            'delete': 'DELETE FROM payment WHERE payment_id = ?;',
+            'select_pk': 'SELECT payment_id, client_id, ... FROM payment WHERE payment_id = ?;',
+        }
+        '''
+        if table_name is None:
+            table_name = cls.model_name
+
+        statements = SchemaRegistry.get_statements(table_name)
+        if statements is not None:
+            return statements
+
+        table_detail = cls._get_table_detail(cls, table_name=table_name)
+
+        pk_field = table_detail.get('pk_field')
+        columns = tuple(table_detail.get('datatype').keys())
+        column_string = ', '.join(columns)
+
+        statements = {
+            'columns': columns,
+            'pk_field': pk_field,
+            'pk_index': columns.index(pk_field),
+            'insert': f'INSERT INTO {table_name}({column_string}) VALUES ({', '.join(['?' for _ in columns])});',
+            'update': f'UPDATE {table_name} SET {', '.join([f'{column} = ?' for column in columns if column != pk_field])} WHERE {pk_field} = ?;',
+            'delete': f'DELETE FROM {table_name} WHERE {pk_field} = ?;',
+            'select_pk': f'SELECT {column_string} FROM {table_name} WHERE {pk_field} = ?;',
+        }
+
+        SchemaRegistry.set_statements(table_name, statements)
+        return statements
+
+    @classmethod
+    def _get_select_statement(cls, keys: tuple) -> str:
+        '''
+        Returns a cached SELECT statement matching keys by equality
+        '''
+        statements = cls._get_statements()
+
+        cache_key = ('select', keys)
+        query = statements.get(cache_key, None)
+        if query is not None:
+            return query
+
+        if keys == (statements['pk_field'],):
+            query = statements['select_pk']
+        else:
+            where = ' AND '.join([f'{key} = ?' for key in keys])
+            query = f'SELECT {', '.join(statements['columns'])} FROM {cls.model_name}{f' WHERE {where}' if where else ''};'
+
+        statements[cache_key] = query
+        return query
+
+    @classmethod
+    def _get_update_statement(cls, mask: int) -> tuple:
+        '''
+        Returns the columns and the cached UPDATE statement writing the
+        columns set in mask, the datetime columns updated on every write
+        are always written
+            (('status', 'updated_at'), 'UPDATE subscription SET status = ?, updated_at = ? WHERE subscription_id = ?;')
+        '''
+        statements = cls._get_statements()
+
+        cache_key = ('update', mask)
+        update = statements.get(cache_key, None)
+        if update is not None:
+            return update
+
+        pk_field = statements['pk_field']
+        columns = tuple(
+            column for column in statements['columns']
+            if column != pk_field and (
+                mask & cls._model_bits.get(column, 0)
+                or (column in cls._model_datetimes and cls._model_fields[column].on_update)
+            )
+        )
+
+        if len(columns) == len(statements['columns']) - 1:
+            query = statements['update']
+        else:
+            query = f'UPDATE {cls.model_name} SET {', '.join([f'{column} = ?' for column in columns])} WHERE {pk_field} = ?;'
+
+        statements[cache_key] = (columns, query)
+        return columns, query
+
     def _check_if_table_exist(self, table_name: str):
         self._connect_to_db()
         if self.conn:
@@ -623,7 +823,7 @@ class DB:
         pass
 
     def __get_pk_field_name(self, model):
-        for key, value in self.table_map[model]['fields'].items():
+        for key, value in get_table_map(model=model)['fields'].items():
             if value['pk']:
                 return key
 
@@ -633,6 +833,7 @@ class DB:
         db_file = Path(self._db)
         
         if db_file.exists():
+            DB.reset_bootstrap(self._db)
             db_file.unlink()
             self.write(f'Dropped {self._db} database successfully\n')
             logger.info(f'Dropped {self._db} database successfully\n')
@@ -648,24 +849,89 @@ class InitDB(DB):
     DB subclass responsible for CRUD operations and ORM for the 
     current instance of a model
     '''
+    objects = QuerySetDescriptor() # set based update/delete
+    indexes = [] # composite indexes, e.g. [('status', 'expiration_date')]
+    relations = {} # rows of other tables loaded by prefetch_related, see database.related
+    checks = () # model checks (attr, check(value, instance), message) run after the field checks
+    pk_checks = () # model checks run only when the pk is checked
+    _validation_plans = ((), ()) # without and with the pk checks, see _compile_validation_plans
+
+    # recorded once when the model class is defined, see __init_subclass__
+    _model_fields = {} # column -> Field in declaration order
+    _model_pk = None
+    _model_fk = {} # column -> table name of the foreign key
+    _model_datetimes = () # datetime columns, computed by _process_auto_datetime
+    _model_bits = {} # column -> bit of the column in _dirty
+    _dirty = 0 # mask of the columns set since the row was read or written
     
     def __init__(self, **kwargs):
-        is_test_environ = os.getenv('CURRENT_WORKING_DB_ENVIRON', '').lower() == 'test' 
-        using = db_config.TEST_DB_NAME
-        if not is_test_environ:
-            using = db_config.DB_NAME
+        using = db_config.get_db_name()
         self._state = 'init'
         super().__init__(using)
         self._set_attribute_from_kwargs(**kwargs)
 
+    def __init_subclass__(cls, **kwargs):
+        '''
+        Record the fields of the model once: the columns in declaration
+        order, the pk, the foreign key tables, the datetime columns, the
+        dirty bit of each column and the table name. Each field is also set on the class as _column
+        so instances read it from the class, and the model is added to
+        MODEL_REGISTRY
+        '''
+        super().__init_subclass__(**kwargs)
 
-    def __setattr__(self, name, value):
-        from database.fields import Field
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for attr, field in vars(klass).items():
+                if isinstance(field, Field) and not attr.startswith('_'):
+                    fields[attr] = field
+
+        cls._model_fields = fields
+        cls._model_pk = next((attr for attr, field in fields.items() if field.pk), None)
+        cls._model_fk = {attr: getattr(field, 'to', None) for attr, field in fields.items() if field.field_type == 'fk'}
+        cls._model_datetimes = tuple(attr for attr, field in fields.items() if field.field_type == 'datetime')
+        cls._model_bits = {attr: 1 << index for index, attr in enumerate(fields)}
 
-        prev_attr_field_instance = getattr(self, f'_{name}', None)
+        # references to rows (database.related) subclass the model, only the model is registered
+        is_model = 'model_name' in vars(cls) or any(isinstance(field, Field) for field in vars(cls).values())
 
-        if isinstance(prev_attr_field_instance, Field):
-            prev_attr_field_instance._set_data(value, name)
+        for attr, field in fields.items():
+            setattr(cls, f'_{attr}', field)
+
+        if not getattr(cls, 'model_name', None):
+            cls.model_name = cls.__name__.lower()
+
+        if is_model:
+            MODEL_REGISTRY[cls.model_name] = cls
+
+        cls._validation_plans = cls._compile_validation_plans()
+
+    @classmethod
+    def _compile_validation_plans(cls) -> tuple:
+        '''
+        Returns the validation plans of the model, without and with the
+        pk checks. A plan is a flat tuple of (attr, check, message), the
+        checks of the contraints set on each field in declaration order
+        then the model checks
+            ('first_name', check, 'MIN LENGTH CONSTRAINT BROKEN with value {value} on field contraint')
+        '''
+        plan = []
+        for attr, field in cls._model_fields.items():
+            for contraint, func, contraint_value, message in field._checks:
+                check = lambda value, instance, func=func, contraint_value=contraint_value: func(value, contraint_value)
+                plan.append((attr, check, message.replace('{contraint}', 'field')))
+
+        plan = (*plan, *cls.checks)
+        return plan, (*plan, *cls.pk_checks)
+
+
+    def __setattr__(self, name, value):
+        bit = self._model_bits.get(name, 0)
+
+        if bit:
+            self._model_fields[name]._set_data(value, name)
+            # update() only writes the columns set since the last read or write
+            object.__setattr__(self, '_dirty', self._dirty | bit)
 
         return super().__setattr__(name, value)
     
@@ -674,64 +940,119 @@ class InitDB(DB):
         
     def _set_attribute_from_kwargs(self, **kwargs):
         ''' Set the field attributes to the model instance '''
-        from database.fields import Field, ForeignKeyField
-        
         if kwargs == {}:
             return
             
         model = self.model_name
         field_map = get_table_map(model=model)
-        auto_field = ['datetime']
 
         # check if model id is in kwargs if not assign new
         if f'{model}_id' not in kwargs:
             kwargs[f'{model}_id'] = self._get_id()        
         
-        for key in field_map['fields'].keys():
-            # check if autofield data exist
-            datatype = field_map['fields'][key]['datatype']
-            null = field_map['fields'][key]['null']
-            
-            if datatype in auto_field:
-                match datatype:
-                    case 'datetime':
-                        kwargs[key] = self._process_auto_datetime(field_map['fields'][key], **kwargs)
-
-            if key is not None:
-                attr = getattr(self, key)
-                
-                if isinstance(attr, Field):
-                    # make field intance a private attr
-                    setattr(self, f'_{key}', attr)
-
-                _attr = getattr(self, f'_{key}')
+        fk = self._model_fk
+        datetimes = self._model_datetimes
+        for key in self._model_fields:
+            if key in datetimes:
+                kwargs[key] = self._process_auto_datetime(field_map['fields'][key], **kwargs)
+
+            if key in fk:
+                setattr(self, key, self._get_fk_instance(kwargs.get(key, None), key))
+                continue
 
-                if isinstance(_attr, ForeignKeyField):
-                    # save attr value if field instance exist as a private key
-                    instance = self._get_fk_instance(kwargs.get(key, None), key)
-                    setattr(self, key, instance)
-                    continue
-
-                if isinstance(_attr, Field):
-                    # save attr value if field instance exist as a private key
-                    setattr(self, key, kwargs.get(key, None))
-                    
+            setattr(self, key, kwargs.get(key, None))
 
     @property
     def data(self):
         return self._get_data()
 
+    @classmethod
+    def _get_hydration_plan(cls) -> tuple:
+        '''
+        ((column, fk model class or None), ...) in the order of the 
+        table columns, compiled once with the model statements
+        '''
+        statements = cls._get_statements()
+        plan = statements.get('hydrate', None)
+
+        if plan is None:
+            fk = cls._model_fk
+            plan = tuple(
+                (column, get_model_class(fk[column]) if column in fk else None)
+                for column in statements['columns']
+            )
+            statements['hydrate'] = plan
+        return plan
+
+    @classmethod
+    def from_db_row(cls, row) -> Self:
+        '''
+        Build an instance from a row of the model table, the values in
+        the order of the table columns. Rows from our own database are
+        already valid so __init__, validation and the auto datetimes are
+        skipped, the stored values are kept as they are. Foreign keys
+        are lazy references, no query is run. In a session the instance
+        already held for the row is returned
+        '''
+        session = get_session()
+        if session is not None:
+            instance = session.get(cls, row[cls._get_statements()['pk_index']])
+            if instance is not None:
+                return instance
+
+        instance = cls.__new__(cls)
+        set_attr = object.__setattr__
+
+        set_attr(instance, '_db', db_config.get_db_name())
+        set_attr(instance, '_state', 'ready')
+
+        for (column, fk_model), value in zip(cls._get_hydration_plan(), row):
+            if fk_model is not None and value is not None:
+                value = lazy_reference(fk_model, value)
+            set_attr(instance, column, value)
+
+        instance._on_load()
+
+        if session is not None:
+            session.add(instance)
+        return instance
+
+    def _get_prefetched(self, name, queryset) -> QuerySet:
+        '''
+        Returns queryset with the rows prefetched for the relation name
+        already read, or queryset itself when name was not prefetched
+        '''
+        rows = self.__dict__.get('_prefetched', {}).get(name, None)
+        if rows is None:
+            return queryset
+
+        queryset = queryset.all()
+        queryset._result_cache = list(rows)
+        return queryset
+
+    def _on_load(self):
+        '''
+        Called on instances built by from_db_row, set the attributes that
+        are not columns here
+        '''
+        pass
+
     def _get_fk_instance(self, data, attr_name):
-        model_name = attr_name.replace('_id', '')
-        module = import_module(f'models.{model_name}')
-        model_class_name = format_model_name(model_name)
-        model_class = getattr(module, model_class_name, None)
-        kwargs = {}
-        kwargs[attr_name] = data
-
-        instance = model_class.fetch_one(**kwargs)
-        if instance:
-            return instance
+        '''
+        Returns a lazy reference to the row data points to, the row is
+        read when one of its other attributes is accessed. The id comes
+        from the caller so the row is checked to exist (by its pk index,
+        the row itself is not read)
+        '''
+        if data is None or isinstance(data, InitDB):
+            return data
+
+        fk_model = get_model_class(self._model_fk[attr_name])
+        session = get_session()
+        if (session is None or session.get(fk_model, data) is None) and not fk_model.exists(**{fk_model._model_pk: data}):
+            raise ValidationError(f'{fk_model.__name__} is not valid on {self.model_name}')
+
+        return lazy_reference(fk_model, data)
     
     def _process_auto_datetime(self, field_map_detail, **kwargs):
         on_save = field_map_detail.get('on_save', False)
@@ -770,14 +1091,14 @@ class InitDB(DB):
         if model == 'self':
             base_model = kwargs
         else:
-            module = import_module(f'models.{model}')
-            model_class_name = format_model_name(model)
-            base_model_class = getattr(module, model_class_name, None)
+            base_model_class = get_model_class(model)
+            if base_model_class is None:
+                raise Exception(f'Model {model} of {string_path} not found')
             data = {}
             data[f'{model}_id'] = kwargs.get(f'{model}_id', None)
-            base_model = base_model.fetch_one(**data)
+            base_model = base_model_class.fetch_one(**data)
         if not base_model:
-            raise Exception(f'Model class {model_class_name} of {string_path} not found')
+            raise Exception(f'{model} row of {string_path} not found')
         
         while len(string_path_list) != 0:
             current_attr = string_path_list.pop(0)
@@ -799,50 +1120,39 @@ class InitDB(DB):
             base_model = current_attr
 
     def _validate(self, check_id=False) -> None:
-        ''' Validate Fields Based on validation set '''
-        
-        from database.validation import VALIDATOR_MAP
-
-        
-        fields = self.table_map[self.model_name]['fields']
+        '''
+        Validate the instance in one pass over the validation plan of
+        the model, check_id adds the pk checks. An attribute not set on
+        the instance is checked as None, except the pk without check_id
+        as it is assigned when the instance is saved
+        '''
+        values = self.__dict__
+        pk_field = None if check_id else self._model_pk
+        for attr, check, message in self._validation_plans[check_id]:
+            if attr in values:
+                value = values[attr]
+            elif attr == pk_field:
+                continue
+            else:
+                value = None
 
-        for field, config in fields.items():
-            if hasattr(self, f'_{field}'):
-                field_intance = getattr(self, f'_{field}')
-                field_name = get_field_from_datatype(field_intance.field_type)
-                contraints = get_contraint_keys_by_field_name(field_name)
-        
-                for contraint in contraints:
-                    if not check_id and contraint == 'pk':
-                        continue
-
-                    if hasattr(field_intance, contraint):
-                        value = getattr(self, field)
-                        try: 
-                            field_intance._validate_by_contraint(contraint, value)
-                        except Exception as err:
-                            raise ValidationError(str(err))
+            if not check(value, self):
+                raise ValidationError(message.format(value=value))
     
     def _get_pk_field(self):
         '''
         returns the fields contraint for the primary key 
         '''
 
-        model = self.model_name
-        field_map = get_table_map()[model]['fields']
-        model_fields = list(field_map.keys())
+        table = get_table_map(model=self.model_name)
+        pk_key = table.get('pk', None)
 
         data = {}
 
-        for key in model_fields:
-            field_obj = field_map.get(key, {})
-            is_pk = field_obj.get('pk', False)
-            
-            if is_pk:
-                data = {
-                    key: field_obj
-                }
-                break
+        if pk_key:
+            data = {
+                pk_key: table['fields'][pk_key]
+            }
         return data   
     
     def _verify_pk(self):
@@ -854,8 +1164,7 @@ class InitDB(DB):
             pk_key: getattr(self, pk_key)
         }
 
-        instance = self.fetch_one(**kwargs)
-        return instance is not None
+        return self.exists(**kwargs)
 
     def _get_data(self, is_new=False):
         '''
@@ -970,163 +1279,98 @@ class InitDB(DB):
 
     #         return True 
                 
-    def _get_id(self) -> str | None:
+    @classmethod
+    def _get_id(cls) -> str | None:
         '''
-        Create UUID for pk field
+        Create an id for the pk field with the generator of the field. The
+        table is not queried, the PRIMARY KEY constraint rejects the
+        practically impossible clash
         '''
-        try:
-            self._set_table_name()
-        except TypeError:
-            self._set_table_name(self)
+        from database.fields import UUIDField
 
-        self._connect_to_db()
-        if self.conn:
-            model = self.model_name
-            id_exist = True
-            id_string = ""
+        pk_key = cls._get_statements()['pk_field']
+        field_instance = getattr(cls, pk_key, None)
 
-            cursor = self.conn.cursor()
+        if isinstance(field_instance, UUIDField):
+            return field_instance.generate()
 
-            while id_exist:
-                try:
-                    id_string = str(uuid.uuid4())
-                    query = f'''
-                        SELECT * FROM {model.lower()} WHERE {model.lower()}_id = ?;
-                    '''
-
-                    cursor.execute(query, (id_string,))
-                    entry = cursor.fetchone()
-
-                    if not entry:
-                        id_exist = False
-                except Exception as err:
-                    cursor.close()
-                    self.conn.close()
-                    logging.exception(str(err))
-                    sys.stderr.write(f'\n{err}\n')
-                    sys.stderr.flush()
-                    raise err
-            
-            return id_string
+        return uuid7()
 
     def _check_unique_value_in_db(self, field, value):
         '''
         Check if a unique value is present in db before save
         '''
-        model = self.model_name
-
-        query = f'SELECT * FROM {model} WHERE {field} = ?;'
-
-        self._connect_to_db()
-        
-        if self.conn:
-            cursor = self.conn.cursor()
-
-            result = None
-            
-            try:
-                cursor.execute(query, (value,))
-                result = cursor.fetchone()
-                self.conn.close()
-            except Exception as err:
-                logger.exception('Error saving client')
-                self.stderr.write(str(err))
-                self.stderr.flush()
+        if self.exists(**{field: value}):
+            raise ValidationError(f'Unique field {field} already has the value {value}')
 
-                self.conn.close()
-                raise err
-            
-            if result is not None:
-                raise ValidationError(f'Unique field {field} already has the value {value}')
-
-    def __save_to_db(self, **kwargs) -> None:
+    def _get_row_data(self, update=False) -> dict:
         '''
-        Save the data on the current instace of the model in 
-        the database
+        Validated data of the current instance ready to be written, with
+        the auto datetime fields filled in
         '''
         try:
             field_map = self._get_field_map()
         except TypeError:
             field_map = self._get_field_map(self)
 
-        model = self.model_name
-
-        model_fields = list(field_map.keys())
-        update = kwargs.get('update', False)
-
-        if update and not isinstance(update, bool):
-            raise Exception(f'Invalid type for update got {type(update)} but expected bool')
-                
         validated_data = self._get_data(is_new=True)
 
-        pk_key = ''
-        pk_value = ''
-        query = ''
-        values = tuple()
         # handle date
-        for key in model_fields:
-            field_obj = field_map.get(key, {})
-            is_pk = field_obj.get('pk', False)
-            datatype = field_obj.get('datatype', False)
-            is_date = datatype == 'datetime'
+        for key, field_obj in field_map.items():
+            if field_obj.get('datatype', False) != 'datetime':
+                continue
+
             on_update = field_obj.get('on_update', False)
             on_save = field_obj.get('on_save', False)
-
             value = validated_data.get(key, None)
-            
-            # get pk field key and value
-            if is_pk:
-                pk_key = key
-                pk_value = value
 
             # check if date field require auto update
-            if is_date:
-                if on_update and not value:
-                    validated_data[key] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                elif on_save and not update:
-                    validated_data[key] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                else:
-                    validated_data[key] = value              
+            if on_update and (update or not value):
+                validated_data[key] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+            elif on_save and not update and not (value and field_obj.get('offset', False)):
+                # offset dates (expiration_date) keep the value computed
+                # from the instance
+                validated_data[key] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+            else:
+                validated_data[key] = value
 
-        if not update:
+        return validated_data
+
+    def __save_to_db(self, **kwargs) -> None:
+        '''
+        Save the data on the current instace of the model in 
+        the database
+        '''
+        update = kwargs.get('update', False)
+
+        if update and not isinstance(update, bool):
+            raise Exception(f'Invalid type for update got {type(update)} but expected bool')
+                
+        validated_data = self._get_row_data(update=update)
 
-            # get primary key string
-            uuid_string = self._get_id()
+        statements = self._get_statements()
+        columns = statements['columns']
+        pk_key = statements['pk_field']
 
-            # add key to object
-            if pk_key not in validated_data:
-                data = {
-                    pk_key: uuid_string,
-                    **validated_data
-                }
+        if not update:
+            # the pk is assigned when the instance is created
+            if not validated_data.get(pk_key, None):
+                uuid_string = self._get_id()
+                validated_data[pk_key] = uuid_string
                 # set id to object
                 setattr(self, pk_key, uuid_string)
-            else:
-                data = validated_data
-            
-            
 
-            # please ignore the tab sapce \t: it is used to make the query readable on terminal
-            query = f'''
-                    INSERT INTO {model.lower()}({',\n\t\t\t'.join([key for key in data.keys()])})
-                    VALUES ({', '.join(['?' for key in data.keys()])});
-            '''
-            values = tuple(data.values())
+            query = statements['insert']
+            values = tuple(validated_data.get(key, None) for key in columns)
 
         if update:
-            pk_value = validated_data.pop(pk_key, None)
-            data = {
-                **validated_data,
-                pk_key: pk_value
-            }
+            # only the columns set since the row was read or last written
+            mask = self._dirty & ~self._model_bits.get(pk_key, 0)
+            if not mask:
+                return self
 
-            # please ignore the tab sapce \t: it is used to make the query readable on terminal
-            query = f'''
-                    UPDATE {model.lower()} 
-                    SET {', '.join([f'{key} = ?' for key in data.keys() if key != pk_key])}
-                    WHERE {f'{pk_key} = ?'};
-            '''
-            values = tuple(data.values())
+            columns, query = self._get_update_statement(mask)
+            values = tuple(validated_data.get(key, None) for key in columns) + (validated_data.get(pk_key, None),)
 
         if self.show_sql:
             self.write(query)
@@ -1137,17 +1381,21 @@ class InitDB(DB):
 
             try:
                 cursor.execute(query,values)
-                self.conn.commit()
-                self.conn.close()
+                self._commit(self.conn)
+                object.__setattr__(self, '_dirty', 0)
+
+                session = get_session()
+                if session is not None:
+                    session.add(self)
 
             except Exception as err:
                 logger.exception('Error saving client')
                 self.stderr.write(str(err))
                 self.stderr.flush()
-                self.conn.close()
+                self._rollback(self.conn)
                 raise err
-            finally:
-                return self
+
+        return self
 
     def save(self):
         return self.__save_to_db()
@@ -1162,31 +1410,23 @@ class InitDB(DB):
             field_map = self._get_field_map(self)
 
         model = self.model_name
-        model_fields = list(field_map.keys())
-
-        pk_key = ''
-        for key in model_fields:
-            field_obj = field_map.get(key, {})
-            is_pk = field_obj.get('pk', False)
-
-
-            if is_pk:
-                pk_key = key
-                break
+        statements = self._get_statements()
+        pk_key = statements['pk_field']
 
         try:
             self._connect_to_db()
             if self.conn:
                 cursor = self.conn.cursor()
-                query = f'''
-                    DELETE FROM {model.lower()} WHERE {pk_key} = ?;
-            '''
+                query = statements['delete']
             if self.show_sql:
                 self.write(query)
 
             cursor.execute(query, (getattr(self, pk_key),))
-            self.conn.commit()
-            self.conn.close()
+            self._commit(self.conn)
+
+            session = get_session()
+            if session is not None:
+                session.discard(self)
 
             # reset fields back
             self._reset_fields()
@@ -1194,13 +1434,13 @@ class InitDB(DB):
             logger.exception(str(err.message))
             self.stderr.write('\033[31m' + str(err.message + '\033[0m\n'))
             self.stderr.flush()
-            self.conn.close()
+            self._rollback(self.conn)
             raise err
         except Exception as err:
             logging.exception(f'Error deleting {model}')
             self.stderr.write(str(err))
             self.stderr.flush()
-            self.conn.close()
+            self._rollback(self.conn)
             raise err
 
     def _reset_fields(self):
@@ -1222,7 +1462,14 @@ class InitDB(DB):
     def fetch_one(cls, **kwargs) -> Self | None:
         '''
         Get one item from model table. Return None if no item is found
+        - in a session a lookup by pk returns the instance already held
+            for the row without a query
+        - values=True returns the row as a dict and values_list=True as a
+            tuple (or pass the fields to read), no instance is built
         '''
+        values = kwargs.pop('values', False)
+        values_list = kwargs.pop('values_list', False)
+
         try:
             field_map = cls._get_field_map()
         except TypeError:
@@ -1236,16 +1483,23 @@ class InitDB(DB):
         
         if not set(kwargs.keys()) <= set(model_fields):
             raise Exception(f'Invalid field provided for {model} model')
+
+        if values or values_list:
+            return cls._project(cls.query().filter(**kwargs), values, values_list).first()
+
+        # the row is already held by the session
+        session = get_session()
+        if session is not None and len(kwargs) == 1 and cls._get_statements()['pk_field'] in kwargs:
+            instance = session.get(cls, *kwargs.values())
+            if instance is not None:
+                return instance
         
         # get model name
 
         conn = cls._connect_to_db(cls)
         cursor = conn.cursor()
 
-        query = f'''
-            SELECT * FROM {model.lower()}
-            WHERE {' AND '.join([f'{key} = ?' for key in kwargs.keys()])};
-        '''
+        query = cls._get_select_statement(tuple(kwargs.keys()))
 
         if cls.show_sql:
             cls.write(query)
@@ -1257,29 +1511,70 @@ class InitDB(DB):
             result = cursor.fetchone()
 
             cursor.close()
-            conn.close()
             if result is None:
                 return None
-            
-            data = {}   
-            for i in range(len(model_fields)):
-                data[list(model_fields)[i]] = result[i]
 
-            instance = cls(**data)
-            return instance
+            return cls.from_db_row(result)
         except Exception as err:
             cursor.close()
-            conn.close()
             logger.exception(f'Error fetching {model}')
             cls.stderr.write(str(err))
             cls.stderr.flush()
 
             raise err
 
+    @classmethod
+    def query(cls) -> QuerySet:
+        '''
+        Returns a lazy QuerySet of the model table
+            Client.query().filter(display_name='client').order_by('-created_at')[:10]
+        '''
+        return QuerySet(cls)
+
+    @classmethod
+    def exists(cls, **kwargs) -> bool:
+        '''
+        Check if a row matches kwargs (fields with an optional lookup)
+        without reading it
+            Client.exists(phone='081000000001')
+        '''
+        return cls.query().filter(**kwargs).exists()
+
+    @classmethod
+    def count(cls, **kwargs) -> int:
+        ''' Number of rows matching kwargs, counted by sqlite '''
+        return cls.query().filter(**kwargs).count()
+
+    @classmethod
+    def _project(cls, queryset, values=False, values_list=False) -> QuerySet:
+        '''
+        Apply the values / values_list mode of fetch_all, filter and 
+        fetch_one. True reads every column, a list or tuple reads those
+        fields
+        '''
+        if values and values_list:
+            raise Exception('values and values_list can not be used together')
+
+        for name, mode in (('values', values), ('values_list', values_list)):
+            if mode and not isinstance(mode, (bool, list, tuple)):
+                raise Exception(f'Invalid type for {name} got {type(mode)} but expected bool, list or tuple')
+
+        if values:
+            return queryset.values(*([] if values is True else values))
+        if values_list:
+            return queryset.values_list(*([] if values_list is True else values_list))
+        return queryset
+
     @classmethod
     def fetch_all(cls, **kwargs) -> Self | None:
         '''
         Get all items from the model.
+        - pass cursor (None for the first page) to page by keyset, the 
+            result is then (instances, next_cursor)
+        - iterator=True yields every row of the table lazily, reading
+            chunk_size rows at a time
+        - values=True returns dicts and values_list=True tuples of the 
+            columns (or pass the fields to read), no instance is built
         '''
 
         try:
@@ -1288,10 +1583,13 @@ class InitDB(DB):
             field_map = cls._get_field_map(cls)
 
         model = cls.model_name
-        model_fields = field_map.keys()
         col_names = kwargs.get('col_names', False)
         page = kwargs.get('page', 1) # default page
         page_size = kwargs.get('page_size', 100) # default pagination
+        iterator = kwargs.get('iterator', False)
+        chunk_size = kwargs.get('chunk_size', 500)
+        values = kwargs.get('values', False)
+        values_list = kwargs.get('values_list', False)
 
         if not field_map:
             raise Exception(f'Field map not found on {model} model')
@@ -1305,59 +1603,52 @@ class InitDB(DB):
         if page_size and not isinstance(page_size, int):
             raise Exception(f'Invalid type for page_size got {type(page_size)} but expected int')
         
-        OFFSET = (page - 1) * page_size
- 
-        conn = cls._connect_to_db(cls)
-        cursor = conn.cursor()
+        if iterator and not isinstance(iterator, bool):
+            raise Exception(f'Invalid type for iterator got {type(iterator)} but expected bool')
 
-        query = f'''
-            SELECT * FROM {model.lower()}
-            LIMIT {page_size}
-            OFFSET {OFFSET};
-        '''
+        queryset = cls._project(cls.query(), values, values_list)
 
-        if cls.show_sql:
-            cls.write(query)
+        if 'cursor' in kwargs:
+            return queryset.paginate(page_size, kwargs.get('cursor'))
 
-        try:
-            cursor.execute(query)
-            result = cursor.fetchall()
-            cursor.close()
-            conn.close()
-            
+        # order by the cursor fields so pages are stable
+        queryset = queryset.order_by(*get_table_map(model=model)['cursor'])
+
+        if not iterator:
+            OFFSET = (page - 1) * page_size
+            queryset = queryset.limit(page_size).offset(OFFSET)
+
+        # only exports will set col_name to true so no need to create client obj
+        if col_names:
+            columns = cls._get_statements()['columns']
+            rows = queryset.values_list(*columns).iterator(chunk_size)
+
+            if iterator:
+                return (rows, list(columns))
+
+            result = list(rows)
             if not len(result) > 0:
                 return []
-            
-            # only exports will set col_name to true so no need to create client obj
-            if col_names:
-                # Get column names
-                column_names = [description[0] for description in cursor.description]
 
-                return (result, column_names)
+            return (result, list(columns))
 
-            instance_list = []
-            for data_tuple in result:
-                data = {}
-                for i in range(len(model_fields)):
-                    data[list(model_fields)[i]] = data_tuple[i]
+        if iterator:
+            return queryset.iterator(chunk_size)
 
-                instance = cls(**data)
-                instance_list.append(instance)
-            
-            return instance_list
-        except Exception as err:
-            cursor.close()
-            conn.close()
-            logger.exception(f'Error fetching {model}')
-            cls.stderr.write(str(err))
-            cls.stderr.flush()
-
-            raise err
+        return list(queryset)
 
     @classmethod  
     def filter(cls, **kwargs) -> list:
         '''
         Filter model table based on the values of the model fields
+        - fields take the QuerySet lookups (created_at__date, 
+            status__in, amount__gte, ...)
+        - pass cursor (None for the first page) to page by keyset, the 
+            result is then (instances, next_cursor)
+        - iterator=True yields every matching row lazily, reading 
+            chunk_size rows at a time
+        - values=True returns dicts and values_list=True tuples of the 
+            columns (or pass the fields to read), no instance is built
         '''
         try:
             field_map = cls._get_field_map()
@@ -1366,24 +1657,21 @@ class InitDB(DB):
 
         model = cls.model_name
         model_fields = field_map.keys()
-        date_like_keys = []
-
-        # get date like keys for wild cards
-        for key in model_fields:
-            field_obj = field_map.get(key, {})
-            datatype = field_obj.get('datatype', False)
-            is_date = datatype == 'datetime'
-            
-            if is_date:
-                date_like_keys.append(key)
 
         page = kwargs.pop('page', 1) # default page
         page_size = kwargs.pop('page_size', 100) # default pagination
+        iterator = kwargs.pop('iterator', False)
+        chunk_size = kwargs.pop('chunk_size', 500)
+        values = kwargs.pop('values', False)
+        values_list = kwargs.pop('values_list', False)
+        keyset = 'cursor' in kwargs
+        cursor = kwargs.pop('cursor', None)
 
         if not field_map:
             raise Exception(f'Field map not found on {model} model')
         
-        if not set(kwargs.keys()) <= set(model_fields):
+        # fields may carry a lookup (created_at__gte)
+        if not {split_lookup(key)[0] for key in kwargs.keys()} <= set(model_fields):
             raise Exception(f'Invalid field provided {model} model')
         
         if page and not isinstance(page, int):
@@ -1392,57 +1680,36 @@ class InitDB(DB):
         if page_size and not isinstance(page_size, int):
             raise Exception(f'Invalid type for page_size got {type(page_size)} but expected int')
         
-        OFFSET = (page - 1) * page_size
-        
-        # get model name
-
-        conn = cls._connect_to_db(cls)
-        cursor = conn.cursor()
+        queryset = cls._project(cls.query().filter(**kwargs), values, values_list)
 
-        # add wild card to date like values
-        for key, value in kwargs.items():
-            if key in date_like_keys:
-                kwargs[key] = f'%{value}%'
+        if keyset:
+            return queryset.paginate(page_size, cursor)
 
-        query = f'''
-            SELECT * FROM {model.lower()}
-            WHERE {' AND '.join([f'{key} = ?' if key not in date_like_keys else f'{key} LIKE ?' for key in kwargs.keys()])}
-            LIMIT {page_size}
-            OFFSET {OFFSET};
-        '''
+        # order by the cursor fields so pages are stable
+        queryset = queryset.order_by(*get_table_map(model=model)['cursor'])
 
-        values = tuple(kwargs.values())
-
-        if cls.show_sql:
-            cls.write(query)
+        if iterator:
+            return queryset.iterator(chunk_size)
+        
+        OFFSET = (page - 1) * page_size
 
+        return list(queryset.limit(page_size).offset(OFFSET))
+    
+    @classmethod
+    def _iterate_cursor(cls, cursor, chunk_size=500):
+        '''
+        Yield the rows of an executed cursor reading chunk_size rows at a
+        time. The cursor is closed once the rows are read, the connection
+        is held until then
+        '''
+        ConnectionManager.hold(cls._db)
         try:
-            cursor.execute(query, values)
-            result = cursor.fetchall()
-
-            if not len(result) > 0:
-                return []
-            
-            instance_list = []
-            for data_tuple in result:
-                data = {}
-                for i in range(len(model_fields)):
-                    data[list(model_fields)[i]] = data_tuple[i]
-
-                instance = cls(**data)
-                instance_list.append(instance)
-            
-            return instance_list
-        except Exception as err:
-            logger.exception(f'Error fetching {model}')
-            cls.stderr.write(str(err))
-            cls.stderr.flush()
-
-            raise err
+            while rows := cursor.fetchmany(chunk_size):
+                yield from rows
         finally:
             cursor.close()
-            conn.close()
-    
+            ConnectionManager.release(cls._db)
+
     @classmethod
     def custom(cls, **kwargs) -> Self | None:
         '''
@@ -1461,6 +1728,8 @@ class InitDB(DB):
         col_names = kwargs.get('col_names', False)
         values_only = kwargs.get('values_only', False)
         result_only = kwargs.get('result_only', False)
+        iterator = kwargs.get('iterator', False)
+        chunk_size = kwargs.get('chunk_size', 500)
         
         if not field_map:
             raise Exception(f'Field map not found on {model} model')
@@ -1482,6 +1751,9 @@ class InitDB(DB):
         
         if result_only and not isinstance(result_only, bool):
             raise Exception(f'Invalid type for result_only got {type(result_only)} but expected bool')
+        
+        if iterator and not many:
+            raise Exception('iterator is only supported with many=True')
  
         conn = cls._connect_to_db(cls)
         cursor = conn.cursor()
@@ -1495,12 +1767,14 @@ class InitDB(DB):
             else:
                 cursor.execute(query, values)
 
+            # commit custom insert, update and delete queries
+            if conn.in_transaction:
+                cls._commit(conn)
+
             if not many:
                 result = cursor.fetchone()
                 cursor.close()
-                conn.close()
                 if result is None:
-                    conn.close()
                     return None
                 
                 if result_only:
@@ -1516,11 +1790,22 @@ class InitDB(DB):
                 instance = cls(**data)
 
                 return instance
+            elif iterator:
+                # the cursor stays open until the rows are read
+                rows = cls._iterate_cursor(cursor, chunk_size)
+
+                if result_only:
+                    return rows
+                
+                if col_names:
+                    column_names = [description[0] for description in cursor.description]
+                    return (rows, column_names)
+                
+                return (cls(**dict(zip(model_fields, data_tuple))) for data_tuple in rows)
             else:
 
                 result = cursor.fetchall()
                 cursor.close()
-                conn.close()
 
                 if not len(result) > 0:
                     return []
@@ -1546,13 +1831,89 @@ class InitDB(DB):
 
                 return instance_list
         except Exception as err:
-            conn.close()
+            if conn.in_transaction:
+                cls._rollback(conn)
             logger.exception(f'Error fetching {model}')
             cls.stderr.write(str(err))
             cls.stderr.flush()
 
             raise err
 
+    @classmethod
+    def bulk_create(cls, iterable, batch_size=500) -> tuple[list, list]:
+        '''
+        Insert many rows with one executemany per batch, each batch is
+        committed in its own transaction
+        - iterable yields dicts of field values or unsaved model instances
+            and is consumed one batch at a time
+        - rows are validated before the batch is written and primary keys
+            are assigned without querying the table
+        - a batch that breaks a table constraint is retried row by row so
+            only the offending rows are skipped
+
+        returns (instances, failed) where failed is a list of
+        (data, {'reason': str}) like import_model reports
+        '''
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise Exception(f'Invalid batch_size got {batch_size} but expected a positive int')
+
+        statements = cls._get_statements()
+        query = statements['insert']
+        columns = statements['columns']
+        pk_key = statements['pk_field']
+
+        if cls.show_sql:
+            cls.write(query)
+
+        instances = []
+        failed = []
+
+        def prepare(item):
+            if isinstance(item, cls):
+                instance = item
+            else:
+                data = dict(item)
+                if not data.get(pk_key, None):
+                    data[pk_key] = cls._get_id()
+                instance = cls(**data)
+
+            row_data = instance._get_row_data()
+            return instance, tuple(row_data.get(key, None) for key in columns)
+
+        def write_batch(batch):
+            try:
+                with cls.atomic() as conn:
+                    conn.executemany(query, [row for _, row, _ in batch])
+                instances.extend(instance for instance, _, _ in batch)
+            except sqlite3.IntegrityError:
+                with cls.atomic() as conn:
+                    for instance, row, item in batch:
+                        try:
+                            with cls.atomic():
+                                conn.execute(query, row)
+                            instances.append(instance)
+                        except sqlite3.IntegrityError as err:
+                            failed.append((item, {'reason': str(err)}))
+
+        batch = []
+        for item in iterable:
+            try:
+                instance, row = prepare(item)
+            except Exception as err:
+                failed.append((item, {'reason': str(err)}))
+                continue
+
+            batch.append((instance, row, item))
+            if len(batch) >= batch_size:
+                write_batch(batch)
+                batch = []
+
+        if batch:
+            write_batch(batch)
+
+        logger.info(f'({len(instances)}/{len(instances) + len(failed)}) {cls.model_name} rows inserted')
+        return instances, failed
+
     @classmethod
     def import_model(cls, filepath, file_type, has_header):
         '''
@@ -1579,46 +1940,31 @@ class InitDB(DB):
  
         manager = ImportManager(file_path=filepath, file_type=file_type, has_header=has_header)
         
-        instance_data = []
-        instances = []
-        failed_imports = []
-
-        if file_type.lower() == '.csv':
-            for data_tuple in manager.import_from_csv():
-                data = {}
-                if not has_header:
-                    for i in range(len(model_fields)):
-                        data[model_fields[i]] = data_tuple[i]
-
-                else:
-                    data = data_tuple
-
-                instance_data.append(data)
+        def read_rows():
+            ''' Yield the rows of the file as field dicts, one at a time '''
+            if file_type.lower() == '.csv':
+                for data_tuple in manager.import_from_csv():
+                    data = {}
+                    if not has_header:
+                        for i in range(len(model_fields)):
+                            data[model_fields[i]] = data_tuple[i]
 
-        elif file_type.lower() in {'.xls', '.xlsx'}:
-            for data_tuple in manager.import_from_excel():
-                data = {}
-                for i in range(len(model_fields)):
-                    data[list(model_fields)[i]] = data_tuple[i]
+                    else:
+                        data = data_tuple
 
-                instance_data.append(data)
+                    yield data
 
-        else:
-            for data_tuple in manager.import_from_pdf():
-                data = {}
-                for i in range(len(model_fields)):
-                    data[list(model_fields)[i]] = data_tuple[i]
+            elif file_type.lower() in {'.xls', '.xlsx'}:
+                for data_tuple in manager.import_from_excel():
+                    yield dict(zip(model_fields, data_tuple))
 
-                instance_data.append(data)
+            else:
+                for data_tuple in manager.import_from_pdf():
+                    yield dict(zip(model_fields, data_tuple))
 
-        for data in instance_data:
-            try:
-                instance = cls(**data)
-                instance.save()
-                instances.append(instance)
-            except Exception as err:
-                failed_imports.append((data, {'reason': str(err)}))
-                continue
+        # batches become savepoints of the import transaction
+        with cls.atomic():
+            instances, failed_imports = cls.bulk_create(read_rows())
             
         for i, failed_import in enumerate(failed_imports):
             cls.stdout.write(f'{i + 1} failed: {failed_import[1]['reason']}')
@@ -1632,17 +1978,10 @@ class InitDB(DB):
         Export into csv, xls, pdf
         '''
 
-        instance_data, column_names = cls.fetch_all(col_names=True)
-
-        column_names = column_names if column_names else None
+        rows, column_names = cls.fetch_all(col_names=True, iterator=True)
 
         # remove unnecessary data like ID 
-        formated_data = []
-
-        for data in instance_data:
-            data = list(data)
-            data.pop(0)
-            formated_data.append(data)
+        formated_data = (list(data)[1:] for data in rows)
         
         column_names.pop(0)
 
@@ -1,13 +1,18 @@
-from utils.general import is_valid_date, matches_regex
+from utils.general import is_valid_date, matches_regex, uuid7
+import uuid
+import re
 
 class Field:
 
     null = False
     unique = False
     pk = False
+    index = False
     default = None
     _data = None
+    _checks = () # (contraint, func, contraint value, message) set by _compile_checks
 
+    # shared by every field of the class, subclasses extend it
     _validator_map = {
         'null': {
             'func': lambda value, arg=None: value is not None,
@@ -46,14 +51,30 @@ class Field:
     def set_kargs(self, **kwargs):
         contraints = get_contraint_keys_by_field_name(self.__class__.__name__)
 
-        default_value = None
         for contraint in contraints:
             contraint_value = kwargs.get(contraint, None)
             if contraint_value is not None:
                 setattr(self, contraint, contraint_value)
 
-            if contraint == 'default' and contraint_value is not None:
-                self._set_data(contraint_value)
+        self._compile_checks()
+
+        # validated once every contraint is set
+        if kwargs.get('default', None) is not None:
+            self._set_data(kwargs['default'])
+
+    def _compile_checks(self):
+        '''
+        Resolve the validators of the contraints set on the field once,
+        in the order of the validator map. Validating a value then only
+        runs these checks. A validator with a compile function gets the
+        contraint value it returns (a compiled regex pattern)
+        '''
+        contraints = get_contraint_keys_by_field_name(self.__class__.__name__)
+        self._checks = tuple(
+            (contraint, validator['func'], validator.get('compile', lambda value: value)(getattr(self, contraint)), validator['message'])
+            for contraint, validator in self._validator_map.items()
+            if contraint in contraints and hasattr(self, contraint)
+        )
 
     def _set_data(self, new_data, attr_name=None):
         data = new_data
@@ -68,11 +89,9 @@ class Field:
         self._data = None
 
     def _validate_data(self, data, attr_name=None):
-        field = self.__class__.__name__
-        contraints = get_contraint_keys_by_field_name(field)
-        for contraint in contraints:
-            if hasattr(self, contraint):
-                self._validate_by_contraint(contraint, data, field=field, attr_name=attr_name)
+        for contraint, func, contraint_value, message in self._checks:
+            if not func(data, contraint_value):
+                self._raise_invalid(message, data, self.__class__.__name__, attr_name)
 
     def _validate_by_contraint(self, contraint, data, field='field', attr_name=None):
         validator = self._get_validator(contraint)
@@ -81,8 +100,11 @@ class Field:
             is_valid = validator['func'](data, contraint_value)
 
             if not is_valid:
-                message = validator['message'] + f' on {attr_name}' if attr_name else validator['message']
-                raise Exception(message.format(value=data, contraint=field))
+                self._raise_invalid(validator['message'], data, field, attr_name)
+
+    def _raise_invalid(self, message, data, field, attr_name=None):
+        message = message + f' on {attr_name}' if attr_name else message
+        raise Exception(message.format(value=data, contraint=field))
             
     def _get_validator(self, constraint):
         return self._validator_map.get(constraint, None)
@@ -96,49 +118,48 @@ class Field:
 
     
 class TextField(Field):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+    _validator_map = {
+        **Field._validator_map,
+        'digit': {
+            'func': lambda value, exp_value: isinstance(value, str) and value.isdigit(),
+            'message': 'DIGIT CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'alpha': {
+            'func': lambda value, exp_value: isinstance(value, str) and value.isalpha(),
+            'message': 'ALPHA CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'alphanum': {
+            'func': lambda value, exp_value: isinstance(value, str) and value.isalnum(),
+            'message': 'ALPHANUM CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'max_length': {
+            'func': lambda value, max: not len(value) > max,
+            'message': 'MAX LENGTH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'min_length': {
+            'func': lambda value, min: not len(value) < min,
+            'message': 'MIN LENGTH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'character_length': {
+            'func': lambda value, length: not len(value) > length,
+            'message': 'CHAR LENGTH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'choice': {
+            'func': lambda value, values_list: value in values_list,
+            'message': 'CHOICE CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'regex_full_match': {
+            'func': lambda value, pattern: matches_regex(value, pattern),
+            'compile': lambda pattern: compile_regex(pattern, 'regex_full_match'),
+            'message': 'FULL MATCH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
 
-        self._validator_map = {
-            **self._validator_map,
-            'digit': {
-                'func': lambda value, exp_value: isinstance(value, str) and value.isdigit(),
-                'message': 'DIGIT CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'alpha': {
-                'func': lambda value, exp_value: isinstance(value, str) and value.isalpha(),
-                'message': 'ALPHA CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'alphanum': {
-                'func': lambda value, exp_value: isinstance(value, str) and value.isalnum(),
-                'message': 'ALPHANUM CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'max_length': {
-                'func': lambda value, max: not len(value) > max,
-                'message': 'MAX LENGTH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'min_length': {
-                'func': lambda value, min: not len(value) < min,
-                'message': 'MIN LENGTH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'character_length': {
-                'func': lambda value, length: not len(value) > length,
-                'message': 'CHAR LENGTH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'choice': {
-                'func': lambda value, values_list: value in set(values_list),
-                'message': 'CHOICE CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'regex_full_match': {
-                'func': lambda value, pattern: matches_regex(value, pattern),
-                'message': 'FULL MATCH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-
-            },
-            'regex_partial_match': {
-                'func': lambda value, pattern: matches_regex(value, pattern, partial=True),
-                'message': 'PARTIAL MATCH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            }
+        },
+        'regex_partial_match': {
+            'func': lambda value, pattern: matches_regex(value, pattern, partial=True),
+            'compile': lambda pattern: compile_regex(pattern, 'regex_partial_match'),
+            'message': 'PARTIAL MATCH CONSTRAINT BROKEN with value {value} on {contraint} contraint'
         }
+    }
 
     def __str__(self):
         return f'{self.data}'
@@ -158,31 +179,29 @@ class TextField(Field):
     
 
 class IntegerField(Field):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self._validator_map = {
-            **self._validator_map,
-            'gt': {
-                'func': lambda value, num: value > num,
-                'message': 'GREATER THAN CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'lt': {
-                'func': lambda value, num: value < num,
-                'message': 'LESS THAN CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'min_value': {
-                'func': lambda value, num: value >= num,
-                'message': 'MIN VALUE CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'max_value': {
-                'func': lambda value, num: value <= num,
-                'message': 'MIN VALUE CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            },
-            'range': {
-                'func': lambda value, values_list: value in values_list,
-                'message': 'RANGE CONSTRAINT BROKEN with value {value} on {contraint} contraint'
-            }
+    _validator_map = {
+        **Field._validator_map,
+        'gt': {
+            'func': lambda value, num: value > num,
+            'message': 'GREATER THAN CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'lt': {
+            'func': lambda value, num: value < num,
+            'message': 'LESS THAN CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'min_value': {
+            'func': lambda value, num: value >= num,
+            'message': 'MIN VALUE CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'max_value': {
+            'func': lambda value, num: value <= num,
+            'message': 'MIN VALUE CONSTRAINT BROKEN with value {value} on {contraint} contraint'
+        },
+        'range': {
+            'func': lambda value, values_list: value in values_list,
+            'message': 'RANGE CONSTRAINT BROKEN with value {value} on {contraint} contraint'
         }
+    }
 
     def __str__(self):
         return f'{self.data}'
@@ -306,10 +325,6 @@ class DateTimeField(Field):
         super().__init__(**kwargs)
         if self.offset_type not in {'hours', 'days', 'weeks', 'months', 'years'}:
             raise Exception(f'Invalid offset_type {self.field_type} for DateTimeField expect value in {"{'hours', 'days', 'weeks', 'months', 'years'}"}')
-        self._validator_map = {
-            **self._validator_map,
-
-        }
 
     def __str__(self):
         return f'{self.data}'
@@ -320,15 +335,18 @@ class DateTimeField(Field):
     
 
 class UUIDField(Field):
+    generator = 'uuid7' # name of an id generator in ID_GENERATORS
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self._validator_map = {
-            **self._validator_map,
-            
-        }
+        get_id_generator(self.generator)
 
     def __str__(self):
         return f'{self.data}'
+
+    def generate(self) -> str:
+        ''' Returns a new id from the generator of the field '''
+        return get_id_generator(self.generator)()
     
     @property
     def field_type(self):
@@ -336,15 +354,13 @@ class UUIDField(Field):
     
 
 class ForeignKeyField(Field):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-
-        from database.db import InitDB
-
-        self._validator_map = {
-            **self._validator_map,
-            'is_model_instance': lambda value, instance=None: isinstance(value, InitDB)
+    _validator_map = {
+        **Field._validator_map,
+        'is_model_instance': {
+            'func': lambda value, instance=None: is_model_instance(value),
+            'message': 'MODEL INSTANCE CONSTRAINT BROKEN with value {value} on {contraint} contraint'
         }
+    }
 
     def __str__(self):
         return f'{self.data}'
@@ -355,13 +371,6 @@ class ForeignKeyField(Field):
     
     
 class JSONField(Field):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self._validator_map = {
-            **self._validator_map,
-            
-        }
-
     def __str__(self):
         return f'{self.data}'
     
@@ -387,27 +396,62 @@ def get_field_from_datatype(datatype):
             field = 'JSONField'
     return field
 
-def get_contraint_keys_by_field_name(field):
-    default_contraint = ['pk', 'null', 'unique', 'default', 'datatype']
-
-    contraint_key_map = {
-        'UUIDField': set(default_contraint),
-        'TextField': set([*default_contraint, 'digit', 'alpha', 'alphanum', 'max_length', 'min_length', 'choice', 'regex_full_match', 'regex_partial_match']),
-        'IntegerField': set([*default_contraint, 'gt', 'lt', 'range']),
-        'DateTimeField': set([*default_contraint, 'on_update', 'on_save', 'offset', 'offset_type', 'offset_by', 'multiply_by']),
-        'ForeignKeyField': set([*default_contraint, 'to', 'on_delete', 'on_update', 'pk_only', 'lazy']),
-        'JSONField': set([*default_contraint, 'indent']),
-    }
+DEFAULT_CONTRAINT = ('pk', 'null', 'unique', 'index', 'default', 'datatype')
+
+# built once and shared, do not mutate
+CONTRAINT_KEY_MAP = {
+    'UUIDField': frozenset([*DEFAULT_CONTRAINT, 'generator']),
+    'TextField': frozenset([*DEFAULT_CONTRAINT, 'digit', 'alpha', 'alphanum', 'max_length', 'min_length', 'choice', 'regex_full_match', 'regex_partial_match']),
+    'IntegerField': frozenset([*DEFAULT_CONTRAINT, 'gt', 'lt', 'range']),
+    'DateTimeField': frozenset([*DEFAULT_CONTRAINT, 'on_update', 'on_save', 'offset', 'offset_type', 'offset_by', 'multiply_by']),
+    'ForeignKeyField': frozenset([*DEFAULT_CONTRAINT, 'to', 'on_delete', 'on_update', 'pk_only', 'lazy']),
+    'JSONField': frozenset([*DEFAULT_CONTRAINT, 'indent']),
+}
 
-    contraint_keys = contraint_key_map.get(field, None)
+def get_contraint_keys_by_field_name(field):
+    contraint_keys = CONTRAINT_KEY_MAP.get(field, None)
     if not contraint_keys:
         raise Exception(f'There is no contraint key for field {field}')
     
     return contraint_keys
 
+ID_GENERATORS = {
+    'uuid7': uuid7,
+    'uuid4': lambda: str(uuid.uuid4()),
+}
+
+def register_id_generator(name, generator):
+    '''
+    Register a callable returning a new string id so it can be used as
+    UUIDField(generator=name)
+    '''
+    if not callable(generator):
+        raise Exception(f'Id generator {name} must be callable')
+    ID_GENERATORS[name] = generator
+
+def get_id_generator(name):
+    generator = ID_GENERATORS.get(name, None)
+    if generator is None:
+        raise Exception(f'Unknown id generator {name} expected one of {set(ID_GENERATORS)}')
+    return generator
+
 def get_required_datatypes():
     return {'str', 'int', 'datetime', 'fk', 'UUID', 'json'}
 
 def value_exist_in_field(value, args):
     return True
 
+def compile_regex(pattern, contraint):
+    '''
+    Compile the pattern of a regex contraint once, when the field is
+    declared, so an invalid pattern fails with the model definition
+    '''
+    try:
+        return re.compile(pattern)
+    except (re.error, TypeError) as err:
+        raise Exception(f'Invalid pattern {pattern!r} for {contraint} contraint: {err}')
+
+def is_model_instance(value):
+    from database.db import InitDB
+    return isinstance(value, InitDB)
+
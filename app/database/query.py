@@ -0,0 +1,936 @@
+import json
+import base64
+import binascii
+import logging
+from datetime import date, datetime, timedelta
+from database.session import get_session
+from exceptions.exception import ValidationError
+from database.connection import ConnectionManager
+
+logger = logging.getLogger(__name__)
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+LOOKUPS = {'exact', 'gt', 'gte', 'lt', 'lte', 'in', 'range', 'startswith', 'date', 'isnull'}
+COMPARISONS = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+# datatypes stored as TEXT (see DB._get_datatype), compared as text in binary order
+TEXT_DATATYPES = {'str', 'UUID', 'datetime', 'dict', 'json'}
+
+
+def split_lookup(key) -> tuple[str, str]:
+    ''' created_at__gte -> ('created_at', 'gte'), created_at -> ('created_at', 'exact') '''
+    field, _, lookup = key.partition('__')
+    return field, lookup if lookup else 'exact'
+
+def get_date_range(value) -> tuple[str, str] | None:
+    '''
+    Returns the half open range [start, end) of a partial date string
+    like '2026', '2026-10' or '2026-10-17'. Dates are stored as
+    'YYYY-MM-DD HH:MM:SS' text so the bounds compare as text and an
+    index on the column can be searched. None if value is not a
+    partial date
+    '''
+    if not isinstance(value, str):
+        return None
+
+    for date_format, step in (('%Y', 'year'), ('%Y-%m', 'month'), ('%Y-%m-%d', 'day'), ('%Y-%m-%d %H', 'hour'), ('%Y-%m-%d %H:%M', 'minute')):
+        try:
+            start = datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+
+        match step:
+            case 'year':
+                end = start.replace(year=start.year + 1)
+            case 'month':
+                end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+            case 'day':
+                end = start + timedelta(days=1)
+            case 'hour':
+                end = start + timedelta(hours=1)
+            case _:
+                end = start + timedelta(minutes=1)
+
+        return start.strftime(date_format), end.strftime(date_format)
+
+    return None
+
+
+class QuerySet:
+    '''
+    A lazy, chainable selection of rows of one model. Chaining only
+    returns a new QuerySet, the rows are read with one statement when the
+    set is iterated, indexed or converted to a list
+        clients = Client.query().filter(display_name='client').exclude(last_name='One').order_by('-created_at')[:10]
+        Client.objects.filter(display_name='client').update(display_name='company')
+        Subscription.objects.filter(status='expired').delete()
+
+    - filter(**kwargs) matches fields by equality or by a lookup suffix
+        compiled to an index friendly predicate
+            created_at='2026-10'              a partial date is a half open range
+            created_at__date='2026-10-17'     the day as a half open range
+            expiration_date__lt=datetime.now()
+            status__in=['booked', 'running']
+            amount__range=(100, 500)
+            last_name__startswith='Ol'        a text range on TEXT fields, LIKE otherwise
+            updated_at__isnull=True
+    - exclude(**kwargs) drops the rows matching all of kwargs, a row
+        holding NULL in a nullable field of kwargs does not match and is
+        kept
+    - only(*fields) reads the given columns and yields dicts of them
+    - values(*fields) yields dicts and values_list(*fields, flat=False)
+        yields tuples (or single values) of the columns, all columns
+        when no field is given. The rows are mapped by the cursor
+        row_factory, no model instance is built
+    - compact() yields read only rows held as tuples of the columns and
+        read by name, the smallest representation of a whole row
+    - iterator(chunk_size) streams the rows with fetchmany
+    - paginate(page_size, cursor) reads one page in cursor order (the
+        creation datetime and the pk) after an opaque cursor, each page
+        costs the same however deep it is
+    - len(), count() and exists() run COUNT(*) / SELECT 1 ... LIMIT 1
+        unless the rows were already read
+    - aggregate(Sum('amount'), Count('*')) returns a dict of the values
+        computed by sqlite over the selected rows
+    - group_by(*fields).annotate(visits=Count('*')) yields a dict of the
+        group fields and the aggregates for each group, annotate before
+        ordering by an aggregate
+    - update() and delete() run one statement for every matching row,
+        update() sets the on_update datetime fields that are not given
+    - select_related('plan_id', 'client_id') reads the rows the foreign
+        keys point to in the same query with a LEFT JOIN
+    - prefetch_related('payments', 'assigned_users') reads each relation
+        declared in the model relations with one IN (...) query for all
+        the rows, so listing rows with their relations costs a constant
+        number of queries
+    '''
+    def __init__(self, model):
+        self.model = model
+        self._where = () # ((negated, ((field, value), ...)), ...)
+        self._order_by = ()
+        self._limit = None
+        self._offset = None
+        self._only = ()
+        self._values = None # None (instances), 'dict', 'tuple', 'flat' or 'compact'
+        self._after = None # values of the cursor fields to read after
+        self._group_by = ()
+        self._annotations = () # ((alias, aggregate), ...)
+        self._select_related = ()
+        self._prefetch_related = ()
+        self._result_cache = None
+
+    def __repr__(self):
+        return f'<QuerySet {self.model.model_name} {self._compile_select()[0]}>'
+
+    def __iter__(self):
+        self._fetch_all()
+        return iter(self._result_cache)
+
+    def __len__(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return self.count()
+
+    def __bool__(self):
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return self.exists()
+
+    def __getitem__(self, key):
+        if self._result_cache is not None:
+            return self._result_cache[key]
+
+        if isinstance(key, slice):
+            if (key.start is not None and key.start < 0) or (key.stop is not None and key.stop < 0):
+                raise Exception('Negative indexing is not supported on QuerySet')
+            if key.step is not None:
+                raise Exception('Slice step is not supported on QuerySet')
+
+            start = key.start or 0
+            limit = max(key.stop - start, 0) if key.stop is not None else None
+            if self._limit is not None:
+                # slice within the rows already limited
+                remaining = max(self._limit - start, 0)
+                limit = remaining if limit is None else min(limit, remaining)
+
+            queryset = self._clone()
+            queryset._limit = limit
+            if start:
+                queryset._offset = (self._offset or 0) + start
+            return queryset
+
+        if not isinstance(key, int):
+            raise TypeError(f'QuerySet indices must be integers or slices not {type(key)}')
+        if key < 0:
+            raise Exception('Negative indexing is not supported on QuerySet')
+
+        result = list(self[key:key + 1])
+        if not result:
+            raise IndexError('QuerySet index out of range')
+        return result[0]
+
+    def _clone(self) -> 'QuerySet':
+        queryset = self.__class__(self.model)
+        queryset._where = self._where
+        queryset._order_by = self._order_by
+        queryset._limit = self._limit
+        queryset._offset = self._offset
+        queryset._only = self._only
+        queryset._values = self._values
+        queryset._after = self._after
+        queryset._group_by = self._group_by
+        queryset._annotations = self._annotations
+        queryset._select_related = self._select_related
+        queryset._prefetch_related = self._prefetch_related
+        return queryset
+
+    @property
+    def _fields(self) -> dict:
+        from database.db import get_table_map
+
+        return get_table_map(model=self.model.model_name)['fields']
+
+    def _check_fields(self, keys) -> None:
+        invalid_fields = set(keys) - set(self._fields)
+        if invalid_fields:
+            raise Exception(f'Invalid field {invalid_fields} provided for {self.model.model_name} model')
+
+    def _to_db_value(self, field, value):
+        ''' Model instances are stored by their primary key '''
+        from database.db import InitDB
+
+        if isinstance(value, InitDB):
+            return getattr(value, field)
+        return value
+
+    def _check_lookups(self, keys) -> None:
+        fields = self._fields
+        for key in keys:
+            field, lookup = split_lookup(key)
+            if field not in fields:
+                raise Exception(f'Invalid field {field} provided for {self.model.model_name} model')
+            if lookup not in LOOKUPS:
+                raise Exception(f'Invalid lookup {lookup} on {field}, expected one of {LOOKUPS}')
+
+    def all(self) -> 'QuerySet':
+        return self._clone()
+
+    def filter(self, **kwargs) -> 'QuerySet':
+        self._check_lookups(kwargs.keys())
+        queryset = self._clone()
+        if kwargs:
+            queryset._where = self._where + ((False, tuple(kwargs.items())),)
+        return queryset
+
+    def exclude(self, **kwargs) -> 'QuerySet':
+        self._check_lookups(kwargs.keys())
+        queryset = self._clone()
+        if kwargs:
+            queryset._where = self._where + ((True, tuple(kwargs.items())),)
+        return queryset
+
+    def order_by(self, *fields) -> 'QuerySet':
+        ''' Order by fields or annotations, prefix with - for descending order '''
+        aliases = {alias for alias, _ in self._annotations}
+        self._check_fields(field.removeprefix('-') for field in fields if field.removeprefix('-') not in aliases)
+        queryset = self._clone()
+        queryset._order_by = tuple(fields)
+        return queryset
+
+    def limit(self, number: int) -> 'QuerySet':
+        if not isinstance(number, int) or number < 0:
+            raise Exception(f'Invalid limit got {number} but expected a positive int')
+        queryset = self._clone()
+        queryset._limit = number
+        return queryset
+
+    def offset(self, number: int) -> 'QuerySet':
+        if not isinstance(number, int) or number < 0:
+            raise Exception(f'Invalid offset got {number} but expected a positive int')
+        queryset = self._clone()
+        queryset._offset = number
+        return queryset
+
+    def only(self, *fields) -> 'QuerySet':
+        self._check_fields(fields)
+        queryset = self._clone()
+        queryset._only = tuple(fields)
+        return queryset
+
+    def values(self, *fields) -> 'QuerySet':
+        ''' Yield dicts of the fields (every column if none is given) '''
+        self._check_fields(fields)
+        queryset = self._clone()
+        queryset._only = tuple(fields) if fields else tuple(self.model._get_statements()['columns'])
+        queryset._values = 'dict'
+        return queryset
+
+    def values_list(self, *fields, flat=False) -> 'QuerySet':
+        '''
+        Yield tuples of the fields (every column if none is given), or
+        the value itself with flat=True and one field
+            Client.query().values_list('phone', flat=True)
+        '''
+        if flat and len(fields) != 1:
+            raise Exception('flat=True needs exactly one field')
+
+        queryset = self.values(*fields)
+        queryset._values = 'flat' if flat else 'tuple'
+        return queryset
+
+    def compact(self) -> 'QuerySet':
+        '''
+        Yield read only rows held as tuples of the columns and read by
+        name, see database.rows. A row costs less memory than an
+        instance, use it for large listings and exports
+            for client in Client.query().compact():
+                client.phone
+        '''
+        queryset = self._clone()
+        queryset._values = 'compact'
+        return queryset
+
+    def select_related(self, *fields) -> 'QuerySet':
+        '''
+        Read the rows of the foreign keys fields with a JOIN, the foreign
+        keys of each instance are then already loaded
+            Subscription.query().select_related('plan_id', 'client_id')
+        '''
+        from database.db import get_table_map
+
+        fk = get_table_map(model=self.model.model_name)['fk']
+        for field in fields:
+            if field not in fk:
+                raise Exception(f'{field} is not a foreign key of {self.model.model_name} model')
+
+        queryset = self._clone()
+        queryset._select_related = self._select_related + tuple(field for field in fields if field not in self._select_related)
+        return queryset
+
+    def prefetch_related(self, *names) -> 'QuerySet':
+        '''
+        Read the relations declared in the model relations for all the
+        rows with one query per relation
+            Subscription.query().prefetch_related('payments', 'assigned_users')
+        '''
+        relations = self.model.relations
+        for name in names:
+            if name not in relations:
+                raise Exception(f'Invalid relation {name} for {self.model.model_name} model, expected one of {set(relations)}')
+
+        queryset = self._clone()
+        queryset._prefetch_related = self._prefetch_related + tuple(name for name in names if name not in self._prefetch_related)
+        return queryset
+
+    @property
+    def _is_related(self) -> bool:
+        return bool(self._select_related or self._prefetch_related)
+
+    @property
+    def _is_grouped(self) -> bool:
+        return bool(self._group_by or self._annotations)
+
+    def _get_aggregates(self, args, kwargs) -> tuple:
+        ''' ((alias, aggregate), ...) of positional and named aggregates '''
+        from database.aggregates import Aggregate
+
+        aggregates = [(aggregate.default_alias if isinstance(aggregate, Aggregate) else None, aggregate) for aggregate in args]
+        aggregates += list(kwargs.items())
+
+        fields = self._fields
+        aliases = {alias for alias, _ in self._annotations}
+        for alias, aggregate in aggregates:
+            if not isinstance(aggregate, Aggregate):
+                raise Exception(f'Invalid aggregate {aggregate}, expected Count, Sum, Avg, Min or Max')
+            aggregate.check(fields)
+
+            # the name is written into the SELECT as the column alias
+            if not isinstance(alias, str) or not alias.isidentifier():
+                raise Exception(f'Invalid aggregate name {alias!r}, expected an identifier')
+            if alias in aliases or alias in fields:
+                raise Exception(f'Aggregate name {alias} is already used on {self.model.model_name}')
+            aliases.add(alias)
+
+        return tuple(aggregates)
+
+    def group_by(self, *fields) -> 'QuerySet':
+        ''' Group the rows by fields, the set yields one dict per group '''
+        if not fields:
+            raise Exception('No fields provided for group_by')
+        self._check_fields(fields)
+        queryset = self._clone()
+        queryset._group_by = tuple(fields)
+        return queryset
+
+    def annotate(self, *args, **kwargs) -> 'QuerySet':
+        '''
+        Add aggregates computed for each group of group_by(), without
+        group_by the set yields one dict for all the rows
+            Visit.query().filter(subscription_id=sub_id).group_by('client_id').annotate(visits=Count('*')).order_by('-visits')
+        '''
+        annotations = self._get_aggregates(args, kwargs)
+        if not annotations:
+            raise Exception('No aggregate provided for annotate')
+
+        queryset = self._clone()
+        queryset._annotations = self._annotations + annotations
+        return queryset
+
+    def aggregate(self, *args, **kwargs) -> dict:
+        '''
+        Returns the aggregates of the selected rows computed in one query
+            Payment.query().filter(subscription_id=sub_id).aggregate(Sum('amount'))['amount__sum']
+        '''
+        if self._is_grouped:
+            raise Exception('aggregate can not be used after group_by or annotate, iterate the groups instead')
+
+        aggregates = self._get_aggregates(args, kwargs)
+        if not aggregates:
+            raise Exception('No aggregate provided for aggregate')
+
+        query, params = self._compile_subquery(columns='*')
+        selection = ', '.join([f'{aggregate.compile()} AS {alias}' for alias, aggregate in aggregates])
+        row = self._read(f'SELECT {selection} FROM ({query});', params)[0]
+
+        return {alias: value for (alias, _), value in zip(aggregates, row)}
+
+    @property
+    def _cursor_fields(self) -> tuple:
+        from database.db import get_table_map
+
+        return tuple(get_table_map(model=self.model.model_name)['cursor'])
+
+    def _encode_cursor(self, row) -> str:
+        if isinstance(row, dict):
+            values = [row[field] for field in self._cursor_fields]
+        else:
+            values = [getattr(row, field) for field in self._cursor_fields]
+        return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+    def _decode_cursor(self, cursor) -> tuple:
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except (AttributeError, UnicodeError, ValueError, binascii.Error):
+            raise Exception(f'Invalid cursor {cursor}')
+
+        if not isinstance(values, list) or len(values) != len(self._cursor_fields):
+            raise Exception(f'Invalid cursor {cursor}')
+        return tuple(values)
+
+    def after(self, cursor) -> 'QuerySet':
+        ''' Rows after the cursor, in cursor order '''
+        queryset = self.order_by(*self._cursor_fields)
+        queryset._after = self._decode_cursor(cursor) if cursor else None
+        return queryset
+
+    def paginate(self, page_size=100, cursor=None) -> tuple[list, str | None]:
+        '''
+        Returns a page of rows and the cursor of the next page, the
+        cursor is None on the last page
+            clients, cursor = Client.query().paginate(50)
+            clients, cursor = Client.query().paginate(50, cursor)
+        '''
+        if not isinstance(page_size, int) or page_size < 1:
+            raise Exception(f'Invalid page_size got {page_size} but expected a positive int')
+        if self._is_grouped:
+            raise Exception('Grouped rows can not be paginated by cursor, use limit and offset')
+        if self._values in ('tuple', 'flat'):
+            raise Exception('values_list rows can not be paginated by cursor, use values()')
+
+        queryset = self.after(cursor)
+        if queryset._only:
+            queryset._only += tuple(field for field in self._cursor_fields if field not in queryset._only)
+
+        # one extra row tells if there is a next page
+        rows = list(queryset.limit(page_size + 1))
+        if len(rows) <= page_size:
+            return rows, None
+
+        rows = rows[:page_size]
+        return rows, self._encode_cursor(rows[-1])
+
+    def first(self):
+        ''' Returns the first row or None '''
+        result = list(self[:1])
+        return result[0] if result else None
+
+    def _to_sql_value(self, field, value):
+        value = self._to_db_value(field, value)
+
+        # dates are stored as text
+        if isinstance(value, datetime):
+            return value.strftime(DATETIME_FORMAT)
+        if isinstance(value, date):
+            return value.strftime('%Y-%m-%d')
+        return value
+
+    def _compile_lookup(self, key, value) -> tuple[str, list]:
+        ''' Returns the predicate and the parameters of one lookup '''
+        field, lookup = split_lookup(key)
+        is_date = self._fields[field].get('datatype', None) == 'datetime'
+
+        match lookup:
+            case 'exact':
+                value = self._to_sql_value(field, value)
+                if value is None:
+                    return f'{field} IS NULL', []
+
+                if is_date:
+                    date_range = get_date_range(value)
+                    if date_range:
+                        return f'{field} >= ? AND {field} < ?', list(date_range)
+
+                    # full timestamps are matched exactly, anything else
+                    # is still matched like InitDB.filter always did
+                    try:
+                        datetime.strptime(value, DATETIME_FORMAT)
+                    except (TypeError, ValueError):
+                        return f'{field} LIKE ?', [f'%{value}%']
+
+                return f'{field} = ?', [value]
+
+            case 'gt' | 'gte' | 'lt' | 'lte':
+                return f'{field} {COMPARISONS[lookup]} ?', [self._to_sql_value(field, value)]
+
+            case 'in':
+                # a string would be matched character by character
+                if isinstance(value, (str, bytes)) or not hasattr(value, '__iter__'):
+                    raise ValidationError(f'Invalid value {value!r} for {key}, expected a list of values')
+                values = [self._to_sql_value(field, item) for item in value]
+                if not values:
+                    return '0', []
+                # the list is padded with its last value to the next power of
+                # two, so one statement is compiled and cached per size bucket
+                size = 1 << (len(values) - 1).bit_length()
+                values += [values[-1]] * (size - len(values))
+                return f'{field} IN ({', '.join(['?' for _ in values])})', values
+
+            case 'range':
+                if isinstance(value, (str, bytes)) or not hasattr(value, '__len__') or len(value) != 2:
+                    raise ValidationError(f'Invalid value {value!r} for {key}, expected a (start, end) pair')
+                start, end = value
+                return f'{field} BETWEEN ? AND ?', [self._to_sql_value(field, start), self._to_sql_value(field, end)]
+
+            case 'startswith':
+                prefix = str(self._to_sql_value(field, value))
+                if not prefix:
+                    return '1', []
+
+                # every text starting with prefix sorts in [prefix, next prefix),
+                # the last character has no next one at U+10FFFF
+                if self._fields[field].get('datatype', None) in TEXT_DATATYPES and prefix[-1] != '\U0010FFFF':
+                    return f'{field} >= ? AND {field} < ?', [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+                escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                return f"{field} LIKE ? ESCAPE '\\'", [f'{escaped}%']
+
+            case 'date':
+                # the day of a datetime, not its timestamp
+                if isinstance(value, datetime):
+                    value = value.date()
+                day = value.isoformat() if isinstance(value, date) else self._to_sql_value(field, value)
+                date_range = get_date_range(day) if isinstance(day, str) and len(day) == 10 else None
+                if date_range is None:
+                    raise ValidationError(f'Invalid date {value} for {key}, expected YYYY-MM-DD')
+                return f'{field} >= ? AND {field} < ?', list(date_range)
+
+            case 'isnull':
+                return f'{field} IS NULL' if value else f'{field} IS NOT NULL', []
+
+    def _compile_where(self) -> tuple[str, tuple]:
+        groups = []
+        params = []
+        for negated, lookups in self._where:
+            conditions = []
+            nullable = []
+            for key, value in lookups:
+                condition, condition_params = self._compile_lookup(key, value)
+                conditions.append(condition)
+                params.extend(condition_params)
+
+                field, lookup = split_lookup(key)
+                if negated and self._fields[field].get('null', False) and lookup != 'isnull' and value is not None:
+                    nullable.append(field)
+
+            condition = ' AND '.join(conditions)
+            if not negated:
+                groups.append(condition)
+            elif nullable:
+                # NOT of a comparison with NULL is NULL, the row would be dropped
+                groups.append(f'(NOT ({condition}) OR {' OR '.join([f'{field} IS NULL' for field in dict.fromkeys(nullable)])})')
+            else:
+                groups.append(f'NOT ({condition})')
+
+        if self._after is not None:
+            cursor_fields = self._cursor_fields
+            groups.append(f'({', '.join(cursor_fields)}) > ({', '.join(['?' for _ in cursor_fields])})')
+            params.extend(self._after)
+
+        where = f' WHERE {' AND '.join(groups)}' if groups else ''
+        return where, tuple(params)
+
+    def _compile_select(self) -> tuple[str, tuple]:
+        '''
+        Returns the SELECT statement and its parameters. The statement of
+        each query shape is compiled once and cached with the model
+        statements
+        '''
+        statements = self.model._get_statements()
+        where, params = self._compile_where()
+
+        # the where clause text holds the lookups, the __in lists are padded
+        # to a power of two so the number of cached statements stays bounded
+        annotations = tuple((alias, aggregate.compile()) for alias, aggregate in self._annotations)
+        cache_key = ('query', where, self._order_by, self._limit is not None, self._offset is not None, self._only, self._group_by, annotations, self._select_related)
+        query = statements.get(cache_key, None)
+
+        if self._is_related and (self._only or self._is_grouped or self._values == 'compact'):
+            raise Exception('select_related and prefetch_related need model instances, they can not be used with only, values, compact or group_by')
+
+        if query is None:
+            if self._is_grouped:
+                columns = [*self._group_by, *[f'{function} AS {alias}' for alias, function in annotations]]
+            else:
+                columns = self._only if self._only else statements['columns']
+            order_by = ', '.join([f'{field[1:]} DESC' if field.startswith('-') else f'{field} ASC' for field in self._order_by])
+
+            query = f'SELECT {', '.join(columns)} FROM {self.model.model_name}{where}'
+            if self._group_by:
+                query += f' GROUP BY {', '.join(self._group_by)}'
+            if order_by:
+                query += f' ORDER BY {order_by}'
+            if self._limit is not None or self._offset is not None:
+                # sqlite needs a LIMIT before an OFFSET, -1 is no limit
+                query += ' LIMIT ?'
+            if self._offset is not None:
+                query += ' OFFSET ?'
+
+            if self._select_related:
+                query = self._compile_joins(query)
+            query += ';'
+
+            statements[cache_key] = query
+
+        if self._limit is not None or self._offset is not None:
+            params += (self._limit if self._limit is not None else -1,)
+        if self._offset is not None:
+            params += (self._offset,)
+
+        return query, params
+
+    def _get_related_models(self) -> list:
+        ''' [(fk field, model class), ...] of select_related '''
+        from database.db import get_table_map, get_model_class
+
+        fk = get_table_map(model=self.model.model_name)['fk']
+        return [(field, get_model_class(fk[field])) for field in self._select_related]
+
+    def _compile_joins(self, query) -> str:
+        '''
+        Wrap the select of the rows in a LEFT JOIN on each select_related
+        table. The columns of the model come first, then the columns of
+        each related table in the select_related order
+        '''
+        columns = [f't.{column}' for column in self.model._get_statements()['columns']]
+        joins = []
+        for index, (field, related_model) in enumerate(self._get_related_models()):
+            related_statements = related_model._get_statements()
+            columns += [f'r{index}.{column}' for column in related_statements['columns']]
+            joins.append(f'LEFT JOIN {related_model.model_name} AS r{index} ON r{index}.{related_statements['pk_field']} = t.{field}')
+
+        query = f'SELECT {', '.join(columns)} FROM ({query}) AS t {' '.join(joins)}'
+
+        # the order of the rows is only kept by ordering the join again
+        order_by = ', '.join([f't.{field[1:]} DESC' if field.startswith('-') else f't.{field} ASC' for field in self._order_by])
+        if order_by:
+            query += f' ORDER BY {order_by}'
+        return query
+
+    def _get_join_row_factory(self):
+        ''' row_factory splitting a joined row into the instance and its loaded foreign keys '''
+        from database.related import lazy_reference
+
+        model = self.model
+        start = len(model._get_statements()['columns'])
+
+        related = []
+        for field, related_model in self._get_related_models():
+            related_statements = related_model._get_statements()
+            end = start + len(related_statements['columns'])
+            pk_index = start + related_statements['columns'].index(related_statements['pk_field'])
+            related.append((field, related_model, start, end, pk_index))
+            start = end
+
+        def row_factory(cursor, row):
+            instance = model.from_db_row(row)
+            for field, related_model, start, end, pk_index in related:
+                # no row joined, the foreign key is null or missing
+                if row[pk_index] is None:
+                    continue
+                target = related_model.from_db_row(row[start:end])
+                object.__setattr__(instance, field, lazy_reference(related_model, row[pk_index], target))
+            return instance
+
+        return row_factory
+
+    def _read(self, query, params, row_factory=None) -> list:
+        model = self.model
+
+        if model.show_sql:
+            model.write(query)
+
+        conn = model._connect_to_db(model)
+        cursor = conn.cursor()
+        cursor.row_factory = row_factory
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        except Exception as err:
+            logger.exception(f'Error fetching {model.model_name}')
+            model.stderr.write(str(err))
+            model.stderr.flush()
+            raise err
+        finally:
+            cursor.close()
+
+    def explain(self, statement='select') -> list[str]:
+        '''
+        Returns the steps of the sqlite query plan of the select, or of
+        the count or exists probe
+        '''
+        compilers = {'select': self._compile_select, 'count': self._compile_count, 'exists': self._compile_exists}
+        if statement not in compilers:
+            raise Exception(f'Invalid statement {statement}, expected one of {set(compilers)}')
+
+        query, params = compilers[statement]()
+        return [row[-1] for row in self._read(f'EXPLAIN QUERY PLAN {query}', params)]
+
+    def _get_row_factory(self):
+        '''
+        Returns the cursor row_factory turning a row into a dict, a
+        value or an instance. None keeps the plain tuple
+        '''
+        if self._values == 'tuple':
+            return None
+
+        if self._values == 'flat':
+            return lambda cursor, row: row[0]
+
+        if self._values == 'compact':
+            from database.rows import get_row_class
+            if self._only or self._is_grouped:
+                raise Exception('compact rows hold every column, they can not be used with only or group_by')
+            row_class = get_row_class(self.model)
+            return lambda cursor, row: row_class(row)
+
+        if self._is_grouped:
+            names = (*self._group_by, *[alias for alias, _ in self._annotations])
+            return lambda cursor, row: dict(zip(names, row))
+
+        if self._only:
+            only = self._only
+            return lambda cursor, row: dict(zip(only, row))
+
+        if self._select_related:
+            return self._get_join_row_factory()
+
+        from_db_row = self.model.from_db_row
+        return lambda cursor, row: from_db_row(row)
+
+    def _fetch_all(self) -> None:
+        if self._result_cache is not None:
+            return
+
+        query, params = self._compile_select()
+        rows = self._read(query, params, self._get_row_factory())
+
+        if self._prefetch_related:
+            from database.related import prefetch_related_objects
+            prefetch_related_objects(rows, *self._prefetch_related)
+
+        self._result_cache = rows
+
+    def iterator(self, chunk_size=500):
+        '''
+        Yield the rows one at a time, reading chunk_size rows per fetch
+        while the cursor stays open. Rows are not cached so memory does
+        not grow with the table
+            for visit in Visit.query().filter(subscription_id=sub_id).iterator():
+                ...
+        '''
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            raise Exception(f'Invalid chunk_size got {chunk_size} but expected a positive int')
+
+        model = self.model
+        query, params = self._compile_select()
+
+        if model.show_sql:
+            model.write(query)
+
+        # the connection is held while the cursor is open
+        conn = model._connect_to_db(model)
+        ConnectionManager.hold(model._db)
+        cursor = conn.cursor()
+        cursor.row_factory = self._get_row_factory()
+        try:
+            cursor.execute(query, params)
+            while rows := cursor.fetchmany(chunk_size):
+                if self._prefetch_related:
+                    # one query per relation for each chunk
+                    from database.related import prefetch_related_objects
+                    prefetch_related_objects(rows, *self._prefetch_related)
+                yield from rows
+        except Exception as err:
+            logger.exception(f'Error fetching {model.model_name}')
+            model.stderr.write(str(err))
+            model.stderr.flush()
+            raise err
+        finally:
+            cursor.close()
+            ConnectionManager.release(model._db)
+
+    def _compile_subquery(self, columns='1') -> tuple[str, tuple]:
+        ''' The selected rows (or groups) without ordering, for COUNT, EXISTS and aggregates '''
+        where, params = self._compile_where()
+        if self._annotations and not self._group_by:
+            # aggregates without groups are always one row
+            columns = 'COUNT(*)'
+        query = f'SELECT {columns} FROM {self.model.model_name}{where}'
+
+        if self._group_by:
+            query += f' GROUP BY {', '.join(self._group_by)}'
+
+        if self._limit is not None or self._offset is not None:
+            query += ' LIMIT ?'
+            params += (self._limit if self._limit is not None else -1,)
+        if self._offset is not None:
+            query += ' OFFSET ?'
+            params += (self._offset,)
+
+        return query, params
+
+    def _compile_count(self) -> tuple[str, tuple]:
+        query, params = self._compile_subquery()
+        return f'SELECT COUNT(*) FROM ({query});', params
+
+    def _compile_exists(self) -> tuple[str, tuple]:
+        '''
+        SELECT 1 ... LIMIT 1 reads no column outside the filters, sqlite
+        stops at the first match and answers from an index holding the
+        filtered columns without touching the table
+        '''
+        query, params = self._compile_subquery()
+        if self._limit is None and self._offset is None and not self._is_grouped:
+            return f'{query} LIMIT 1;', params
+        return f'SELECT 1 FROM ({query}) LIMIT 1;', params
+
+    def count(self) -> int:
+        if self._result_cache is not None:
+            return len(self._result_cache)
+
+        query, params = self._compile_count()
+        return self._read(query, params)[0][0]
+
+    def exists(self) -> bool:
+        if self._result_cache is not None:
+            return len(self._result_cache) > 0
+
+        query, params = self._compile_exists()
+        return len(self._read(query, params)) > 0
+
+    def _compile_target(self) -> tuple[str, tuple]:
+        '''
+        WHERE clause for update and delete. A sliced or ordered set is
+        matched by primary key since sqlite has no LIMIT on writes
+        '''
+        if self._is_grouped:
+            raise Exception('Grouped rows can not be updated or deleted')
+
+        if self._limit is None and self._offset is None:
+            return self._compile_where()
+
+        pk_field = self.model._get_statements()['pk_field']
+        queryset = self._clone()
+        queryset._only = (pk_field,)
+        queryset._select_related = queryset._prefetch_related = ()
+        query, params = queryset._compile_select()
+        return f' WHERE {pk_field} IN ({query.rstrip(';')})', params
+
+    def _execute(self, query, params) -> int:
+        ''' Run a write statement and return the number of rows changed '''
+        model = self.model
+
+        if model.show_sql:
+            model.write(query)
+
+        conn = model._connect_to_db(model)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, params)
+            model._commit(conn)
+
+            # the rows changed are not known, the instances held are stale
+            session = get_session()
+            if session is not None:
+                session.evict(model)
+            return cursor.rowcount
+        except Exception as err:
+            model._rollback(conn)
+            logger.exception(f'Error writing {model.model_name}')
+            model.stderr.write(str(err))
+            model.stderr.flush()
+            raise err
+        finally:
+            cursor.close()
+            self._result_cache = None
+
+    def update(self, **values) -> int:
+        '''
+        Set values on every matching row. Values are validated with the
+        field contraints, returns the number of rows updated
+        '''
+        import time
+        from database.fields import Field
+
+        model = self.model
+        fields = self._fields
+        pk_field = model._get_statements()['pk_field']
+
+        if not values:
+            raise Exception('No values provided for update')
+
+        self._check_fields(values.keys())
+
+        if pk_field in values:
+            raise Exception(f'Primary key {pk_field} can not be updated in bulk')
+
+        data = {}
+        for field, value in values.items():
+            value = self._to_db_value(field, value)
+            field_instance = getattr(model, field, None)
+            if isinstance(field_instance, Field):
+                field_instance._validate_data(value, field)
+            data[field] = value
+
+        for field, contraint in fields.items():
+            if contraint.get('datatype', None) == 'datetime' and contraint.get('on_update', False) and field not in data:
+                data[field] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+
+        where, params = self._compile_target()
+        query = f'UPDATE {model.model_name} SET {', '.join([f'{field} = ?' for field in data])}{where};'
+
+        return self._execute(query, tuple(data.values()) + params)
+
+    def delete(self) -> int:
+        ''' Delete every matching row, returns the number of rows deleted '''
+        where, params = self._compile_target()
+        query = f'DELETE FROM {self.model.model_name}{where};'
+
+        return self._execute(query, params)
+
+
+class QuerySetDescriptor:
+    '''
+    Class attribute returning a new QuerySet of the model it is read from
+    '''
+    def __get__(self, instance, owner) -> QuerySet:
+        return QuerySet(owner)
@@ -0,0 +1,231 @@
+from exceptions.exception import ValidationError
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LazyForeignKey:
+    '''
+    Stand-in for the row a foreign key points to. It holds the raw id
+    and reads the row on first access of any other attribute, the row
+    is then kept on the reference so it is read at most once
+        visit.subscription_id.subscription_id   # the id, no query
+        visit.subscription_id.plan_unit         # reads the subscription
+
+    - the reference class subclasses the model so isinstance checks on
+        the model still pass
+    - references are equal to the instance or reference of the same row
+    - the columns are read only on the reference, the other properties
+        and methods of the model (data, save, update, delete...) run on
+        the loaded row so one instance holds the changes of a row
+            visit.subscription_id.status = 'running'   # raises
+            subscription = visit.subscription_id._resolve()
+            subscription.status = 'running'
+            subscription.update()
+    '''
+    _target = None
+
+    def __getattr__(self, name):
+        # only called for attributes the reference does not hold itself
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        if name in self._model_bits:
+            raise AttributeError(f'{name} can not be set on {self!r}, set it on the row returned by _resolve()')
+        object.__setattr__(self, name, value)
+
+    def __eq__(self, other):
+        from database.db import InitDB
+
+        model = self._model
+        if isinstance(other, InitDB) and other.model_name == model.model_name:
+            pk_field = model._get_statements()['pk_field']
+            return getattr(other, pk_field) == self._pk
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self._model.model_name, self._pk))
+
+    def __str__(self):
+        return str(self._resolve())
+
+    def __repr__(self):
+        state = 'loaded' if self.is_loaded else 'lazy'
+        return f'<{self._model.__name__} {self._pk} ({state})>'
+
+    @property
+    def _pk(self):
+        return self.__dict__[self._model._get_statements()['pk_field']]
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.__dict__.get('_target', None) is not None
+
+    def _resolve(self):
+        target = self.__dict__.get('_target', None)
+        if target is None:
+            model = self._model
+            pk_field = model._get_statements()['pk_field']
+            target = model.fetch_one(**{pk_field: self._pk})
+            if target is None:
+                raise ValidationError(f'{model.__name__} is not valid, {model.model_name} {self._pk} referenced by a foreign key does not exist')
+            object.__setattr__(self, '_target', target)
+        return target
+
+
+_reference_classes = {}
+
+def get_reference_class(model):
+    '''
+    Returns the LazyForeignKey subclass of model, built once. Each
+    column other than the pk is a read only property reading through to
+    the loaded row, the properties and methods of the model are
+    overridden to run on the loaded row as the reference only holds the pk
+    '''
+    reference_class = _reference_classes.get(model, None)
+    if reference_class is not None:
+        return reference_class
+
+    statements = model._get_statements()
+    attributes = {'_model': model}
+
+    for column in statements['columns']:
+        if column == statements['pk_field']:
+            continue
+        attributes[column] = property(lambda self, column=column: getattr(self._resolve(), column))
+
+    own = {name for klass in LazyForeignKey.__mro__ for name in vars(klass)}
+    for name in dir(model):
+        if name.startswith('__') or name in own or name in attributes:
+            continue
+        member = inspect.getattr_static(model, name)
+        if isinstance(member, property):
+            attributes[name] = property(lambda self, name=name: getattr(self._resolve(), name))
+        elif inspect.isfunction(member):
+            attributes[name] = lambda self, *args, name=name, **kwargs: getattr(self._resolve(), name)(*args, **kwargs)
+
+    reference_class = type(f'Lazy{model.__name__}', (LazyForeignKey, model), attributes)
+    _reference_classes[model] = reference_class
+    return reference_class
+
+def lazy_reference(model, pk_value, target=None):
+    '''
+    Returns a reference to the row of model with pk_value, target is
+    the instance of that row when it is already loaded. In a session
+    every foreign key to the row shares one reference
+    '''
+    from configs import db_config
+    from database.session import get_session
+
+    session = get_session()
+    if session is not None:
+        if target is None:
+            target = session.get(model, pk_value)
+
+        reference = session.get_reference(model, pk_value)
+        if reference is not None:
+            if target is not None and not reference.is_loaded:
+                object.__setattr__(reference, '_target', target)
+            return reference
+
+    reference_class = get_reference_class(model)
+    reference = reference_class.__new__(reference_class)
+    object.__setattr__(reference, '_db', db_config.get_db_name())
+    object.__setattr__(reference, model._get_statements()['pk_field'], pk_value)
+    if target is not None:
+        object.__setattr__(reference, '_target', target)
+
+    if session is not None:
+        session.add_reference(model, pk_value, reference)
+    return reference
+
+# rows per IN (...) query, below sqlite's default limit of 32766 parameters
+PREFETCH_CHUNK_SIZE = 10000
+
+def _chunks(values, size=PREFETCH_CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _read_reverse(model, relation, pks) -> dict:
+    '''
+    pk -> instances of the relation model whose fk column holds pk
+        'payments': {'model': 'payment', 'fk': 'subscription_id'}
+    '''
+    from database.db import get_model_class, get_table_map
+
+    related_model = get_model_class(relation['model'])
+    columns = related_model._get_statements()['columns']
+    fk_index = columns.index(relation['fk'])
+    cursor = get_table_map(model=relation['model'])['cursor']
+
+    groups = {}
+    for chunk in _chunks(pks):
+        queryset = related_model.query().filter(**{f'{relation['fk']}__in': chunk}).order_by(*cursor).values_list()
+        for row in queryset:
+            groups.setdefault(row[fk_index], []).append(related_model.from_db_row(row))
+    return groups
+
+def _read_through(model, relation, pks) -> dict:
+    '''
+    pk -> instances of the relation model linked to pk by the rows of the
+    through table, read with one JOIN per chunk
+        'assigned_users': {'model': 'client', 'through': 'assigned_client', 'fk': 'subscription_id', 'to': 'client_id'}
+    '''
+    from database.db import get_model_class, get_table_map
+
+    related_model = get_model_class(relation['model'])
+    statements = related_model._get_statements()
+    cursor = get_table_map(model=relation['through'])['cursor']
+
+    groups = {}
+    for chunk in _chunks(pks):
+        query = f'''
+            SELECT t.{relation['fk']}, {', '.join([f'r.{column}' for column in statements['columns']])}
+            FROM {relation['through']} AS t
+            INNER JOIN {relation['model']} AS r ON r.{statements['pk_field']} = t.{relation['to']}
+            WHERE t.{relation['fk']} IN ({', '.join(['?' for _ in chunk])})
+            ORDER BY {', '.join([f't.{field}' for field in cursor])};
+        '''
+        for row in related_model.query()._read(query, tuple(chunk)):
+            groups.setdefault(row[0], []).append(related_model.from_db_row(row[1:]))
+    return groups
+
+def prefetch_related_objects(instances, *names) -> None:
+    '''
+    Load the relations declared in the model relations for every
+    instance with one query per relation (per PREFETCH_CHUNK_SIZE rows)
+    - a relation behind a property (Subscription.payments) is kept on
+        the instance and returned by the property without a query
+    - any other relation (Subscription.assigned_users) is set as a list
+    '''
+    if not instances:
+        return
+
+    model = instances[0].__class__
+    pk_field = model._get_statements()['pk_field']
+    by_pk = {getattr(instance, pk_field): instance for instance in instances}
+    pks = list(by_pk)
+
+    for name in names:
+        relation = model.relations.get(name, None)
+        if relation is None:
+            raise Exception(f'Invalid relation {name} for {model.model_name} model, expected one of {set(model.relations)}')
+
+        if 'through' in relation:
+            groups = _read_through(model, relation, pks)
+        else:
+            groups = _read_reverse(model, relation, pks)
+            # the related rows point back to instances already loaded
+            for pk, rows in groups.items():
+                for row in rows:
+                    object.__setattr__(row, relation['fk'], lazy_reference(model, pk, by_pk[pk]))
+
+        for instance in instances:
+            rows = groups.get(getattr(instance, pk_field), [])
+            if isinstance(getattr(model, name, None), property):
+                instance.__dict__.setdefault('_prefetched', {})[name] = rows
+            else:
+                setattr(instance, name, rows)
@@ -0,0 +1,53 @@
+from operator import itemgetter
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CompactRow(tuple):
+    '''
+    Read only row of a model table. The values are held in a tuple in
+    the order of the table columns and each column is read by name
+    through the class
+        for client in Client.query().compact():
+            client.first_name   # client[1], no instance is built
+
+    - the row has no __dict__, it costs the tuple of its values
+    - foreign keys hold the raw id, there are no references
+    - instance() builds the model instance of the row to change it
+    '''
+    __slots__ = ()
+    _model = None
+    _columns = ()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.data}>'
+
+    @property
+    def data(self) -> dict:
+        return dict(zip(self._columns, self))
+
+    def instance(self):
+        ''' Returns the model instance of the row (see InitDB.from_db_row) '''
+        return self._model.from_db_row(self)
+
+
+_row_classes = {}
+
+def get_row_class(model):
+    '''
+    Returns the CompactRow subclass of model, built once. Each column is
+    an itemgetter property on its position in the table columns
+    '''
+    row_class = _row_classes.get(model, None)
+    if row_class is not None:
+        return row_class
+
+    columns = model._get_statements()['columns']
+    attributes = {'__slots__': (), '_model': model, '_columns': columns}
+    for index, column in enumerate(columns):
+        attributes[column] = property(itemgetter(index))
+
+    row_class = type(f'{model.__name__}Row', (CompactRow,), attributes)
+    _row_classes[model] = row_class
+    return row_class
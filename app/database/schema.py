@@ -0,0 +1,179 @@
+import os
+import json
+import hashlib
+import importlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaRegistry:
+    '''
+    Process-wide registry of the compiled model schema.
+    - The models package is scanned and imported only once per process,
+        the result is reused by every model instance and class method.
+    - Each table entry keeps the TABLE_MAP shape (table_name -> fields ->
+        column_name -> field_contraint) and adds the compiled details:
+
+        {
+            'fields': {...},
+            'pk': 'client_id',
+            'fk': {'plan_id': 'plan'},
+            'datatypes': {'client_id': 'UUID', 'first_name': 'str', ...},
+            'cursor': ['created_at', 'client_id'],
+            'indexes': {
+                'client_cursor_idx': ['created_at', 'client_id'],
+                'client_phone_idx': ['phone']
+            }
+        }
+
+    - cursor is the unique ordering used for keyset pagination, the
+        creation datetime of the row followed by the pk
+    - indexes maps each index name to its columns: the cursor, fields
+        declared with index=True, every foreign key column and the
+        composite indexes listed on the model (indexes = [('a', 'b')])
+
+    - the canonical CRUD statements compiled for each table are kept
+        alongside the schema and dropped with it
+    - call invalidate() whenever a model file is added or changed
+    '''
+    _tables = None
+    _version = None
+    _statements = {}
+
+    @classmethod
+    def get_tables(cls) -> dict:
+        if cls._tables is None:
+            cls._tables = cls._build()
+        return cls._tables
+
+    @classmethod
+    def get_table(cls, model) -> dict | None:
+        return cls.get_tables().get(model, None)
+
+    @classmethod
+    def get_version(cls) -> int:
+        '''
+        Returns a stable hash of the compiled schema. It fits in sqlite's
+        PRAGMA user_version so the database file can be stamped with the
+        schema it was created from
+        '''
+        if cls._version is None:
+            schema = json.dumps(cls.get_tables(), sort_keys=True, default=str)
+            cls._version = int(hashlib.sha1(schema.encode('utf-8')).hexdigest()[:7], 16)
+        return cls._version
+
+    @classmethod
+    def get_statements(cls, model) -> dict | None:
+        return cls._statements.get(model, None)
+
+    @classmethod
+    def set_statements(cls, model, statements: dict) -> None:
+        cls._statements[model] = statements
+
+    @classmethod
+    def invalidate(cls) -> None:
+        ''' Drop the compiled schema so the next lookup rescans the models '''
+        cls._tables = None
+        cls._version = None
+        cls._statements = {}
+
+        # make newly written model files importable
+        importlib.invalidate_caches()
+
+    @classmethod
+    def _build(cls) -> dict:
+        from database.db import get_model_class, get_contraint_from_field_instance
+
+        logger.info('Compiling model schema...')
+
+        os.makedirs('database', exist_ok=True)
+
+        file_path = os.path.join('models')
+        model_files = sorted(os.listdir(file_path))
+
+        tables = {}
+        for model_file in model_files:
+            if '.py' not in model_file or '__init__' in model_file:
+                continue
+
+            model_file = model_file.replace('.py', '')
+            model_class = get_model_class(model_file)
+            if model_class is None:
+                raise Exception(f'No model named {model_file} is defined in models/{model_file}.py')
+
+            # the fields were collected when the model class was defined
+            fields = {}
+            datatypes = {}
+            for key, value in model_class._model_fields.items():
+                contraint = get_contraint_from_field_instance(value)
+                contraint['datatype'] = value.field_type
+                fields[key] = contraint
+                datatypes[key] = value.field_type
+
+            pk = model_class._model_pk
+            fk = dict(model_class._model_fk)
+
+            cursor = cls._get_cursor(fields, pk)
+            tables[model_file] = {
+                'fields': fields,
+                'pk': pk,
+                'fk': fk,
+                'datatypes': datatypes,
+                'cursor': cursor,
+                'indexes': cls._get_indexes(model_file, model_class, fields, pk, cursor)
+            }
+
+        return tables
+
+    @classmethod
+    def _get_cursor(cls, fields, pk) -> list:
+        '''
+        created_at or the first datetime set on save (without an offset
+        like expiration dates) followed by the pk
+        '''
+        created_field = 'created_at' if 'created_at' in fields else None
+
+        if created_field is None:
+            for key, contraint in fields.items():
+                if contraint.get('datatype', None) == 'datetime' and contraint.get('on_save', False) and not contraint.get('offset', False):
+                    created_field = key
+                    break
+
+        if created_field is None or pk is None:
+            return [pk] if pk else []
+        return [created_field, pk]
+
+    @classmethod
+    def _get_indexes(cls, table_name, model_class, fields, pk, cursor) -> dict:
+        '''
+        Index name -> columns. A single column index is skipped when the
+        column is the pk, is unique or leads another index, sqlite already
+        has an index that serves it
+        '''
+        composite = [list(columns) for columns in getattr(model_class, 'indexes', [])]
+        if len(cursor) > 1:
+            composite.insert(0, cursor)
+
+        for columns in composite:
+            unknown = set(columns) - set(fields)
+            if unknown:
+                raise Exception(f'Unknown index fields {unknown} on {table_name}')
+
+        single = [
+            key for key, contraint in fields.items()
+            if contraint.get('index', False) or contraint.get('datatype', None) == 'fk'
+        ]
+
+        indexes = {}
+        for columns in composite:
+            name = 'cursor' if columns == cursor else '_'.join(columns)
+            indexes[f'{table_name}_{name}_idx'] = columns
+
+        leading = {columns[0] for columns in composite}
+        for key in single:
+            if key == pk or fields[key].get('unique', False) or key in leading:
+                continue
+            indexes[f'{table_name}_{key}_idx'] = [key]
+
+        return indexes
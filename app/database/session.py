@@ -0,0 +1,122 @@
+import threading
+from functools import wraps
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    '''
+    Identity map of the rows read while the session is open, a row is
+    held by one instance per (model, pk)
+        with Session():
+            visits = Visit.query().filter(subscription_id=sub_id)
+            # every visit resolves its subscription to the same instance,
+            # the subscription is read once
+            [visit.subscription_id.plan_unit for visit in visits]
+
+    - rows read again return the instance already in the map, the row
+        values already held are kept
+    - fetch_one on the pk of a row in the map runs no query
+    - save and update put the instance in the map, delete removes it,
+        set based update and delete drop every row of the model
+    - the session is bound to the current thread, a nested session has
+        its own map and the outer one is restored on exit
+    - the session holds the pooled connection of the thread, it goes
+        back to the pool on exit unless an outer session or atomic block
+        still holds it
+    - can be used as a decorator
+    '''
+    _local = threading.local()
+
+    def __init__(self):
+        self._instances = {} # (model_name, pk) -> instance
+        self._references = {} # (model_name, pk) -> lazy reference
+        self._previous = []
+
+    def __enter__(self):
+        from configs import db_config
+        from database.connection import ConnectionManager
+
+        # the connection of the thread is kept for the whole session
+        db = db_config.get_db_name()
+        ConnectionManager.hold(db)
+
+        self._previous.append((get_session(), db))
+        Session._local.session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        from database.connection import ConnectionManager
+
+        Session._local.session, db = self._previous.pop()
+        self.clear()
+        ConnectionManager.release(db)
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Session():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def __len__(self):
+        return len(self._instances)
+
+    def __contains__(self, instance):
+        return self._get_key(instance) in self._instances
+
+    @staticmethod
+    def _get_key(instance) -> tuple:
+        pk_field = instance._get_statements()['pk_field']
+        return (instance.model_name, instance.__dict__.get(pk_field, None))
+
+    def get(self, model, pk):
+        ''' Returns the instance of the row of model with pk, None if not in the map '''
+        return self._instances.get((model.model_name, pk), None)
+
+    def add(self, instance):
+        '''
+        Put instance in the map, it replaces the instance held for the
+        same row
+        '''
+        key = self._get_key(instance)
+        if key[1] is None:
+            return instance
+
+        self._instances[key] = instance
+
+        reference = self._references.get(key, None)
+        if reference is not None:
+            object.__setattr__(reference, '_target', instance)
+        return instance
+
+    def discard(self, instance) -> None:
+        ''' Remove the row of instance from the map '''
+        key = self._get_key(instance)
+        self._instances.pop(key, None)
+        self._references.pop(key, None)
+
+    def evict(self, model) -> None:
+        ''' Remove every row of model from the map '''
+        model_name = model.model_name
+        for rows in (self._instances, self._references):
+            for key in [key for key in rows if key[0] == model_name]:
+                del rows[key]
+
+    def get_reference(self, model, pk):
+        return self._references.get((model.model_name, pk), None)
+
+    def add_reference(self, model, pk, reference):
+        self._references[(model.model_name, pk)] = reference
+        return reference
+
+    def clear(self) -> None:
+        self._instances.clear()
+        self._references.clear()
+
+
+def get_session() -> Session | None:
+    ''' Returns the session open on the current thread, None outside a session '''
+    return getattr(Session._local, 'session', None)
@@ -9,32 +9,17 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def generate_id(model: str, cursor) -> str:
+def generate_id(model: str, cursor=None) -> str:
+    '''
+    Returns a time ordered id for a new row of model. The table is not
+    queried for a clash, the PRIMARY KEY constraint rejects it
+    '''
+    from utils.general import uuid7
+
     if not model:
         return None
-    if not hasattr(cursor, 'execute'):
-        return None
     
-    id_exist = True
-    id_string = ""
-    while id_exist:
-        try:
-            id_string = str(uuid.uuid4())
-            query = f'''
-                SELECT * FROM {model.lower()} WHERE {model.lower()}_id = ?;
-            '''
-
-            cursor.execute(query, (id_string,))
-            entry = cursor.fetchone()
-
-            if not entry:
-                id_exist = False
-        except Exception as err:
-            logging.error(str(err))
-            sys.stderr.write(f'\n{err}\n')
-            sys.stderr.flush()
-            return None
-    return id_string
+    return uuid7()
 
 def insert_to_db(model: str, cursor, values, many=False) -> None:
     if not model:
@@ -199,7 +184,16 @@ def fetch_all_entry(model: str, cursor, col_names=False):
         return None
 
 def delete_db(db_path, db: str):
+    from database.db import DB
+
     if os.path.isfile(db_path / db):
         print(f'Deleting {db}')
+        # close pooled connections so the WAL is checkpointed first
+        DB.reset_bootstrap(db_path / db)
         os.remove(db_path / db)
 
+    # remove WAL leftovers of a connection that was not closed cleanly
+    for suffix in ('-wal', '-shm'):
+        if os.path.isfile(db_path / f'{db}{suffix}'):
+            os.remove(db_path / f'{db}{suffix}')
+
@@ -23,6 +23,7 @@ class AssignedClient(InitDB):
 
     '''
     model_name = 'assigned_client'
+    indexes = [('subscription_id', 'client_id')]
 
     assigned_client_id = fields.UUIDField(pk=True, unique=True, null=False)
     subscription_id = fields.ForeignKeyField(to = 'subscription', on_delete = 'cascade', on_update='no action')
@@ -86,9 +87,7 @@ class AssignedClient(InitDB):
 
         cls.custom(query=query, values=(sub_id, client_id))
 
-        user = cls.get_user(sub_id=sub_id, client_id=client_id)
-
-        if user is not None:
+        if cls.exists(subscription_id=sub_id, client_id=client_id):
             cls.write_error('User not delete from subscription')
             logger.exception('User not delete from subscription')
 
@@ -26,12 +26,22 @@ class Client(InitDB):
     first_name = fields.TextField(min_length=3)
     last_name = fields.TextField(min_length=3)
     company_name = fields.TextField()
-    email = fields.TextField()
-    phone = fields.TextField(null = False)
+    email = fields.TextField(index = True)
+    phone = fields.TextField(null = False, index = True)
     display_name = fields.TextField(choice=['client', 'company'])
     created_at = fields.DateTimeField(on_save = True)
     updated_at = fields.DateTimeField(on_update = True)
 
+    checks = (
+        ('first_name', lambda value, client: value or client.company_name, 'First Name and Company Name cannot both be empty'),
+        ('first_name', lambda value, client: not value or len(value) >= 3, 'First Name cannot be less than 3 characters'),
+        ('company_name', lambda value, client: not value or len(value) >= 3, 'Company Name cannot be less than 3 characters'),
+    )
+    pk_checks = (
+        ('client_id', lambda value, client: value, 'Client ID cannot be empty'),
+        ('client_id', lambda value, client: client._verify_pk(), 'Client ID is not valid'),
+    )
+
     def __init__(self, using=None, **kwargs):
         super().__init__(**kwargs)
 
@@ -52,36 +62,6 @@ class Client(InitDB):
         else:
             return self.company_name
 
-    def _validate(self, check_id=False) -> None:
-        super()._validate(check_id)
-        # validating first_name and company name
-        if not self.first_name and not self.company_name:
-            raise ValidationError('First Name and Company Name cannot both be empty')
-
-        if self.first_name and len(self.first_name) < 3:
-            raise ValidationError('First Name cannot be less than 3 characters')
-
-        if self.company_name and len(self.company_name) < 3:
-            raise ValidationError('Company Name cannot be less than 3 characters')
-
-        # # validating phone
-        # if not self.phone:
-        #     raise ValidationError('Phone cannot be empty')
-        
-        # if not self.phone.isdigit():
-        #     raise ValidationError('Phone cannot contain alphabet')
-        
-        # if self._display_name not in {'client', 'company'}:
-        #     raise ValidationError('Display name needs either [client, company]')
-        
-        # validating check_id
-        if check_id:
-            if not self.client_id:
-                raise ValidationError('Client ID cannot be empty')
-
-            if not self._verify_pk():
-                raise ValidationError('Client ID is not valid')
-
     # def save(self, update=False) -> None:
     #     super().save()
                        
@@ -37,6 +37,21 @@ class Payment(InitDB):
     created_at = fields.DateTimeField(on_save = True)
     updated_at = fields.DateTimeField(on_update = True)
 
+    checks = (
+        ('client_id', lambda value, payment: value, 'Client not set payment'),
+        ('client_id', lambda value, payment: isinstance(value, Client), 'Client is not valid on payment'),
+        ('subscription_id', lambda value, payment: value, 'Subscription not set on payment'),
+        ('subscription_id', lambda value, payment: isinstance(value, Subscription), 'Subscription is not valid on payment'),
+        ('amount', lambda value, payment: value, 'Payment amount is required'),
+        ('amount', lambda value, payment: isinstance(value, (int, float)), 'Payment amount cannot be letters'),
+        ('amount', lambda value, payment: value >= 0, 'Payment amount cannot be less than zero'),
+        ('amount', lambda value, payment: value <= payment._get_balance_from_db(), 'Payment amount cannot be greater than subscription amount'),
+    )
+    pk_checks = (
+        ('payment_id', lambda value, payment: value, 'Payment not set'),
+        ('payment_id', lambda value, payment: payment._verify_pk(), 'Payment ID is not valid'),
+    )
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -85,32 +100,6 @@ class Payment(InitDB):
     #     if updated_at:
     #         self.updated_at = updated_at
 
-    def _validate(self, check_id=False) -> None:
-        super()._validate(check_id)
-
-        if check_id:
-            if not self.payment_id:
-                raise ValidationError('Payment not set')
-            if not self._verify_pk():
-                raise ValidationError('Payment ID is not valid')
-
-        if not self.client_id:
-            raise ValidationError('Client not set payment')
-        if not isinstance(self.client_id, Client):
-            raise ValidationError('Client is not valid on payment')
-        if not self.subscription_id:
-            raise ValidationError('Subscription not set on payment')
-        if not isinstance(self.subscription_id, Subscription):
-            raise ValidationError('Subscription is not valid on payment')
-        if not self.amount:
-            raise ValidationError('Payment amount is required')
-        if not isinstance(self.amount, (int, float)):
-            raise ValidationError('Payment amount cannot be letters')
-        if self.amount < 0:
-            raise ValidationError('Payment amount cannot be less than zero')
-        if self.amount > self._get_balance_from_db():
-            raise ValidationError('Payment amount cannot be greater than subscription amount')
-   
     def update(self) -> None:
         self._validate(check_id=True)
         super().update()
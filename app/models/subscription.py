@@ -4,6 +4,8 @@ from typing import Self
 from datetime import datetime, timedelta
 from database.db import InitDB
 from database import fields
+from database.aggregates import Sum
+from database.related import prefetch_related_objects
 from exceptions.exception import ValidationError, GenerationError
 from logs.utils import log_error_to_file, log_to_file
 from utils.import_file import ImportManager
@@ -37,6 +39,11 @@ class Subscription(InitDB):
         }
     '''
     model_name = 'subscription'
+    indexes = [('status', 'expiration_date')]
+    relations = {
+        'payments': {'model': 'payment', 'fk': 'subscription_id'},
+        'assigned_users': {'model': 'client', 'through': 'assigned_client', 'fk': 'subscription_id', 'to': 'client_id'},
+    }
     subscription_id = fields.UUIDField(pk=True, unique=True, null=False)
     plan_id = fields.ForeignKeyField(to = 'plan', on_delete = 'cascade', on_update='no action')
     client_id = fields.ForeignKeyField(to = 'client', on_delete = 'cascade', on_update='no action')
@@ -50,6 +57,18 @@ class Subscription(InitDB):
     created_at = fields.DateTimeField(on_save = True)
     updated_at = fields.DateTimeField(on_update = True)
 
+    checks = (
+        ('plan_id', lambda value, subscription: isinstance(value, Plan), 'Plan is not valid on subscription'),
+        ('client_id', lambda value, subscription: value, 'Client not set on subscription'),
+        ('client_id', lambda value, subscription: isinstance(value, Client), 'Client is not valid on subscription'),
+    )
+    pk_checks = (
+        ('subscription_id', lambda value, subscription: value, 'Subscription ID is required'),
+        ('expiration_date', lambda value, subscription: value, 'Expiration Date is required'),
+        ('assigned_users', lambda value, subscription: isinstance(value, list), 'Assigned users need to be a list of valid client'),
+        ('subscription_id', lambda value, subscription: subscription._verify_pk(), 'Subscription ID is not valid'),
+    )
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.assigned_users = []
@@ -80,6 +99,9 @@ class Subscription(InitDB):
 
         self._get_assigned_users
 
+    def _on_load(self):
+        self.assigned_users = []
+
     @property
     def usage(self):
         # {'hourly', 'daily', 'weekly', 'monthly', 'half-year', 'yearly'}
@@ -123,13 +145,13 @@ class Subscription(InitDB):
     def payments(self):
         from .payment import Payment
         
-        payments = Payment.filter_payments(self.subscription_id, by_subscription=True)
+        payments = Payment.query().filter(subscription_id=self.subscription_id)
 
-        return payments
+        return self._get_prefetched('payments', payments)
     
     @property
     def total_paid(self):
-        amount = sum(payment.amount for payment in self.payments)
+        amount = self.payments.aggregate(Sum('amount'))['amount__sum']
         
         return  amount if amount else 0
 
@@ -140,70 +162,9 @@ class Subscription(InitDB):
     def __str__(self):
         return f'Subscription for {self.plan.plan_name} by {self.client.get_display_name()}'
  
-    def _validate(self, check_id=False) -> None:
-        super()._validate(check_id)
-
-        STATUS_TYPE = ['booked', 'running', 'expired', 'exhausted']
-        PAYMENT_STATUS_TYPE = ['pending', 'partial', 'paid', 'free']
-
-        # if not self.plan_id:
-        #     raise ValidationError('Plan is not set on subscription')
-        if not isinstance(self.plan_id, Plan):
-            raise ValidationError('Plan is not valid on subscription')
-        if not self.client_id:
-            raise ValidationError('Client not set on subscription')
-        if not isinstance(self.client_id, Client):
-            raise ValidationError('Client is not valid on subscription')
-        # if not isinstance(self.plan_unit, (int, float)):
-        #     raise ValidationError('Plan unit need to be a number')
-        # if not self.plan_unit > 0:
-        #     raise ValidationError('Plan unit can not be less than 1')
-        # if not self.discount:
-        #     raise ValidationError('Payment discount not set on subscription')
-        # if self.discount < 0:
-        #     raise ValidationError('Payment discount cannot be less than zero')
-        # if not isinstance(self.discount, (int, float)):
-        #     raise ValidationError('Payment discount cannot be letters')
-        # if self.discount_type not in {'percent', 'fixed'}:
-        #     raise ValidationError('Payment discount type choices are [percent, fixed]')
-        # if not self.vat:
-        #     raise ValidationError('Payment vat is required')
-        # if self.vat < 0:
-        #     raise ValidationError('Payment vat cannot be less than zero')
-        # if not isinstance(self.vat, (int, float)):
-        #     raise ValidationError('Payment vat cannot be letters')
-        # if not self.status or self.status not in STATUS_TYPE:
-        #     raise ValidationError(f'Status is required and must include {STATUS_TYPE}')
-        # if not self.payment_status or self.payment_status not in PAYMENT_STATUS_TYPE:
-        #     raise ValidationError(f'Payment status is required. choice {PAYMENT_STATUS_TYPE}')
-        # if len(self.assigned_users) > 0 and not all(isinstance(u, Client) for u in self.assigned_users):
-        #         raise ValidationError('Assigned users need to be a list of valid client')
-            
-        
-        if check_id:
-            if not self.subscription_id:
-                raise ValidationError('Subscription ID is required')
-            if not self.expiration_date:
-                raise ValidationError('Expiration Date is required')
-            
-            if not isinstance(self.assigned_users, list):
-                raise ValidationError('Assigned users need to be a list of valid client')
-            
-            if not self._verify_pk():
-                raise ValidationError('Subscription ID is not valid')
-
     def _get_assigned_users(self):
-        assigned_clients_id = AssignedClient.filter_sub(sub_id=self.subscription_id)
-
-        assigned_users = []
-
-        if len(assigned_clients_id) > 0:
-            for assigned_client_id_tuple in assigned_clients_id:                
-                client = Client.fetch_one(client_id=assigned_client_id_tuple[0])
-                if client:
-                    assigned_users.append(client)
-    
-        self.assigned_users = assigned_users
+        # one query for every assigned user
+        prefetch_related_objects([self], 'assigned_users')
 
     def _set_expiration(self) -> None:
         match(self.plan_id.plan_type):
@@ -231,6 +192,7 @@ class Subscription(InitDB):
         self._validate(check_id=True)
         super().update()
 
+    @InitDB.atomic()
     def set_assigned_client(self, client_id) -> None:
         client = Client.fetch_one(client_id=client_id)
         
@@ -295,11 +257,21 @@ class Subscription(InitDB):
             raise Exception('Usage has been exhausted for this subscription')
         
         # TODO: validate if plan is hourly
-        visit = Visit(**{'subscription_id': self.subscription_id, 'client_id': client.client_id})
-        visit.save()
-        
-        self.status = 'running'
-        self.update()
+        # the visit and the status change are committed together
+        with self.atomic():
+            visit = Visit(**{'subscription_id': self.subscription_id, 'client_id': client.client_id})
+            visit.save()
+            
+            self.status = 'running'
+            self.update()
+
+    @classmethod
+    def expire_subscriptions(cls) -> int:
+        '''
+        Mark every booked or running subscription past its expiration date
+        as expired in one statement, returns the number expired
+        '''
+        return cls.objects.filter(status__in=['booked', 'running'], expiration_date__lt=datetime.now()).update(status='expired')
 
     def remove_user_visit(self, client_id, date_value: str) -> None:
         # date_value is expecting date in YYYY-MM-DD format
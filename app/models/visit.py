@@ -99,7 +99,7 @@ class Visit(InitDB):
     #         raise ValidationError('Subscription is not valid on visit')
   
     @classmethod
-    def get_client_visits_per_sub(cls, sub_id: str, get_count: bool=False, col_names=False, result_only=False) -> list:
+    def get_client_visits_per_sub(cls, sub_id: str, get_count: bool=False, col_names=False, result_only=False, iterator=False) -> list:
         query = '''
                 SELECT 
                     c.first_name,
@@ -127,9 +127,9 @@ class Visit(InitDB):
                 GROUP BY c.client_id, c.first_name, c.last_name, c.company_name;
             '''
         
-        result = cls.custom(query=query, values=(sub_id,), col_names=col_names, many=True, result_only=result_only)
+        result = cls.custom(query=query, values=(sub_id,), col_names=col_names, many=True, result_only=result_only, iterator=iterator)
 
-        if col_names:
+        if col_names or iterator:
             return result
         return result[0]
 
@@ -193,36 +193,23 @@ class Visit(InitDB):
         return result[0]
        
     @classmethod
-    def get_all_sub_visits_count(cls, sub_id) -> list:
-        query = '''
-            SELECT
-                v.client_id
-            FROM visit AS v
-            WHERE v.subscription_id = ?;
-        '''
-
-        result = cls.custom(query=query, values=(sub_id,), many=True, result_only=True)
-        return len(result)
+    def get_all_sub_visits_count(cls, sub_id) -> int:
+        return cls.query().filter(subscription_id=sub_id).count()
 
     @classmethod
     def export_model(cls, path, sub_id: str):
 
-        visits_by_date, column_names_by_date = Visit.get_client_visits_per_sub(sub_id, col_names=True)
+        visits_by_date, column_names_by_date = Visit.get_client_visits_per_sub(sub_id, col_names=True, iterator=True)
         visits_by_count, column_names_by_count = Visit.get_client_visits_per_sub(sub_id, get_count=True, col_names=True)
 
         column_names_by_date = column_names_by_date if column_names_by_date else None
         column_names_by_count = column_names_by_count if column_names_by_count else None
 
         # remove unnecessary data like subcription_id
-        formated_visits_by_date = []
+        # remove client id
+        formated_visits_by_date = ([*visit[:3], *visit[4:]] for visit in visits_by_date)
         formated_visits_by_count = []
 
-        for visit in visits_by_date:
-            visit = list(visit)
-            # remove client id
-            visit.pop(3)
-            formated_visits_by_date.append(visit)
-
         for visit in visits_by_count:
             visit = list(visit)
             formated_visits_by_count.append(visit)
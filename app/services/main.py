@@ -1,3 +1,4 @@
+from database.session import Session
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,11 +17,10 @@ class ServiceManager:
         self.__get_model_object()
 
     def __get_model_object(self):
-        import importlib
+        from database.db import get_model_class
 
         try:
-            module = importlib.import_module(f'models.{self.model}')
-            model_class = getattr(module, self.model.title())
+            model_class = get_model_class(self.model)
             if model_class:
                 self.model_class = model_class
 
@@ -58,7 +58,12 @@ class ServiceManager:
             data_list.append(instance.data)
         return data_list
 
+    @Session()
     def process_command(self):
+        '''
+        Run the command in a session, a row read more than once while
+        the command runs is one instance read once
+        '''
         match self.command.lower():
             case 'create':
                 return self.process_create()
@@ -66,6 +71,10 @@ class ServiceManager:
                 return self.process_create(update=True)
             case 'delete':
                 return self.process_delete()
+            case 'fetch_all' | 'filter':
+                return self.process_fetch()
+            case 'fetch_one':
+                return self.process_fetch_one()
             case _:    
                 return self.process_model_object_function()
     
@@ -121,6 +130,38 @@ class ServiceManager:
             print(err)
             return self.failure(message=str(err), error=err)
         
+    def process_fetch(self):
+        '''
+        Read one keyset page. The response carries the next_cursor to 
+        send back for the following page, it is None on the last page.
+        Rows are read as dicts, no model instance is built
+        '''
+        payload = dict(self.validated_args['payload'] or {})
+        payload.setdefault('cursor', None)
+        object_func = getattr(self.model_class, self.command.lower())
+
+        try:
+            data, next_cursor = object_func(**payload, values=True)
+
+            response = self.success(message=f'{self.command} completed on {self.model_class.model_name} successfully', data=data)
+            response['next_cursor'] = next_cursor
+            return response
+        except Exception as err:
+            print(err)
+            return self.failure(message=str(err), error=err)
+        
+    def process_fetch_one(self):
+        ''' Read one row as a dict, no model instance is built '''
+        payload = self.validated_args['payload']
+
+        try:
+            data = self.model_class.fetch_one(**payload, values=True)
+
+            return self.success(message=f'{self.command} completed on {self.model_class.model_name} successfully', data=data)
+        except Exception as err:
+            print(err)
+            return self.failure(message=str(err), error=err)
+        
     def process_model_object_function(self):
         payload = self.validated_args['payload']
         object_func = getattr(self.model_class, self.command.lower())
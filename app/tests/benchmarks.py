@@ -0,0 +1,364 @@
+from configs import app_config
+from helpers.db_helpers import delete_db
+from database.schema import SchemaRegistry
+from database.connection import ConnectionManager
+from models.client import Client
+from models.plan import Plan
+from models.subscription import Subscription
+from models.visit import Visit
+from .test_models import BaseTestClass, DB_NAME
+from .test_data import clients as clients_data, plans as plans_data
+
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault('CURRENT_WORKING_DB_ENVIRON', 'test')
+
+
+def timed(func, number=1):
+    '''
+    Run func number times and return the average seconds per run
+    '''
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+def measure(func) -> int:
+    '''
+    Run func once and return the bytes still held by its result
+    '''
+    tracemalloc.start()
+    try:
+        result = func()
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+class BenchInstanceConstruction(BaseTestClass):
+    '''
+    Client construction cost with a cold schema (rescanning the models
+    package like get_table_map used to) and with the compiled registry
+    '''
+    number = 50
+
+    @classmethod
+    def start_benchmark(cls):
+        cls.write('Benchmark: Client instance construction')
+
+        data = clients_data[0]
+
+        def cold():
+            SchemaRegistry.invalidate()
+            Client(**data)
+
+        def warm():
+            Client(**data)
+
+        Client(**data) # create tables before timing
+
+        cold_time = timed(cold, cls.number)
+        warm_time = timed(warm, cls.number)
+
+        cls.write(f'cold schema:   {cold_time * 1000:.3f} ms/instance')
+        cls.write(f'schema cached: {warm_time * 1000:.3f} ms/instance')
+
+
+class BenchBulkCreate(BaseTestClass):
+    '''
+    Client inserts one save() at a time against bulk_create. Set
+    BENCH_ROWS to run at a larger size (e.g. 100000)
+    '''
+    rows = int(os.getenv('BENCH_ROWS', 2000))
+
+    @classmethod
+    def get_rows(cls, number):
+        data = clients_data[0]
+        for i in range(number):
+            yield {**data, 'email': f'client{i}@mail.com'}
+
+    @classmethod
+    def start_benchmark(cls):
+        cls.write(f'Benchmark: inserting {cls.rows} clients')
+
+        # the per-row path is slow, time a sample of it
+        sample = min(cls.rows, 1000)
+
+        def save_rows():
+            for data in cls.get_rows(sample):
+                Client(**data).save()
+
+        def bulk_rows():
+            instances, failed = Client.bulk_create(cls.get_rows(cls.rows), batch_size=1000)
+            assert not failed
+
+        save_time = timed(save_rows) / sample
+        bulk_time = timed(bulk_rows) / cls.rows
+
+        cls.write(f'save():        {save_time * 1000:.3f} ms/row ({save_time * cls.rows:.2f} s for {cls.rows})')
+        cls.write(f'bulk_create(): {bulk_time * 1000:.3f} ms/row ({bulk_time * cls.rows:.2f} s for {cls.rows})')
+
+
+class BenchPrimaryKeys(BaseTestClass):
+    '''
+    Visit inserts keyed by random uuid4 ids against time ordered uuid7 ids.
+    Rows are written straight to the visit table so only the primary key
+    index is measured. Random keys touch pages all over the B-tree while
+    time ordered keys only append to its right edge
+    '''
+    rows = int(os.getenv('BENCH_ROWS', 2000)) * 10
+
+    @classmethod
+    def insert_visits(cls, generator):
+        from database.fields import get_id_generator
+
+        new_id = get_id_generator(generator)
+        query = Visit._get_statements()['insert']
+        rows = ((new_id(), 'subscription', 'client', '2026-01-01 00:00:00') for _ in range(cls.rows))
+
+        with Visit.atomic() as conn:
+            conn.executemany(query, rows)
+
+    @classmethod
+    def get_index_pages(cls, conn):
+        ''' Returns the page count and the unused share of the pk index '''
+        query = '''
+            SELECT count(*), 1.0 * sum(unused) / sum(pgsize) FROM dbstat WHERE name = (
+                SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'visit' AND name LIKE 'sqlite_autoindex%'
+            );
+        '''
+        return conn.execute(query).fetchone()
+
+    @classmethod
+    def start_benchmark(cls):
+        cls.write(f'Benchmark: inserting {cls.rows} visits')
+
+        # the connection is held so the pragma stays set on it
+        with ConnectionManager.connection() as conn:
+            # the rows reference no real client or subscription
+            conn.execute('PRAGMA foreign_keys = OFF')
+            try:
+                for generator in ('uuid4', 'uuid7'):
+                    insert_time = timed(lambda: cls.insert_visits(generator))
+                    pages, unused = cls.get_index_pages(conn)
+
+                    cls.write(f'{generator}: {cls.rows / insert_time:,.0f} rows/s, pk index {pages} pages ({unused:.0%} unused)')
+
+                    conn.execute('DELETE FROM visit')
+                    conn.commit()
+            finally:
+                conn.execute('PRAGMA foreign_keys = ON')
+
+
+
+class BenchPagination(BaseTestClass):
+    '''
+    Reading the last page of the visit table with LIMIT/OFFSET against a
+    keyset cursor. Only the ids are read so hydration is not measured
+    '''
+    rows = BenchPrimaryKeys.rows
+    page_size = 50
+
+    @classmethod
+    def start_benchmark(cls):
+        cls.write(f'Benchmark: last page of {cls.rows} visits')
+
+        # the connection is held so the pragma stays set on it
+        with ConnectionManager.connection() as conn:
+            conn.execute('PRAGMA foreign_keys = OFF')
+            try:
+                BenchPrimaryKeys.insert_visits('uuid7')
+
+                queryset = Visit.query().only('visit_id')
+                last_offset = cls.rows - cls.page_size
+
+                # cursor of the row before the last page
+                before_last = queryset.order_by('timestamp', 'visit_id').offset(last_offset - 1).only('timestamp', 'visit_id').first()
+                cursor = queryset._encode_cursor(before_last)
+
+                def offset_page():
+                    list(queryset.order_by('timestamp', 'visit_id').limit(cls.page_size).offset(last_offset))
+
+                def keyset_page():
+                    queryset.paginate(cls.page_size, cursor)
+
+                cls.write(f'LIMIT/OFFSET: {timed(offset_page, 20) * 1000:.3f} ms/page')
+                cls.write(f'cursor:       {timed(keyset_page, 20) * 1000:.3f} ms/page')
+
+                conn.execute('DELETE FROM visit')
+                conn.commit()
+            finally:
+                conn.execute('PRAGMA foreign_keys = ON')
+
+
+
+class BenchStreaming(BaseTestClass):
+    '''
+    Peak memory of reading every visit row with fetchall against the
+    chunked iterator
+    '''
+    rows = BenchPrimaryKeys.rows
+
+    @classmethod
+    def start_benchmark(cls):
+        cls.write(f'Benchmark: reading {cls.rows} visits')
+
+        # the connection is held so the pragma stays set on it
+        with ConnectionManager.connection() as conn:
+            query = 'SELECT * FROM visit;'
+
+            conn.execute('PRAGMA foreign_keys = OFF')
+            try:
+                BenchPrimaryKeys.insert_visits('uuid7')
+
+                def read_all():
+                    for row in Visit.custom(query=query, many=True, result_only=True):
+                        pass
+
+                def read_stream():
+                    for row in Visit.custom(query=query, many=True, result_only=True, iterator=True):
+                        pass
+
+                for name, func in (('fetchall', read_all), ('iterator', read_stream)):
+                    tracemalloc.start()
+                    seconds = timed(func)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+
+                    cls.write(f'{name}: {seconds * 1000:.1f} ms, peak {peak / 1024:,.0f} KiB')
+
+                conn.execute('DELETE FROM visit')
+                conn.commit()
+            finally:
+                conn.execute('PRAGMA foreign_keys = ON')
+
+
+class BenchHydration(BaseTestClass):
+    '''
+    Per row cost of building an instance from a stored row through
+    __init__ (cls(**data)) against from_db_row. Subscription and Visit
+    rows also resolve their foreign keys
+    '''
+    number = 200
+
+    @classmethod
+    def start_benchmark(cls):
+        cls.write('Benchmark: hydrating one stored row')
+
+        client = Client(**clients_data[0])
+        client.save()
+        plan = Plan(**plans_data[0])
+        plan.save()
+        subscription = Subscription(plan_id=plan.plan_id, client_id=client.client_id, plan_unit=1, discount=0, discount_type='value', vat=0, status='booked', payment_status='pending')
+        subscription.save()
+        Visit(subscription_id=subscription.subscription_id, client_id=client.client_id).save()
+
+        conn = Client._connect_to_db(Client)
+        for model in (Client, Subscription, Visit):
+            columns = model._get_statements()['columns']
+            row = conn.execute(f'SELECT {', '.join(columns)} FROM {model.model_name} LIMIT 1;').fetchone()
+
+            init_time = timed(lambda: model(**dict(zip(columns, row))), cls.number)
+            row_time = timed(lambda: model.from_db_row(row), cls.number)
+
+            cls.write(f'{model.model_name:<12} __init__: {init_time * 1000:.3f} ms/row, from_db_row: {row_time * 1000:.3f} ms/row ({init_time / row_time:.1f}x)')
+
+        Client.objects.all().delete()
+        Plan.objects.all().delete()
+
+
+class BenchValidation(BaseTestClass):
+    '''
+    Validating Client payloads with the compiled validation plan against
+    walking the contraints of every field like _validate used to, and
+    the full Client(**payload) construction. Set BENCH_VALIDATIONS to
+    change the number of payloads
+    '''
+    payloads = int(os.getenv('BENCH_VALIDATIONS', 100000))
+
+    @classmethod
+    def start_benchmark(cls):
+        from database.db import get_table_map
+        from database.fields import get_contraint_keys_by_field_name, get_field_from_datatype
+
+        cls.write(f'Benchmark: validating {cls.payloads:,} client payloads')
+
+        payloads = [
+            {**clients_data[index % len(clients_data)], 'phone': f'08{index:09d}'}
+            for index in range(cls.payloads)
+        ]
+        client = Client(**clients_data[0])
+
+        def contraint_walk():
+            for payload in payloads:
+                client.__dict__.update(payload)
+                for field in get_table_map(model='client')['fields']:
+                    field_instance = getattr(client, f'_{field}')
+                    for contraint in get_contraint_keys_by_field_name(get_field_from_datatype(field_instance.field_type)):
+                        if contraint != 'pk' and hasattr(field_instance, contraint):
+                            field_instance._validate_by_contraint(contraint, getattr(client, field))
+
+        def validation_plan():
+            for payload in payloads:
+                client.__dict__.update(payload)
+                client._validate()
+
+        def construction():
+            for payload in payloads:
+                Client(**payload)
+
+        walk_time = timed(contraint_walk)
+        plan_time = timed(validation_plan)
+        construction_time = timed(construction)
+
+        cls.write(f'contraint walk:  {walk_time:.3f} s ({walk_time / cls.payloads * 1e6:.2f} us/payload)')
+        cls.write(f'validation plan: {plan_time:.3f} s ({plan_time / cls.payloads * 1e6:.2f} us/payload, {walk_time / plan_time:.1f}x)')
+        cls.write(f'Client(**payload): {construction_time:.3f} s ({construction_time / cls.payloads * 1e6:.2f} us/payload)')
+
+
+class BenchMemory(BaseTestClass):
+    '''
+    Memory held by Client and Visit rows read as model instances
+    (from_db_row) against compact rows (QuerySet.compact), measured
+    with tracemalloc. Set BENCH_MEMORY_ROWS to change the number of rows
+    '''
+    rows = int(os.getenv('BENCH_MEMORY_ROWS', 100000))
+
+    @classmethod
+    def start_benchmark(cls):
+        from database.rows import get_row_class
+
+        cls.write(f'Benchmark: memory of {cls.rows:,} rows')
+
+        for model in (Client, Visit):
+            columns = model._get_statements()['columns']
+            # the values are built first so only the rows are measured
+            table = [tuple(f'{column}-{index}' for column in columns) for index in range(cls.rows)]
+            row_class = get_row_class(model)
+
+            instances = measure(lambda: [model.from_db_row(row) for row in table])
+            rows = measure(lambda: [row_class(row) for row in table])
+
+            cls.write(f'{model.__name__} instances: {instances / 2**20:.1f} MiB ({instances / cls.rows:.0f} B/row)')
+            cls.write(f'{model.__name__} compact rows: {rows / 2**20:.1f} MiB ({rows / cls.rows:.0f} B/row, {instances / rows:.1f}x smaller)')
+
+
+def main(**kwargs):
+    try:
+        BenchInstanceConstruction.start_benchmark()
+        BenchBulkCreate.start_benchmark()
+        BenchPrimaryKeys.start_benchmark()
+        BenchPagination.start_benchmark()
+        BenchStreaming.start_benchmark()
+        BenchHydration.start_benchmark()
+        BenchValidation.start_benchmark()
+        BenchMemory.start_benchmark()
+    finally:
+        # clean up
+        delete_db(app_config.BASE_DIR, DB_NAME)
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,12 @@ from models.subscription import Subscription
 from models.payment import Payment
 from models.visit import Visit
 from models.assigned_client import AssignedClient
+from models.migration import Migration
+from database.db import get_table_map
+from database.aggregates import Count, Sum, Avg, Min, Max
+from database.session import Session
+from database.query import QuerySet
+from exceptions.exception import ValidationError
 from datetime import datetime
 import os
 import sys
@@ -65,6 +71,21 @@ class TestClient(BaseTestClass):
         cls._test_import_csv(cls)
         cls._test_import_xlsx(cls)
         cls._test_import_pdf(cls)
+        cls._test_atomic(cls)
+        cls._test_bulk_create(cls)
+        cls._test_time_ordered_ids(cls)
+        cls._test_bulk_update_delete(cls)
+        cls._test_queryset(cls)
+        cls._test_keyset_pagination(cls)
+        cls._test_iterator(cls)
+        cls._test_lookups(cls)
+        cls._test_exists_count(cls)
+        cls._test_values(cls)
+        cls._test_from_db_row(cls)
+        cls._test_field_checks(cls)
+        cls._test_regex_contraints(cls)
+        cls._test_model_registry(cls)
+        cls._test_compact_rows(cls)
 
     def _test_create_client(self):
         self.write('Test 1: Creating clients from test data')
@@ -227,6 +248,499 @@ class TestClient(BaseTestClass):
         assert len(refetched_clients) == 0
 
         self.write('\nTest 11: Passed ✅\n')
+
+    def _test_atomic(self):
+        self.write('Test 12: Saving clients in one transaction')
+
+        data = list(get_client())
+
+        # an error in the block rolls back every save
+        try:
+            with Client.atomic():
+                Client(**data[0]).save()
+                Client(**data[1]).save()
+                raise Exception('rollback')
+        except Exception:
+            pass
+
+        assert len(Client.fetch_all()) == 0
+
+        # a failed nested block only rolls back its own save
+        with Client.atomic():
+            Client(**data[0]).save()
+            try:
+                with Client.atomic():
+                    Client(**data[1]).save()
+                    raise Exception('rollback')
+            except Exception:
+                pass
+
+        fetched_clients = Client.fetch_all()
+        assert len(fetched_clients) == 1
+        assert fetched_clients[0].email == data[0]['email']
+
+        for client in fetched_clients:
+            client.delete()
+
+        self.write('\nTest 12: Passed ✅\n')
+
+    def _test_bulk_create(self):
+        self.write('Test 13: Bulk creating clients')
+
+        data = list(get_client())
+        invalid_client = {**data[0], 'first_name': 'Cl'} # breaks min_length
+
+        instances, failed = Client.bulk_create([*data, invalid_client], batch_size=2)
+        assert len(instances) == len(data)
+        assert len(failed) == 1 and failed[0][0] == invalid_client
+
+        fetched_clients = Client.fetch_all()
+        assert len(fetched_clients) == len(data)
+
+        # a duplicate pk only skips the duplicate row of the batch
+        duplicate = {**data[0], 'client_id': instances[0].client_id}
+        instances, failed = Client.bulk_create([duplicate, data[1]])
+        assert len(instances) == 1 and len(failed) == 1
+        assert len(Client.fetch_all()) == len(data) + 1
+
+        Client.objects.all().delete()
+
+        self.write('\nTest 13: Passed ✅\n')
+
+    def _test_time_ordered_ids(self):
+        import uuid
+
+        self.write('Test 14: Client ids are time ordered')
+
+        instances, failed = Client.bulk_create(get_client())
+        ids = [instance.client_id for instance in instances]
+
+        assert not failed
+        assert all(uuid.UUID(pk).version == 7 for pk in ids)
+        assert ids == sorted(ids)
+
+        Client.objects.all().delete()
+
+        self.write('\nTest 14: Passed ✅\n')
+
+    def _test_bulk_update_delete(self):
+        self.write('Test 15: Updating and deleting clients in one statement')
+
+        Client.bulk_create(get_client())
+        total = len(Client.fetch_all())
+
+        updated = Client.objects.filter(display_name='client').update(display_name='company')
+        assert updated == total
+
+        fetched_clients = Client.filter(display_name='company')
+        assert len(fetched_clients) == total
+        assert all(client.updated_at for client in fetched_clients)
+
+        one_client = fetched_clients[0]
+        assert Client.objects.filter(client_id=one_client.client_id).delete() == 1
+        assert Client.fetch_one(client_id=one_client.client_id) is None
+
+        assert Client.objects.all().delete() == total - 1
+        assert len(Client.fetch_all()) == 0
+
+        self.write('\nTest 15: Passed ✅\n')
+
+    def _test_queryset(self):
+        self.write('Test 16: Chaining client queries')
+
+        data = list(get_client())
+        Client.bulk_create(data)
+
+        queryset = Client.query().filter(first_name='Client')
+        ordered = queryset.exclude(last_name='One').order_by('-last_name')
+        
+        # nothing is read until the rows are used
+        assert queryset._result_cache is None
+        assert len(queryset) == len(data)
+        assert queryset.exists()
+        assert not Client.query().filter(first_name='Nobody').exists()
+
+        last_names = [client.last_name for client in ordered]
+        assert 'One' not in last_names
+        assert last_names == sorted(last_names, reverse=True)
+
+        assert [client.last_name for client in ordered[1:3]] == last_names[1:3]
+        assert ordered[0].last_name == last_names[0]
+        assert len(ordered[1:]) == len(last_names) - 1
+
+        emails = Client.query().order_by('email').only('email')
+        assert list(emails) == [{'email': email} for email in sorted(client['email'] for client in data)]
+
+        Client.objects.all().delete()
+
+        self.write('\nTest 16: Passed ✅\n')
+
+    def _test_keyset_pagination(self):
+        from services.main import ServiceManager
+
+        self.write('Test 17: Paging through clients with a cursor')
+
+        data = [{**client, 'email': f'client{i}@mail.com'} for i in range(3) for client in get_client()]
+        Client.bulk_create(data)
+
+        client_ids = []
+        clients, cursor = Client.fetch_all(cursor=None, page_size=4)
+        client_ids += [client.client_id for client in clients]
+        while cursor:
+            clients, cursor = Client.fetch_all(cursor=cursor, page_size=4)
+            client_ids += [client.client_id for client in clients]
+
+        assert len(client_ids) == len(data)
+        assert len(set(client_ids)) == len(data)
+
+        # the same order as reading every row at once
+        assert client_ids == [client.client_id for client in Client.query().order_by('created_at', 'client_id')]
+
+        clients, cursor = Client.filter(last_name='One', cursor=None, page_size=2)
+        assert len(clients) == 2 and cursor is not None
+        clients, cursor = Client.filter(last_name='One', cursor=cursor, page_size=2)
+        assert len(clients) == 1 and cursor is None
+
+        service = ServiceManager(model='client', command='FETCH_ALL', validated_args={'model': 'client', 'payload': {'page_size': 4}}, required_args=['model'])
+        response = service.process_command()
+        assert response['success'] and len(response['data']) == 4
+        assert response['next_cursor'] is not None
+
+        Client.objects.all().delete()
+
+        self.write('\nTest 17: Passed ✅\n')
+
+    def _test_iterator(self):
+        import types
+
+        self.write('Test 18: Streaming clients')
+
+        data = [{**client, 'email': f'client{i}@mail.com'} for i in range(3) for client in get_client()]
+        Client.bulk_create(data)
+
+        clients = Client.fetch_all(iterator=True, chunk_size=4)
+        assert isinstance(clients, types.GeneratorType)
+        assert len([client.client_id for client in clients]) == len(data)
+
+        clients = Client.filter(last_name='One', iterator=True, chunk_size=2)
+        assert all(client.last_name == 'One' for client in clients)
+
+        rows, column_names = Client.fetch_all(col_names=True, iterator=True)
+        assert column_names[0] == 'client_id'
+        assert len(list(rows)) == len(data)
+
+        rows = Client.custom(query='SELECT client_id FROM client;', many=True, result_only=True, iterator=True, chunk_size=5)
+        assert isinstance(rows, types.GeneratorType)
+        assert len(list(rows)) == len(data)
+
+        Client.objects.all().delete()
+
+        self.write('\nTest 18: Passed ✅\n')
+
+    def _test_lookups(self):
+        self.write('Test 19: Filtering clients with lookups')
+
+        data = list(get_client())
+        instances, _ = Client.bulk_create(data)
+        today = datetime.now().strftime('%Y-%m-%d')
+
+        assert len(Client.filter(created_at__date=today)) == len(data)
+        assert len(Client.filter(created_at=self.current_year)) == len(data)
+        assert len(Client.filter(created_at__gte=datetime(int(self.current_year), 1, 1))) == len(data)
+        assert len(Client.filter(created_at__lt=today)) == 0
+        assert len(Client.filter(updated_at__isnull=False)) == len(data)
+
+        assert {client.last_name for client in Client.filter(last_name__startswith='T')} == {'Two', 'Three'}
+
+        # a text range on TEXT fields, LIKE on the other fields and after U+10FFFF
+        assert ' >= ? AND last_name < ?' in repr(Client.query().filter(last_name__startswith='T'))
+        assert len(Client.filter(last_name__startswith='T\U0010FFFF')) == 0
+        assert len(Client.filter(last_name__startswith='T%')) == 0
+        assert Client.query()._compile_lookup('last_name__startswith', 'T\U0010FFFF') == ("last_name LIKE ? ESCAPE '\\'", ['T\U0010FFFF%'])
+        assert Plan.query()._compile_lookup('price__startswith', 12) == ("price LIKE ? ESCAPE '\\'", ['12%'])
+
+        # a NULL in a nullable field does not match the exclusion, the row is kept.
+        # No client field is nullable, the queryset below sees email as one
+        class NullableEmailQuerySet(QuerySet):
+            @property
+            def _fields(self):
+                fields = dict(super()._fields)
+                fields['email'] = {**fields['email'], 'null': True}
+                return fields
+
+        assert repr(Client.query().exclude(email='x')).endswith('WHERE NOT (email = ?);>')
+        queryset = NullableEmailQuerySet(Client).exclude(email='x', last_name__isnull=True)
+        assert 'WHERE (NOT (email = ? AND last_name IS NULL) OR email IS NULL);' in repr(queryset), repr(queryset)
+        assert len(queryset) == len(data)
+        assert get_table_map(model='client')['fields']['email'].get('null', False) is False
+
+        # dates and datetimes match their day, invalid values are rejected
+        assert len(Client.filter(created_at__date=datetime.now())) == len(data)
+        assert len(Client.filter(created_at__date=datetime.now().date())) == len(data)
+        for lookup, value in (('created_at__date', 'today'), ('last_name__in', 'One'), ('created_at__range', (today,)), ('created_at__range', 5)):
+            try:
+                Client.query().filter(**{lookup: value})._compile_where()
+                raise AssertionError(f'{lookup} accepted {value!r}')
+            except ValidationError:
+                pass
+
+        assert len(Client.filter(client_id__in=[instances[0].client_id, instances[1].client_id])) == 2
+        assert len(Client.filter(client_id__in=[])) == 0
+        assert len(Client.query().exclude(last_name__in=['One', 'Two'])) == len(data) - 2
+
+        # __in lists are padded to a power of two, the statements cached stay bounded
+        statements = Client._get_statements()
+        cached = len(statements)
+        for size in range(5, 9):
+            assert len(Client.filter(client_id__in=[instance.client_id for instance in instances][:size] + ['missing'] * size)) == min(size, len(instances))
+        assert len(statements) == cached + 1
+
+        # the date predicates are ranges searched on the cursor index
+        for queryset in (
+            Client.query().filter(created_at__date=today),
+            Client.query().filter(created_at='2026-10'),
+            Client.query().filter(created_at__lt=datetime.now()),
+        ):
+            plan = ' '.join(queryset.explain())
+            assert 'client_cursor_idx' in plan, plan
+            assert 'SCAN' not in plan, plan
+
+        Client.objects.all().delete()
+
+        self.write('\nTest 19: Passed ✅\n')
+
+    def _test_exists_count(self):
+        self.write('Test 20: Probing clients with exists and count')
+
+        data = list(get_client())
+        instances, _ = Client.bulk_create(data)
+
+        assert Client.count() == len(data)
+        assert Client.count(last_name__in=['One', 'Two']) == 2
+        assert Client.exists(phone=data[0]['phone'])
+        assert not Client.exists(phone='000')
+        assert instances[0]._verify_pk()
+
+        # the probes read the phone index only, never the table rows
+        plan = ' '.join(Client.query().filter(phone=data[0]['phone']).explain('exists'))
+        assert 'COVERING INDEX client_phone_idx' in plan, plan
+
+        Client.objects.filter(client_id=instances[0].client_id).delete()
+        assert not instances[0]._verify_pk()
+        assert Client.count() == len(data) - 1
+
+        Client.objects.all().delete()
+
+        self.write('\nTest 20: Passed ✅\n')
+
+    def _test_values(self):
+        from services.main import ServiceManager
+
+        self.write('Test 21: Reading clients as dicts and tuples')
+
+        data = list(get_client())
+        instances, _ = Client.bulk_create(data)
+        one_client = Client.fetch_one(client_id=instances[0].client_id)
+
+        assert Client.fetch_one(client_id=one_client.client_id, values=True) == one_client.data
+        assert Client.fetch_one(client_id=one_client.client_id, values_list=('first_name', 'phone')) == (one_client.first_name, one_client.phone)
+        assert Client.fetch_one(client_id='unknown', values=True) is None
+
+        rows = Client.fetch_all(values=True)
+        assert len(rows) == len(data) and all(isinstance(row, dict) for row in rows)
+        assert rows[0] == one_client.data
+
+        rows = Client.filter(last_name='One', values_list=True)
+        assert rows == [tuple(one_client.data.values())]
+
+        rows, cursor = Client.filter(last_name__in=['One', 'Two'], values=('last_name',), cursor=None, page_size=1)
+        assert rows[0]['last_name'] == 'One' and cursor is not None
+
+        assert set(Client.query().values_list('last_name', flat=True)) == {client['last_name'] for client in data}
+
+        for command, payload, size in (
+            ('FETCH_ALL', {}, len(data)),
+            ('FILTER', {'last_name__in': ['One', 'Two']}, 2),
+        ):
+            service = ServiceManager(model='client', command=command, validated_args={'model': 'client', 'payload': payload}, required_args=['model', 'payload'])
+            response = service.process_command()
+            assert response['success'] and len(response['data']) == size, response
+            assert all(isinstance(row, dict) for row in response['data'])
+
+        service = ServiceManager(model='client', command='FETCH_ONE', validated_args={'model': 'client', 'payload': {'client_id': one_client.client_id}}, required_args=['model', 'payload'])
+        response = service.process_command()
+        assert response['success'] and response['data'] == one_client.data, response
+
+        Client.objects.all().delete()
+
+        self.write('\nTest 21: Passed ✅\n')
+
+    def _test_from_db_row(self):
+        self.write('Test 22: Building clients from stored rows')
+
+        Client.bulk_create(list(get_client()))
+        stored = '2020-01-01 00:00:00'
+        Client.objects.update(created_at=stored, updated_at=stored)
+
+        row = Client.fetch_one(last_name='One', values_list=True)
+        one_client = Client.from_db_row(row)
+        assert isinstance(one_client, Client)
+        assert tuple(one_client.data.values()) == row
+
+        # the stored datetimes are kept, an update stamps updated_at
+        fetched_client = Client.fetch_one(client_id=one_client.client_id)
+        assert fetched_client.created_at == stored and fetched_client.updated_at == stored
+
+        fetched_client.first_name = 'Updated Client'
+        fetched_client.update()
+        refetched_client = Client.fetch_one(client_id=one_client.client_id)
+        assert refetched_client.created_at == stored and refetched_client.updated_at > stored
+        assert refetched_client.first_name == 'Updated Client'
+
+        Client.objects.all().delete()
+
+        self.write('\nTest 22: Passed ✅\n')
+
+    def _test_field_checks(self):
+        self.write('Test 23: Field validators are shared and compiled once')
+
+        # one validator map per field class
+        assert Client.first_name._validator_map is Client.last_name._validator_map
+        assert Client.client_id._validator_map is not Client.first_name._validator_map
+
+        # only the contraints set on the field are checked, in a fixed order
+        assert [check[0] for check in Client.first_name._checks] == ['null', 'unique', 'min_length']
+        assert [check[0] for check in Client.display_name._checks] == ['null', 'unique', 'choice']
+        assert [check[0] for check in Client.created_at._checks] == ['null', 'unique']
+
+        client = Client(**clients_data[0])
+        client.display_name = 'company'
+        for field, value, message in (('first_name', 'ab', 'MIN LENGTH'), ('display_name', 'person', 'CHOICE'), ('phone', None, 'NOT NULL')):
+            try:
+                setattr(client, field, value)
+                raise AssertionError(f'{field} accepted {value}')
+            except AssertionError:
+                raise
+            except Exception as err:
+                assert str(err).startswith(message) and str(err).endswith(f'on {field}')
+
+        # the plan checks the attributes not set as None, with the messages of the contraints
+        client = Client(**clients_data[0])
+        client.__dict__['first_name'] = 'ab'
+        del client.__dict__['phone']
+        for attr, message in (('first_name', 'MIN LENGTH CONSTRAINT BROKEN with value ab on field contraint'), ('phone', 'NOT NULL CONSTRAINT BROKEN with value None on field contraint')):
+            try:
+                client._validate()
+                raise AssertionError(f'{attr} was not checked')
+            except ValidationError as err:
+                assert str(err.message) == message, err.message
+            client.__dict__['first_name'] = clients_data[0]['first_name']
+
+        self.write('\nTest 23: Passed ✅\n')
+
+    def _test_regex_contraints(self):
+        self.write('Test 24: Regex contraints are compiled when the field is declared')
+
+        import re
+        from database import fields
+
+        # the field keeps the pattern string, the check holds the compiled pattern
+        phone = fields.TextField(regex_full_match=r'\+?\d{7,15}')
+        assert phone.regex_full_match == r'\+?\d{7,15}'
+        pattern = dict((check[0], check[2]) for check in phone._checks)['regex_full_match']
+        assert isinstance(pattern, re.Pattern) and pattern.pattern == phone.regex_full_match
+
+        phone._set_data('+2348100000001', 'phone')
+        try:
+            phone._set_data('0810-000', 'phone')
+            raise AssertionError('phone accepted 0810-000')
+        except AssertionError:
+            raise
+        except Exception as err:
+            assert str(err).startswith('FULL MATCH')
+
+        partial = fields.TextField(regex_partial_match=r'\d')
+        partial._set_data('plan 5')
+
+        try:
+            fields.TextField(regex_full_match='(')
+            raise AssertionError('invalid pattern accepted')
+        except AssertionError:
+            raise
+        except Exception as err:
+            assert 'Invalid pattern' in str(err)
+
+        self.write('\nTest 24: Passed ✅\n')
+
+    def _test_model_registry(self):
+        self.write('Test 25: Models are registered with their fields when defined')
+
+        from database.db import MODEL_REGISTRY, get_model_class
+        from database.related import lazy_reference
+
+        assert MODEL_REGISTRY['client'] is Client and get_model_class('subscription') is Subscription
+        assert tuple(Client._model_fields) == Client._get_statements()['columns']
+        assert Client._model_pk == 'client_id'
+        assert Subscription._model_fk == {'plan_id': 'plan', 'client_id': 'client'}
+        assert Subscription._model_datetimes == ('expiration_date', 'created_at', 'updated_at')
+
+        # references subclass the model but are not registered
+        lazy_reference(Client, 'client-id')
+        assert MODEL_REGISTRY['client'] is Client
+
+        # the fields are read from the class, not copied to each instance
+        client = Client(**clients_data[0])
+        assert client._first_name is Client.first_name and '_first_name' not in client.__dict__
+
+        self.write('\nTest 25: Passed ✅\n')
+
+    def _test_compact_rows(self):
+        self.write('Test 26: Compact rows and updates of the changed columns only')
+
+        for data in clients_data[:2]:
+            Client(**data).save()
+
+        rows = list(Client.query().order_by('client_id').compact())
+        clients = list(Client.query().order_by('client_id'))
+        assert len(rows) == len(clients) == 2
+
+        # the row is a tuple of the columns, read by name
+        row, client = rows[0], clients[0]
+        assert isinstance(row, tuple) and not hasattr(row, '__dict__')
+        assert row.client_id == client.client_id and row.phone == client.phone
+        assert row.data == {column: getattr(client, column) for column in Client._get_statements()['columns']}
+        assert row.instance().first_name == client.first_name
+
+        try:
+            row.phone = '+2340000000000'
+            raise AssertionError('compact row accepted a new value')
+        except AttributeError:
+            pass
+
+        # rows read from the table are clean, setting a column marks it
+        assert client._dirty == 0
+        client.last_name = 'Compact'
+        assert client._dirty == Client._model_bits['last_name']
+
+        conn = Client._connect_to_db(Client)
+        updates = []
+        conn.set_trace_callback(lambda statement: updates.append(statement) if statement.lstrip().upper().startswith('UPDATE') else None)
+
+        try:
+            client.update()
+            client.update()
+        finally:
+            conn.set_trace_callback(None)
+
+        # only last_name and updated_at are written, the second update has nothing to write
+        assert len(updates) == 1 and updates[0].startswith("UPDATE client SET last_name = 'Compact', updated_at = "), updates
+        assert client._dirty == 0
+        assert Client.fetch_one(client_id=client.client_id).last_name == 'Compact'
+
+        for client in clients:
+            client.delete()
+
+        self.write('\nTest 26: Passed ✅\n')
         
  
 class TestPlan(BaseTestClass):
@@ -246,6 +760,7 @@ class TestPlan(BaseTestClass):
         cls._test_import_csv(cls)
         cls._test_import_xlsx(cls)
         cls._test_import_pdf(cls)
+        cls._test_connection_release(cls)
 
     def _test_create_plan(self):
         self.write('Test 1: Creating plans from test data')
@@ -411,6 +926,95 @@ class TestPlan(BaseTestClass):
         assert len(refetched_plans) == 0
 
         self.write('\nTest 11: Passed ✅\n')
+
+    def _test_connection_release(self):
+        self.write('Test 12: Pooled connections are released after each unit of work')
+
+        import threading
+        from database.connection import ConnectionManager
+
+        pool = ConnectionManager._get_pool(db_config.get_db_name())
+        counts, errors = [], []
+
+        def unit_of_work(work):
+            try:
+                work()
+            except Exception as err:
+                errors.append(err)
+
+        def held():
+            with ConnectionManager.connection():
+                counts.append(len(Plan.fetch_all()))
+
+        def in_atomic():
+            with Plan.atomic():
+                counts.append(len(Plan.fetch_all()))
+
+        def in_session():
+            with Session():
+                counts.append(len(Plan.fetch_all()))
+
+        def bare_query():
+            # released when the thread ends
+            counts.append(len(Plan.fetch_all()))
+
+        works = (held, in_atomic, in_session, bare_query)
+        for work in works:
+            threads = [threading.Thread(target=unit_of_work, args=(work,)) for _ in range(pool.pool_size * 2)]
+            for thread in threads:
+                thread.start()
+                if work is bare_query:
+                    thread.join()
+            for thread in threads:
+                thread.join()
+
+        assert not errors, errors
+        assert len(counts) == pool.pool_size * 2 * len(works)
+        assert len(pool._connections) <= pool.pool_size
+
+        # a nested unit of work (an atomic block, an iterator) keeps the connection of the outer one
+        with ConnectionManager.connection() as conn:
+            with ConnectionManager.connection():
+                assert pool.held is conn
+            assert pool.held is conn
+
+            with Plan.atomic():
+                Plan(**plans_data[0]).save()
+            assert pool.held is conn
+
+            rows = Plan.query().iterator(chunk_size=1)
+            next(rows)
+            with Plan.atomic():
+                pass
+            assert pool.held is conn
+            rows.close()
+            assert pool.held is conn
+        assert pool.held is None
+
+        # an open iterator holds the connection
+        rows = Plan.query().iterator(chunk_size=1)
+        next(rows)
+        conn = pool.held
+        with Plan.atomic():
+            pass
+        assert pool.held is conn
+        rows.close()
+        assert pool.held is None
+
+        # so does a session
+        with Session():
+            conn = pool.held
+            with Plan.atomic():
+                pass
+            rows = Plan.query().iterator(chunk_size=1)
+            next(rows)
+            rows.close()
+            assert pool.held is conn
+        assert pool.held is None
+
+        Plan.fetch_one(plan_name=plans_data[0]['plan_name']).delete()
+
+        self.write('\nTest 12: Passed ✅\n')
         
 
 class TestSubscription(BaseTestClass):
@@ -427,6 +1031,8 @@ class TestSubscription(BaseTestClass):
         cls._test_export_xlsx(cls)
         cls._test_export_pdf(cls)
         cls._test_assigned_users(cls)
+        cls._test_expire_subscriptions(cls)
+        cls._test_indexes(cls)
 
     def _test_setup(self):
         self.write('\nSetting up db with users, plan and payment')
@@ -577,6 +1183,51 @@ class TestSubscription(BaseTestClass):
         assert assigned_user == one_subscription.assigned_users[0].client_id
 
         self.write('\nTest 7: Passed ✅\n')
+
+    def _test_expire_subscriptions(self):
+        self.write('Test 8: Expire subscriptions past their expiration date')
+
+        Subscription.objects.update(status='running')
+
+        one_subscription = Subscription.fetch_all()[0]
+        Subscription.objects.filter(subscription_id=one_subscription.subscription_id).update(expiration_date='2000-01-01 00:00:00')
+
+        assert Subscription.expire_subscriptions() == 1
+        assert Subscription.fetch_one(subscription_id=one_subscription.subscription_id).status == 'expired'
+        assert len(Subscription.filter(status='expired')) == 1
+
+        self.write('\nTest 8: Passed ✅\n')
+
+    def _test_indexes(self):
+        self.write('Test 9: Foreign keys and declared fields are indexed')
+
+        conn = Subscription._connect_to_db(Subscription)
+        created = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';").fetchall()}
+
+        for model in ('client', 'subscription', 'assigned_client', 'payment', 'visit'):
+            indexes = get_table_map(model=model)['indexes']
+            assert set(indexes) <= created, set(indexes) - created
+
+        for column in get_table_map(model='visit')['fk']:
+            assert f'visit_{column}_idx' in created
+
+        one_subscription = Subscription.fetch_all()[0]
+        for queryset, index_name in (
+            (Visit.query().filter(subscription_id=one_subscription.subscription_id), 'visit_subscription_id_idx'),
+            (AssignedClient.query().filter(subscription_id=one_subscription.subscription_id), 'assigned_client_subscription_id_client_id_idx'),
+            (Payment.query().filter(subscription_id=one_subscription.subscription_id), 'payment_subscription_id_idx'),
+            (Client.query().filter(phone='081000000001'), 'client_phone_idx'),
+            (Subscription.query().filter(status__in=['booked', 'running'], expiration_date__lt=datetime.now()), 'subscription_status_expiration_date_idx'),
+        ):
+            plan = ' '.join(queryset.explain())
+            assert index_name in plan, plan
+
+        # the applied schema is logged with its indexes
+        migrations = list(Migration.query().only('table_map'))
+        assert len(migrations) > 0
+        assert any('subscription_status_expiration_date_idx' in str(row['table_map']) for row in migrations)
+
+        self.write('\nTest 9: Passed ✅\n')
         
 
 class TestPayment(BaseTestClass):
@@ -589,6 +1240,8 @@ class TestPayment(BaseTestClass):
         cls._test_fetch_payments(cls)
         cls._test_update_payment(cls)
         cls._test_delete_payment(cls)
+        cls._test_aggregates(cls)
+        cls._test_related(cls)
 
     def _test_create_payments(self):
         self.write('Test 1: Creating payments from test data') 
@@ -708,6 +1361,95 @@ class TestPayment(BaseTestClass):
         assert len(fetched_payment) != len(fetched_payment_again)
 
         self.write('\nTest 4: Passed ✅\n')
+
+    def _test_aggregates(self):
+        self.write('Test 5: Aggregating payments in sqlite')
+
+        payments = Payment.fetch_all()
+        amounts = [payment.amount for payment in payments]
+        sub_id = payments[0].subscription_id.subscription_id
+
+        result = Payment.query().filter(subscription_id=sub_id).aggregate(
+            Sum('amount'), Count('*'), Avg('amount'), Min('amount'), Max('amount'), clients=Count('client_id', distinct=True)
+        )
+        assert result == {
+            'amount__sum': sum(amounts),
+            'count': len(amounts),
+            'amount__avg': sum(amounts) / len(amounts),
+            'amount__min': min(amounts),
+            'amount__max': max(amounts),
+            'clients': 1
+        }, result
+
+        assert Payment.query().filter(amount__lt=0).aggregate(total=Sum('amount')) == {'total': None}
+        assert Subscription.fetch_one(subscription_id=sub_id).total_paid == sum(amounts)
+
+        groups = list(Payment.query().group_by('subscription_id').annotate(Sum('amount'), payments=Count('*')).order_by('-payments'))
+        assert groups == [{'subscription_id': sub_id, 'amount__sum': sum(amounts), 'payments': len(amounts)}], groups
+        assert Payment.query().group_by('subscription_id').count() == 1
+        assert list(Payment.query().annotate(Max('amount'))) == [{'amount__max': max(amounts)}]
+
+        # the names are column aliases, only identifiers that are not fields are accepted
+        for name in ('total; DROP TABLE payment', 'amount', 'amount__max'):
+            try:
+                Payment.query().annotate(Max('amount')).annotate(**{name: Sum('amount')})
+                raise AssertionError(f'aggregate name {name} accepted')
+            except AssertionError:
+                raise
+            except Exception as err:
+                assert 'aggregate name' in str(err).lower(), err
+
+        self.write('\nTest 5: Passed ✅\n')
+
+    def _test_related(self):
+        self.write('Test 6: Listing subscriptions with their relations')
+
+        subscription = Subscription.fetch_all()[0]
+        client = Client.fetch_one(client_id=subscription.client_id.client_id)
+        for _ in range(3):
+            new_subscription = Subscription(plan_id=subscription.plan_id.plan_id, client_id=client.client_id, plan_unit=1, discount=0, discount_type='value', vat=0, status='booked', payment_status='pending')
+            new_subscription.save()
+            new_subscription.set_assigned_client(client.client_id)
+
+        expected = {}
+        for one_subscription in Subscription.fetch_all():
+            one_subscription._get_assigned_users()
+            expected[one_subscription.subscription_id] = (
+                one_subscription.plan_id.plan_name,
+                one_subscription.client_id.phone,
+                [payment.payment_id for payment in one_subscription.payments],
+                [user.client_id for user in one_subscription.assigned_users],
+            )
+        assert len(expected) == 4
+
+        conn = Subscription._connect_to_db(Subscription)
+        selects = []
+        conn.set_trace_callback(lambda statement: selects.append(statement) if statement.lstrip().upper().startswith('SELECT') else None)
+
+        try:
+            subscriptions = Subscription.query().select_related('plan_id', 'client_id').prefetch_related('payments', 'assigned_users')
+            result = {
+                one_subscription.subscription_id: (
+                    one_subscription.plan_id.plan_name,
+                    one_subscription.client_id.phone,
+                    [payment.payment_id for payment in one_subscription.payments],
+                    [user.client_id for user in one_subscription.assigned_users],
+                )
+                for one_subscription in subscriptions
+            }
+            # the subscriptions with the joined rows, then one query per relation
+            assert len(selects) == 3, selects
+        finally:
+            conn.set_trace_callback(None)
+
+        assert result == expected, result
+        assert ' JOIN plan ' in repr(subscriptions) and ' JOIN client ' in repr(subscriptions)
+
+        # the payments point back to the loaded subscription
+        payments = [payment for one_subscription in subscriptions for payment in one_subscription.payments]
+        assert payments and all(payment.subscription_id.is_loaded for payment in payments)
+
+        self.write('\nTest 6: Passed ✅\n')
         
 
 class TestVisit(BaseTestClass):
@@ -720,6 +1462,9 @@ class TestVisit(BaseTestClass):
         cls._test_create_visit(cls)
         # cls._test_delete_visit(cls)
         cls._test_export_pdf(cls)
+        cls._test_visit_count(cls)
+        cls._test_lazy_foreign_keys(cls)
+        cls._test_identity_map(cls)
 
     def _test_setup(self):
         self.write('Setting up db with users, plan, and subscription')
@@ -781,6 +1526,147 @@ class TestVisit(BaseTestClass):
 
         self.write('\nTest 1: Passed ✅\n')
         
+    def _test_visit_count(self):
+        self.write('Test 3: Counting subscription visits')
+
+        assert Visit.get_all_sub_visits_count(self.sub_id) == 1
+        assert Visit.get_all_sub_visits_count('unknown') == 0
+
+        visits = list(Visit.query().filter(subscription_id=self.sub_id).group_by('client_id').annotate(visits=Count('*')))
+        assert len(visits) == 1 and visits[0]['visits'] == 1
+
+        self.write('\nTest 3: Passed ✅\n')
+
+    def _test_lazy_foreign_keys(self):
+        self.write('Test 4: Foreign keys are read on first access')
+
+        conn = Visit._connect_to_db(Visit)
+        selects = []
+        conn.set_trace_callback(lambda statement: selects.append(statement) if statement.lstrip().upper().startswith('SELECT') else None)
+
+        try:
+            visit = Visit.query().filter(subscription_id=self.sub_id).first()
+            assert len(selects) == 1
+
+            # the ids are held by the references
+            subscription = visit.subscription_id
+            assert subscription.subscription_id == self.sub_id
+            assert visit.data['subscription_id'] == self.sub_id
+            assert isinstance(subscription, Subscription) and not subscription.is_loaded
+            assert len(selects) == 1
+
+            # the row is read once and kept on the reference
+            assert subscription.status in {'booked', 'running'}
+            assert subscription.plan_unit == 3
+            assert subscription.is_loaded and len(selects) == 2
+
+            plan_id = subscription.plan_id.plan_id
+            assert len(selects) == 2
+            assert subscription.plan_id.plan_name and len(selects) == 3
+            assert subscription.plan_id == Plan.fetch_one(plan_id=plan_id)
+        finally:
+            conn.set_trace_callback(None)
+
+        # the columns are read only on the reference, the row it resolves to holds the changes
+        try:
+            subscription.plan_unit = 4
+            raise AssertionError('reference accepted plan_unit')
+        except AttributeError:
+            pass
+        assert subscription._dirty == 0 and subscription.plan_unit == 3
+
+        row = subscription._resolve()
+        row.status = row.status
+        updates = []
+        conn.set_trace_callback(lambda statement: updates.append(statement) if statement.lstrip().upper().startswith('UPDATE') else None)
+
+        try:
+            # update on the reference updates the row, once
+            subscription.update()
+            row.update()
+        finally:
+            conn.set_trace_callback(None)
+
+        assert len(updates) == 1 and updates[0].startswith('UPDATE subscription SET status = '), updates
+
+        # the other members of the model run on the row, the reference only holds the id
+        fresh = Visit.query().filter(subscription_id=self.sub_id).first().subscription_id
+        assert not fresh.is_loaded
+        assert fresh.data == row.data and fresh.data['plan_unit'] == 3
+        fresh._validate(check_id=True)
+
+        # a missing row is a validation error, from a reference or from the caller
+        from database.related import lazy_reference
+        try:
+            lazy_reference(Subscription, 'unknown')._resolve()
+            raise AssertionError('resolved a missing subscription')
+        except ValidationError:
+            pass
+
+        try:
+            Visit(subscription_id='unknown', client_id=row.client_id.client_id)
+            raise AssertionError('created a visit of a missing subscription')
+        except ValidationError as err:
+            assert err.message == 'Subscription is not valid on visit', err.message
+
+        self.write('\nTest 4: Passed ✅\n')
+
+    def _test_identity_map(self):
+        self.write('Test 5: One instance per row in a session')
+
+        assert Subscription.fetch_one(subscription_id=self.sub_id) is not Subscription.fetch_one(subscription_id=self.sub_id)
+
+        conn = Visit._connect_to_db(Visit)
+        selects = []
+        conn.set_trace_callback(lambda statement: selects.append(statement) if statement.lstrip().upper().startswith('SELECT') else None)
+
+        try:
+            with Session() as session:
+                subscription = Subscription.fetch_one(subscription_id=self.sub_id)
+                assert subscription in session and len(selects) == 1
+
+                # read by pk from the map, no query
+                assert Subscription.fetch_one(subscription_id=self.sub_id) is subscription
+                assert len(selects) == 1
+
+                # the foreign keys resolve to the instance already read
+                visits = list(Visit.query().filter(subscription_id=self.sub_id))
+                other_visits = list(Visit.query().filter(subscription_id=self.sub_id))
+                assert visits[0] is other_visits[0]
+                assert visits[0].subscription_id.plan_unit == 3
+                assert visits[0].subscription_id._resolve() is subscription
+                assert len(selects) == 3
+
+                client = visits[0].client_id
+                assert client.first_name and len(selects) == 4
+                assert subscription.client_id is client
+
+                # writes keep the map coherent
+                client = client._resolve()
+                client.company_name = 'Session Company'
+                client.update()
+                assert Client.fetch_one(client_id=client.client_id).company_name == 'Session Company'
+
+                new_client = Client(**{**clients_data[0], 'email': 'session@mail.com', 'phone': '081000000099'})
+                new_client.save()
+                count = len(selects)
+                assert Client.fetch_one(client_id=new_client.client_id) is new_client
+                assert len(selects) == count
+
+                new_client.delete()
+                assert new_client not in session
+                assert Client.fetch_one(client_id=new_client.client_id) is None
+
+                Subscription.query().filter(subscription_id=self.sub_id).update(plan_unit=3)
+                assert subscription not in session
+                assert Subscription.fetch_one(subscription_id=self.sub_id) is not subscription
+
+            assert len(session) == 0
+        finally:
+            conn.set_trace_callback(None)
+
+        self.write('\nTest 5: Passed ✅\n')
+
     def _test_delete_visit(self):
         self.write('Test 3: Delete Subscription in DB')
         
@@ -39,9 +39,9 @@ class ExportManager:
             writer.writerows(data)
 
     def export_to_excel(self, data, column_names=None):
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "ExportedData"
+        # write only workbooks stream rows to the file instead of keeping every cell
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("ExportedData")
 
         # Write column headers
         if column_names:
@@ -55,10 +55,11 @@ class ExportManager:
         wb.save(self.file_name)
 
     def export_to_pdf(self, data, column_names=None):
-        data_list = data
+        # the pdf table is laid out in memory
+        data_list = list(data)
         # Combine headers and data
         if column_names:
-            data_list = [column_names] + data
+            data_list = [column_names] + data_list
         # Create a PDF document
         pdf_file = str(self.file_name)
         doc = SimpleDocTemplate(pdf_file, pagesize=A4)
@@ -1,8 +1,15 @@
+import os
+import re
 import json
+import time
+import threading
 from decimal import Decimal
 from datetime import datetime
 import uuid
 
+_uuid7_lock = threading.Lock()
+_uuid7_last = [0, 0] # [unix ms, sequence] of the last generated uuid7
+
 class DecimalDatetimeUUIDEncoder(json.JSONEncoder):
     '''
     Class to parse Decimal, UUID, Datetime, Set object in test
@@ -33,10 +40,40 @@ def is_valid_date(date_string, date_format):
         return False
     
 def matches_regex(value, pattern, partial=False):
-    import re
-
+    ''' pattern is a compiled pattern or a pattern string '''
     if value is None:
         return False
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
     if partial:
-        return re.search(pattern, str(value)) is not None
-    return re.fullmatch(pattern, str(value)) is not None
\ No newline at end of file
+        return pattern.search(str(value)) is not None
+    return pattern.fullmatch(str(value)) is not None
+
+def uuid7() -> str:
+    '''
+    Time ordered UUID (RFC 9562 version 7).
+    - the first 48 bits are the unix time in milliseconds so new keys land
+        at the end of the primary key index instead of a random page
+    - the 12 bit sequence after the version keeps ids generated in the
+        same millisecond increasing
+    - the last 62 bits are random
+    '''
+    with _uuid7_lock:
+        ms = time.time_ns() // 1_000_000
+        last_ms, seq = _uuid7_last
+
+        if ms > last_ms:
+            # random start with headroom for ids in the same millisecond
+            seq = int.from_bytes(os.urandom(2), 'big') & 0x7FF
+        else:
+            ms = last_ms
+            seq += 1
+            if seq > 0xFFF:
+                ms += 1
+                seq = 0
+
+        _uuid7_last[0], _uuid7_last[1] = ms, seq
+
+    rand = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    value = (ms & ((1 << 48) - 1)) << 80 | 0x7 << 76 | seq << 64 | 0b10 << 62 | rand
+    return str(uuid.UUID(int=value))